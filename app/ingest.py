@@ -0,0 +1,428 @@
+import argparse
+import csv
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Deque, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+from app.repository.pgvector import (
+    ChunkBatch,
+    InsertBatch,
+    PgVectorRepository,
+    VectorIndexConfig,
+)
+from app.repository.registry import model_table_name
+from app.repository.sentence_transformer import (
+    SentenceTransformerRepository,
+    mean_embeddings,
+    truncate_embeddings,
+)
+from app.settings import MODEL_DIMENSIONS, get_settings
+
+FIELDS = ("category", "title", "text")
+
+Record = Tuple[str, str, str]
+# チャンク分割した場合の、文書のベクトルとチャンク
+ChunkedEmbeddings = Tuple[np.ndarray, ChunkBatch]
+
+
+class IngestReport(BaseModel):
+    rows: int
+    skipped: int
+    chunks: int
+    elapsed_seconds: float
+    embed_seconds: float
+    copy_seconds: float
+    index_seconds: float
+    rows_per_second: float
+
+
+def read_records(path: Path, file_format: Optional[str] = None) -> Iterator[Record]:
+    file_format = file_format or path.suffix.lstrip(".").lower()
+    if file_format in ("jsonl", "ndjson", "json"):
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield tuple(str(row[field]) for field in FIELDS)
+    elif file_format == "csv":
+        with path.open(encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                yield tuple(row[field] for field in FIELDS)
+    elif file_format == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("reading parquet files requires pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(columns=list(FIELDS)):
+            columns = [batch.column(field).to_pylist() for field in FIELDS]
+            yield from zip(*columns)
+    else:
+        raise ValueError(f"unsupported file format: {file_format}")
+
+
+def chunked(records: Iterable[Record], size: int) -> Iterator[List[Record]]:
+    chunk: List[Record] = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Checkpoint:
+    def __init__(self, path: Optional[Path], sources: Sequence[str]):
+        self.path = path
+        self.sources = list(sources)
+
+    def load(self) -> int:
+        if self.path is None or not self.path.exists():
+            return 0
+        state = json.loads(self.path.read_text())
+        if state["sources"] != self.sources:
+            raise SystemExit(
+                f"checkpoint {self.path} was written for {state['sources']}, "
+                "remove it to start over"
+            )
+        return state["rows"]
+
+    def save(self, rows: int):
+        if self.path is None:
+            return
+        # 途中で中断されても壊れないよう、一時ファイルに書いてから置き換える
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps({"sources": self.sources, "rows": rows}))
+        os.replace(tmp, self.path)
+
+
+def encode_chunked(
+    repository: SentenceTransformerRepository,
+    titles: List[str],
+    texts: List[str],
+    dimension: Optional[int],
+    max_tokens: Optional[int],
+    overlap: int,
+) -> ChunkedEmbeddings:
+    # APIの挿入と同じく「タイトル チャンク」ごとに推論し、文書のベクトルはその平均とする
+    chunked_texts = repository.chunk_texts(titles, texts, max_tokens, overlap)
+    documents = [i for i, chunks in enumerate(chunked_texts) for _ in chunks]
+    positions = [p for chunks in chunked_texts for p in range(len(chunks))]
+    chunk_texts = [chunk for chunks in chunked_texts for chunk in chunks]
+    embeddings = truncate_embeddings(
+        repository.encode_texts(
+            [f"{titles[i]} {text}" for i, text in zip(documents, chunk_texts)]
+        ),
+        dimension,
+    )
+    return mean_embeddings(embeddings, documents, len(titles)), ChunkBatch(
+        documents=documents,
+        positions=positions,
+        texts=chunk_texts,
+        embeddings=embeddings,
+    )
+
+
+_worker_repository: Optional[SentenceTransformerRepository] = None
+_worker_dimension: Optional[int] = None
+_worker_chunking: Tuple[Optional[int], int] = (None, 0)
+
+
+def _init_worker(
+    model_name: str,
+    num_threads: Optional[int],
+    batch_size: int,
+    dimension: Optional[int],
+    max_batch_tokens: Optional[int],
+    chunking: Tuple[Optional[int], int],
+):
+    global _worker_repository, _worker_dimension, _worker_chunking
+    _worker_repository = SentenceTransformerRepository(
+        model_name,
+        num_threads=num_threads,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+    )
+    _worker_dimension = dimension
+    _worker_chunking = chunking
+
+
+def _encode_in_worker(texts: List[str]) -> np.ndarray:
+    # プロセス間で受け渡すデータを減らすため、ワーカー側で次元を切り詰める
+    return truncate_embeddings(
+        _worker_repository.encode_texts(texts), _worker_dimension
+    )
+
+
+def _encode_chunked_in_worker(titles: List[str], texts: List[str]) -> ChunkedEmbeddings:
+    return encode_chunked(
+        _worker_repository, titles, texts, _worker_dimension, *_worker_chunking
+    )
+
+
+class ChunkEncoder:
+    def __init__(
+        self,
+        model_name: str,
+        workers: int = 1,
+        num_threads: Optional[int] = None,
+        batch_size: int = 128,
+        dimension: Optional[int] = None,
+        max_batch_tokens: Optional[int] = None,
+        chunking: bool = False,
+        chunk_max_tokens: Optional[int] = None,
+        chunk_overlap_tokens: int = 0,
+    ):
+        self.workers = workers
+        self.dimension = dimension
+        self.chunking = chunking
+        self._chunk_window = (chunk_max_tokens, chunk_overlap_tokens)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._repository: Optional[SentenceTransformerRepository] = None
+        if workers > 1:
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(
+                    model_name,
+                    num_threads,
+                    batch_size,
+                    dimension,
+                    max_batch_tokens,
+                    self._chunk_window,
+                ),
+            )
+        else:
+            self._repository = SentenceTransformerRepository(
+                model_name,
+                num_threads=num_threads,
+                batch_size=batch_size,
+                max_batch_tokens=max_batch_tokens,
+            )
+
+    def submit(self, texts: List[str]) -> Future:
+        if self._executor is not None:
+            return self._executor.submit(_encode_in_worker, texts)
+        future: Future = Future()
+        future.set_result(
+            truncate_embeddings(self._repository.encode_texts(texts), self.dimension)
+        )
+        return future
+
+    def submit_chunked(self, titles: List[str], texts: List[str]) -> Future:
+        if self._executor is not None:
+            return self._executor.submit(_encode_chunked_in_worker, titles, texts)
+        future: Future = Future()
+        future.set_result(
+            encode_chunked(
+                self._repository, titles, texts, self.dimension, *self._chunk_window
+            )
+        )
+        return future
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+def ingest(
+    records: Iterable[Record],
+    repository: PgVectorRepository,
+    encoder: ChunkEncoder,
+    checkpoint: Checkpoint,
+    chunk_size: int = 1024,
+    rebuild_indexes: bool = False,
+) -> IngestReport:
+    started = time.perf_counter()
+    skipped = checkpoint.load()
+    rows = skipped
+    chunks = 0
+    embed_seconds = 0.0
+    copy_seconds = 0.0
+    index_seconds = 0.0
+
+    records = iter(records)
+    for _ in range(skipped):
+        next(records, None)
+
+    if rebuild_indexes:
+        repository.drop_indexes()
+
+    # 推論を最大 workers * 2 チャンク先行させ、その間に完了したチャンクをCOPYする
+    pending: Deque[Tuple[List[Record], Future, float]] = deque()
+
+    def flush(limit: int):
+        nonlocal rows, chunks, embed_seconds, copy_seconds
+        while len(pending) > limit:
+            chunk, future, submitted = pending.popleft()
+            if encoder.chunking:
+                embeddings, chunk_batch = future.result()
+            else:
+                embeddings, chunk_batch = future.result(), None
+            embed_seconds += time.perf_counter() - submitted
+            copy_started = time.perf_counter()
+            categories, titles, texts = zip(*chunk)
+            repository.copy_batch(
+                InsertBatch(
+                    categories=list(categories),
+                    titles=list(titles),
+                    texts=list(texts),
+                    embeddings=embeddings,
+                    chunks=chunk_batch,
+                )
+            )
+            copy_seconds += time.perf_counter() - copy_started
+            rows += len(chunk)
+            chunks += 1
+            checkpoint.save(rows)
+
+    for chunk in chunked(records, chunk_size):
+        if encoder.chunking:
+            future = encoder.submit_chunked(
+                [title for _, title, _ in chunk], [text for _, _, text in chunk]
+            )
+        else:
+            future = encoder.submit([f"{title} {text}" for _, title, text in chunk])
+        pending.append((chunk, future, time.perf_counter()))
+        flush(encoder.workers * 2)
+    flush(0)
+
+    if rebuild_indexes:
+        index_started = time.perf_counter()
+        repository.create_indexes()
+        index_seconds = time.perf_counter() - index_started
+
+    elapsed = time.perf_counter() - started
+    return IngestReport(
+        rows=rows - skipped,
+        skipped=skipped,
+        chunks=chunks,
+        elapsed_seconds=elapsed,
+        embed_seconds=embed_seconds,
+        copy_seconds=copy_seconds,
+        index_seconds=index_seconds,
+        rows_per_second=(rows - skipped) / elapsed if elapsed > 0 else 0.0,
+    )
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    settings = get_settings()
+    parser = argparse.ArgumentParser(
+        prog="python -m app.ingest",
+        description="Embed JSONL/CSV/Parquet files and bulk-load them into pgvector",
+    )
+    parser.add_argument("paths", nargs="+", type=Path)
+    parser.add_argument("--format", choices=["jsonl", "csv", "parquet"])
+    parser.add_argument("--connection-string", default=settings.connection_string)
+    parser.add_argument(
+        "--table",
+        help="defaults to the table the API searches for --model",
+    )
+    parser.add_argument(
+        "--model",
+        default=settings.sentence_transformer_model,
+        choices=sorted(MODEL_DIMENSIONS),
+    )
+    parser.add_argument(
+        "--dimension",
+        type=int,
+        help="store only the first N dimensions, renormalized (Matryoshka); "
+        "defaults to EMBEDDING_DIMENSION for the default model",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument(
+        "--max-batch-tokens",
+        type=int,
+        default=settings.max_batch_tokens,
+        help="group texts of similar length so each batch pads to at most N tokens",
+    )
+    parser.add_argument(
+        "--document-chunking",
+        action=argparse.BooleanOptionalAction,
+        default=settings.document_chunking,
+        help="split texts into overlapping token windows and store chunk vectors",
+    )
+    parser.add_argument(
+        "--chunk-max-tokens", type=int, default=settings.chunk_max_tokens
+    )
+    parser.add_argument(
+        "--chunk-overlap-tokens", type=int, default=settings.chunk_overlap_tokens
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads-per-worker", type=int)
+    parser.add_argument("--checkpoint", type=Path)
+    parser.add_argument(
+        "--rebuild-indexes",
+        action="store_true",
+        help="drop the ANN and trigram indexes before loading and rebuild them after",
+    )
+    args = parser.parse_args(argv)
+    # APIと同じく、既定のモデルは TABLE_NAME と EMBEDDING_DIMENSION を使い、
+    # それ以外のモデルは切り詰めずにモデルごとのテーブルへ保存する
+    if args.model == settings.sentence_transformer_model:
+        args.table = args.table or settings.table_name
+        if args.dimension is None:
+            args.dimension = settings.embedding_dimension
+    else:
+        args.table = args.table or model_table_name(args.model)
+    if args.dimension is not None and not (
+        0 < args.dimension <= MODEL_DIMENSIONS[args.model]
+    ):
+        parser.error(
+            f"--dimension must be between 1 and {MODEL_DIMENSIONS[args.model]}"
+        )
+    if args.chunk_overlap_tokens < 0 or (
+        args.chunk_max_tokens is not None
+        and args.chunk_overlap_tokens >= args.chunk_max_tokens
+    ):
+        parser.error("--chunk-overlap-tokens must be in [0, --chunk-max-tokens)")
+    return args
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    args = parse_args(argv)
+    repository = PgVectorRepository(
+        args.connection_string,
+        table_name=args.table,
+        index_config=VectorIndexConfig.from_settings(get_settings()),
+    )
+    repository.create_table(vector_dim=args.dimension or MODEL_DIMENSIONS[args.model])
+    encoder = ChunkEncoder(
+        args.model,
+        workers=args.workers,
+        num_threads=args.threads_per_worker,
+        batch_size=args.batch_size,
+        dimension=args.dimension,
+        max_batch_tokens=args.max_batch_tokens,
+        chunking=args.document_chunking,
+        chunk_max_tokens=args.chunk_max_tokens,
+        chunk_overlap_tokens=args.chunk_overlap_tokens,
+    )
+    records = (
+        record for path in args.paths for record in read_records(path, args.format)
+    )
+    try:
+        report = ingest(
+            records,
+            repository,
+            encoder,
+            Checkpoint(args.checkpoint, [str(path) for path in args.paths]),
+            chunk_size=args.chunk_size,
+            rebuild_indexes=args.rebuild_indexes,
+        )
+    finally:
+        encoder.close()
+        repository.close()
+    print(report.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
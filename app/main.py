@@ -1,12 +1,56 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
 
-from app.router import embed, health, hybrid
+from app.metrics import RequestMetricsMiddleware
+from app.profiling import ProfilingMiddleware, get_profile_store
+from app.repository.batcher import QueueFullError
+from app.repository.memory import UnsupportedSearchError
+from app.repository.registry import UnknownModelError
+from app.router import admin, embed, health, hybrid, metrics
+from app.settings import get_settings
 
 app = FastAPI(title="Embedding API", version="1.0.0")
 
+app.include_router(admin.router)
 app.include_router(embed.router)
 app.include_router(health.router)
 app.include_router(hybrid.router)
+app.include_router(metrics.router)
+app.add_middleware(RequestMetricsMiddleware)
+
+settings = get_settings()
+if settings.profiling_enabled:
+    app.add_middleware(
+        ProfilingMiddleware,
+        store=get_profile_store(settings),
+        sample_rate=settings.profiling_sample_rate,
+        header=settings.profiling_header,
+        top_functions=settings.profiling_top_functions,
+    )
+
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(get_settings().retry_after_seconds)},
+    )
+
+
+@app.exception_handler(UnknownModelError)
+async def unknown_model_handler(request: Request, exc: UnknownModelError):
+    return JSONResponse(
+        status_code=status.HTTP_404_NOT_FOUND, content={"detail": str(exc)}
+    )
+
+
+@app.exception_handler(UnsupportedSearchError)
+async def unsupported_search_handler(request: Request, exc: UnsupportedSearchError):
+    return JSONResponse(
+        status_code=status.HTTP_400_BAD_REQUEST, content={"detail": str(exc)}
+    )
+
 
 if __name__ == "__main__":
     import uvicorn
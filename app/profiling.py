@@ -0,0 +1,240 @@
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Annotated, Callable, Deque, List, Literal, Optional
+
+from fastapi import Depends
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from app.settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+ProfileTrigger = Literal["header", "sample"]
+
+
+class ProfileSummary(BaseModel):
+    id: int
+    method: str
+    path: str
+    trigger: ProfileTrigger
+    started_at: datetime
+    elapsed_ms: float
+    status: int
+    # 計測中に始まった他のリクエストの件数。0でない場合はその処理も計測に含まれる
+    concurrent_requests: int = 0
+
+
+class RequestProfile(ProfileSummary):
+    stats: str
+    explain: List[str] = []
+
+
+@dataclass
+class ActiveProfile:
+    # プロファイルの停止後に実行する、EXPLAIN ANALYZE を取得する処理
+    explains: List[Callable[[], str]] = field(default_factory=list)
+
+
+_active: ContextVar[Optional[ActiveProfile]] = ContextVar(
+    "active_profile", default=None
+)
+
+
+def active_profile() -> Optional[ActiveProfile]:
+    # run_in_threadpool はコンテキストを引き継ぐため、スレッド内の処理からも参照できる
+    return _active.get()
+
+
+class ProfileStore:
+    def __init__(self, max_profiles: int = 50):
+        self._profiles: Deque[RequestProfile] = deque(maxlen=max_profiles)
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def reserve_id(self) -> int:
+        # レスポンスのヘッダーで返せるよう、計測の開始時に番号を決める
+        with self._lock:
+            profile_id = self._next_id
+            self._next_id += 1
+        return profile_id
+
+    def add(self, profile: RequestProfile) -> RequestProfile:
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def list(self) -> List[ProfileSummary]:
+        with self._lock:
+            return [
+                ProfileSummary(**profile.model_dump(exclude={"stats", "explain"}))
+                for profile in reversed(self._profiles)
+            ]
+
+    def get(self, profile_id: int) -> Optional[RequestProfile]:
+        with self._lock:
+            return next((p for p in self._profiles if p.id == profile_id), None)
+
+
+def _with_header(send, name: bytes, value: bytes):
+    async def send_with_header(message):
+        if message["type"] == "http.response.start":
+            headers = [*message.get("headers", []), (name, value)]
+            message = {**message, "headers": headers}
+        await send(message)
+
+    return send_with_header
+
+
+def format_stats(profiler: cProfile.Profile, top: int) -> str:
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(top)
+    return output.getvalue()
+
+
+class ProfilingMiddleware:
+    def __init__(
+        self,
+        app,
+        store: ProfileStore,
+        sample_rate: float = 0.0,
+        header: str = "X-Profile",
+        top_functions: int = 40,
+    ):
+        self.app = app
+        self.store = store
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode("latin-1")
+        self.top_functions = top_functions
+        # cProfileはプロセス全体（3.12以降は全スレッド）を計測するため、
+        # 他のリクエストと並行した処理が混ざらないよう、単独で処理中のリクエストだけを
+        # プロファイルする。ASGIの呼び出しはイベントループ上で行われるため、ロックは不要
+        self._in_flight = 0
+        self._profiling = False
+        self._concurrent = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trigger = self._trigger(scope)
+        others = self._in_flight
+        self._in_flight += 1
+        if self._profiling:
+            self._concurrent += 1
+        try:
+            if trigger is not None and others == 0:
+                await self._profile(scope, receive, send, trigger)
+            elif trigger is not None:
+                logger.info(
+                    "skipped profiling %s: %d other requests in flight",
+                    scope["path"],
+                    others,
+                )
+                await self.app(
+                    scope,
+                    receive,
+                    _with_header(send, b"x-profile-skipped", b"concurrent-requests"),
+                )
+            else:
+                await self.app(scope, receive, send)
+        finally:
+            self._in_flight -= 1
+
+    def _trigger(self, scope) -> Optional[ProfileTrigger]:
+        for name, value in scope["headers"]:
+            if name == self.header and value not in (b"", b"0", b"false"):
+                return "header"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    async def _profile(self, scope, receive, send, trigger: ProfileTrigger):
+        status = 500
+        profile_id = self.store.reserve_id()
+        send = _with_header(send, b"x-profile-id", str(profile_id).encode("latin-1"))
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        active = ActiveProfile()
+        token = _active.set(active)
+        started_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        self._profiling = True
+        self._concurrent = 0
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            profiler.disable()
+            self._profiling = False
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            _active.reset(token)
+            # 途中で他のリクエストが始まった場合も破棄せず、その件数を付けて保存する
+            await self._save(
+                profile_id,
+                scope,
+                trigger,
+                started_at,
+                elapsed_ms,
+                status,
+                profiler,
+                active,
+                self._concurrent,
+            )
+
+    async def _save(
+        self,
+        profile_id: int,
+        scope,
+        trigger: ProfileTrigger,
+        started_at: datetime,
+        elapsed_ms: float,
+        status: int,
+        profiler: cProfile.Profile,
+        active: ActiveProfile,
+        concurrent_requests: int,
+    ):
+        # 実行計画はレスポンスを返した後に取得し、CPUプロファイルにも含めない
+        explain = []
+        for run in active.explains:
+            try:
+                explain.append(await run_in_threadpool(run))
+            except Exception as e:
+                explain.append(f"EXPLAIN failed: {e}")
+        self.store.add(
+            RequestProfile(
+                id=profile_id,
+                method=scope["method"],
+                path=scope["path"],
+                trigger=trigger,
+                started_at=started_at,
+                elapsed_ms=elapsed_ms,
+                status=status,
+                concurrent_requests=concurrent_requests,
+                stats=format_stats(profiler, self.top_functions),
+                explain=explain,
+            )
+        )
+
+
+@lru_cache(maxsize=1)
+def get_profile_store(
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> ProfileStore:
+    return ProfileStore(max_profiles=settings.profiling_max_profiles)
@@ -0,0 +1,172 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Annotated, List, Optional, Sequence
+
+import numpy as np
+from fastapi import Depends
+
+from app.metrics import BATCH_SIZE, STAGE_SECONDS
+from app.repository.sentence_transformer import (
+    SentenceTransformerRepository,
+    get_sentence_transformer_repository,
+)
+from app.settings import Settings, get_settings
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class ModelUnloadedError(QueueFullError):
+    # 再送すればモデルが読み込み直されるため、キューが満杯の場合と同じく429で応答する
+    pass
+
+
+@dataclass
+class _Job:
+    texts: List[str]
+    future: Future
+    enqueued: float = field(default_factory=time.perf_counter)
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        repository: SentenceTransformerRepository,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        workers: int = 1,
+        max_queue_size: int = 0,
+    ):
+        self.repository = repository
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: queue.Queue[Optional[_Job]] = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._workers = [
+            threading.Thread(
+                target=self._run, name=f"embedding-worker-{i}", daemon=True
+            )
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    async def encode_text(self, text: str) -> np.ndarray:
+        embeddings = await self._submit([text])
+        return embeddings[0]
+
+    async def encode_texts(self, texts: Sequence[str]) -> np.ndarray:
+        return await self._submit(list(texts))
+
+    def chunk_texts(
+        self,
+        titles: Sequence[str],
+        texts: Sequence[str],
+        max_tokens: Optional[int] = None,
+        overlap: int = 0,
+    ) -> List[List[str]]:
+        # トークナイズのみでモデルの推論は行わないため、キューを経由せずに呼び出す
+        return self.repository.chunk_texts(titles, texts, max_tokens, overlap)
+
+    def close(self):
+        # キュー済みのリクエストを処理し終えてから、ワーカーごとに終了の目印で止める
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            for _ in self._workers:
+                self._queue.put(None)
+
+    def _submit(self, texts: List[str]) -> asyncio.Future:
+        future: Future = Future()
+        with self._close_lock:
+            if self._closed:
+                raise ModelUnloadedError(
+                    f"embedding model {self.repository.model_name} was unloaded"
+                )
+            try:
+                self._queue.put_nowait(_Job(texts=texts, future=future))
+            except queue.Full:
+                raise QueueFullError(f"embedding queue is full ({self._queue.maxsize})")
+        return asyncio.wrap_future(future)
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            if not jobs:
+                return
+            self._encode(jobs)
+
+    def _collect(self) -> List[_Job]:
+        first = self._queue.get()
+        if first is None:
+            return []
+        jobs = [first]
+        size = len(first.texts)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job is None:
+                # 他のワーカーも止められるよう、終了の目印はキューに戻す
+                self._queue.put(None)
+                break
+            jobs.append(job)
+            size += len(job.texts)
+        return jobs
+
+    def _encode(self, jobs: List[_Job]):
+        # 待機中にキャンセルされたリクエストはバッチから除外する
+        jobs = [job for job in jobs if job.future.set_running_or_notify_cancel()]
+        if not jobs:
+            return
+        started = time.perf_counter()
+        for job in jobs:
+            STAGE_SECONDS.observe(started - job.enqueued, "queue_wait")
+        texts = tuple(text for job in jobs for text in job.texts)
+        BATCH_SIZE.observe(len(texts))
+        try:
+            embeddings = self.repository.encode_texts(texts)
+            STAGE_SECONDS.observe(time.perf_counter() - started, "encode")
+        except Exception as e:
+            for job in jobs:
+                job.future.set_exception(e)
+            return
+        offset = 0
+        for job in jobs:
+            job.future.set_result(embeddings[offset : offset + len(job.texts)])
+            offset += len(job.texts)
+
+
+def build_embedding_batcher(
+    settings: Settings, repository: SentenceTransformerRepository
+) -> EmbeddingBatcher:
+    return EmbeddingBatcher(
+        repository,
+        max_batch_size=settings.batch_max_size,
+        max_wait_ms=settings.batch_max_wait_ms,
+        workers=settings.inference_workers,
+        max_queue_size=settings.inference_queue_size,
+    )
+
+
+@lru_cache(maxsize=1)
+def get_embedding_batcher(
+    settings: Annotated[Settings, Depends(get_settings)],
+    repository: Annotated[
+        SentenceTransformerRepository, Depends(get_sentence_transformer_repository)
+    ],
+) -> EmbeddingBatcher:
+    return build_embedding_batcher(settings, repository)
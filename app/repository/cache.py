@@ -0,0 +1,222 @@
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+import numpy as np
+from fastapi import Depends
+from pydantic import BaseModel
+from typing_extensions import Annotated
+
+from app.repository.disk_cache import DiskEmbeddingCache
+from app.repository.pgvector import VectorRecord
+from app.settings import Settings, get_settings
+
+V = TypeVar("V")
+
+# OrderedDictのノードやキーなど、値以外にかかる1エントリあたりのおおよそのバイト数
+ENTRY_OVERHEAD_BYTES = 128
+# 検索結果1件のうち、文字列以外（数値・日時・オブジェクト）にかかるおおよそのバイト数
+RECORD_OVERHEAD_BYTES = 400
+
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    bytes: int
+    max_bytes: int
+    disk_hits: int = 0
+
+
+class LRUCache(Generic[V]):
+    def __init__(
+        self,
+        max_bytes: int,
+        sizeof: Callable[[V], int],
+        ttl_seconds: Optional[float] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._sizeof = sizeof
+        self._entries: OrderedDict[Hashable, Tuple[V, int, float]] = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[2]):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: V):
+        size = self._sizeof(value) + ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+            )
+
+    def _expired(self, stored_at: float) -> bool:
+        return (
+            self.ttl_seconds is not None
+            and time.monotonic() - stored_at > self.ttl_seconds
+        )
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def embedding_key(model_name: str, text: str) -> bytes:
+    return hashlib.sha256(
+        f"{model_name}\0{normalize_text(text)}".encode("utf-8")
+    ).digest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        model_name: str,
+        max_bytes: int,
+        ttl_seconds: Optional[float] = None,
+        disk: Optional[DiskEmbeddingCache] = None,
+    ):
+        self.model_name = model_name
+        self.disk = disk
+        self._cache: LRUCache[np.ndarray] = LRUCache(
+            max_bytes=max_bytes,
+            sizeof=lambda embedding: embedding.nbytes,
+            ttl_seconds=ttl_seconds,
+        )
+        self._disk_hits = 0
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        keys = [embedding_key(self.model_name, t) for t in texts]
+        embeddings = [self._cache.get(key) for key in keys]
+        missing = [key for key, e in zip(keys, embeddings) if e is None]
+        if self.disk is None or not missing:
+            return embeddings
+        found = self.disk.get_many(missing)
+        for key, embedding in found.items():
+            self._cache.put(key, embedding)
+        self._disk_hits += len(found)
+        return [found.get(key) if e is None else e for key, e in zip(keys, embeddings)]
+
+    def put_many(self, texts: Sequence[str], embeddings: np.ndarray):
+        keys = [embedding_key(self.model_name, t) for t in texts]
+        for key, embedding in zip(keys, embeddings):
+            # バッチ全体の行列を保持しないよう1行ずつコピーし、読み取り専用にする
+            value = np.array(embedding, dtype=np.float32)
+            value.setflags(write=False)
+            self._cache.put(key, value)
+        if self.disk is not None:
+            self.disk.put_many(keys, embeddings)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> CacheStats:
+        return self._cache.stats().model_copy(update={"disk_hits": self._disk_hits})
+
+
+def _records_size(records: List[VectorRecord]) -> int:
+    return sum(
+        RECORD_OVERHEAD_BYTES + len(r.category) + len(r.title) + len(r.text)
+        for r in records
+    )
+
+
+class SearchResultCache:
+    def __init__(
+        self, model_name: str, max_bytes: int, ttl_seconds: Optional[float] = None
+    ):
+        self.model_name = model_name
+        self._cache: LRUCache[List[VectorRecord]] = LRUCache(
+            max_bytes=max_bytes, sizeof=_records_size, ttl_seconds=ttl_seconds
+        )
+
+    def key(self, request: Dict[str, Any], generation: int) -> bytes:
+        # 世代番号をキーに含めるため、挿入後は古い結果が参照されずLRUで追い出される
+        normalized = {**request, "query": normalize_text(request["query"])}
+        payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(
+            f"{self.model_name}\0{generation}\0{payload}".encode("utf-8")
+        ).digest()
+
+    def get(self, key: bytes) -> Optional[List[VectorRecord]]:
+        return self._cache.get(key)
+
+    def put(self, key: bytes, records: List[VectorRecord]):
+        self._cache.put(key, list(records))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> CacheStats:
+        return self._cache.stats()
+
+
+@lru_cache(maxsize=1)
+def get_search_result_cache(
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> Optional[SearchResultCache]:
+    if settings.search_cache_max_bytes <= 0:
+        return None
+    return SearchResultCache(
+        settings.sentence_transformer_model,
+        max_bytes=settings.search_cache_max_bytes,
+        ttl_seconds=settings.search_cache_ttl_seconds,
+    )
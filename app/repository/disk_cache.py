@@ -0,0 +1,140 @@
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# SQLiteのバインド変数上限（古いビルドでは999）を超えないように分割して検索する
+QUERY_CHUNK_SIZE = 500
+# 件数の確認と古い行の削除は、この件数を書き込むごとに行う
+PRUNE_INTERVAL_ROWS = 1000
+
+
+class DiskEmbeddingCache:
+    def __init__(
+        self,
+        path: str,
+        model_name: str,
+        timeout: float = 5.0,
+        max_rows: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+    ):
+        self.path = path
+        self.model_name = model_name
+        self.max_rows = max_rows
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._written = 0
+        self._conn = sqlite3.connect(
+            path, timeout=timeout, check_same_thread=False, isolation_level=None
+        )
+        # WALモードにより、複数のワーカープロセスから同時に読み込める
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,
+                model TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL DEFAULT 0
+            ) WITHOUT ROWID;
+        """)
+        columns = [
+            row[1] for row in self._conn.execute("PRAGMA table_info(embeddings);")
+        ]
+        if "accessed_at" not in columns:
+            # 最終参照時刻がない以前のファイルは、作成時刻を参照時刻とみなす
+            self._conn.execute(
+                "ALTER TABLE embeddings ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0;"
+            )
+            self._conn.execute("UPDATE embeddings SET accessed_at = created_at;")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_accessed_at "
+            "ON embeddings (accessed_at);"
+        )
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        found: Dict[bytes, np.ndarray] = {}
+        unique = list(dict.fromkeys(keys))
+        now = time.time()
+        created_after = now - self.ttl_seconds if self.ttl_seconds is not None else 0
+        with self._lock:
+            for i in range(0, len(unique), QUERY_CHUNK_SIZE):
+                chunk = unique[i : i + QUERY_CHUNK_SIZE]
+                rows = self._conn.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN "
+                    f"({','.join('?' * len(chunk))}) AND created_at >= ?;",
+                    [*chunk, created_after],
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype="<f4")
+            if found:
+                # 上限を超えたときに最も古く参照された行から削除するため、参照時刻を更新する
+                hits = list(found)
+                for i in range(0, len(hits), QUERY_CHUNK_SIZE):
+                    chunk = hits[i : i + QUERY_CHUNK_SIZE]
+                    self._conn.execute(
+                        "UPDATE embeddings SET accessed_at = ? WHERE key IN "
+                        f"({','.join('?' * len(chunk))});",
+                        [now, *chunk],
+                    )
+        return found
+
+    def put_many(self, keys: Sequence[bytes], embeddings: np.ndarray):
+        vectors = np.ascontiguousarray(embeddings, dtype="<f4")
+        now = time.time()
+        rows: List[tuple] = [
+            (key, self.model_name, vector.shape[0], vector.tobytes(), now, now)
+            for key, vector in zip(keys, vectors)
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN;")
+            try:
+                # 期限切れの行は読み込まれないため、新しいベクトルで置き換える
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings "
+                    "(key, model, dim, vector, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?);",
+                    rows,
+                )
+                self._conn.execute("COMMIT;")
+            except Exception:
+                self._conn.execute("ROLLBACK;")
+                raise
+            self._written += len(rows)
+            if self._written >= PRUNE_INTERVAL_ROWS:
+                self._written = 0
+                self._prune(now)
+
+    def prune(self):
+        with self._lock:
+            self._prune(time.time())
+
+    def _prune(self, now: float):
+        # ファイルは複数のモデル・プロセスで共有するため、件数の上限はファイル全体に適用する
+        if self.ttl_seconds is not None:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE created_at < ?;",
+                (now - self.ttl_seconds,),
+            )
+        if self.max_rows is not None:
+            rows = self._conn.execute("SELECT COUNT(*) FROM embeddings;").fetchone()[0]
+            if rows > self.max_rows:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN ("
+                    "SELECT key FROM embeddings ORDER BY accessed_at LIMIT ?);",
+                    (rows - self.max_rows,),
+                )
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings WHERE model = ?;", (self.model_name,)
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,81 @@
+from typing import Callable, Dict, List, Literal, Optional, Sequence
+
+from pydantic import BaseModel, Field
+
+FusionStrategy = Literal["linear", "rrf", "max"]
+
+
+class FusionParams(BaseModel):
+    strategy: FusionStrategy = "linear"
+    vector_weight: float = Field(default=0.7, ge=0)
+    text_weight: float = Field(default=0.3, ge=0)
+    # RRFの平滑化定数。大きいほど下位の候補との差が小さくなる
+    rrf_k: int = Field(default=60, ge=1)
+
+
+Scorer = Callable[[float, float, Optional[int], Optional[int], FusionParams], float]
+
+
+def _linear(
+    vector_score: float,
+    text_score: float,
+    vector_rank: Optional[int],
+    text_rank: Optional[int],
+    params: FusionParams,
+) -> float:
+    return vector_score * params.vector_weight + text_score * params.text_weight
+
+
+def _rrf(
+    vector_score: float,
+    text_score: float,
+    vector_rank: Optional[int],
+    text_rank: Optional[int],
+    params: FusionParams,
+) -> float:
+    score = 0.0
+    if vector_rank is not None:
+        score += params.vector_weight / (params.rrf_k + vector_rank)
+    if text_rank is not None:
+        score += params.text_weight / (params.rrf_k + text_rank)
+    return score
+
+
+def _max(
+    vector_score: float,
+    text_score: float,
+    vector_rank: Optional[int],
+    text_rank: Optional[int],
+    params: FusionParams,
+) -> float:
+    return max(vector_score * params.vector_weight, text_score * params.text_weight)
+
+
+SCORERS: Dict[str, Scorer] = {"linear": _linear, "rrf": _rrf, "max": _max}
+
+
+def rank(scores: Sequence[Optional[float]]) -> List[Optional[int]]:
+    # スコアの降順に1始まりの順位を付ける。候補に含まれない (None) ものは順位なし
+    ranks: List[Optional[int]] = [None] * len(scores)
+    ordered = sorted(
+        (i for i, score in enumerate(scores) if score is not None),
+        key=lambda i: scores[i],
+        reverse=True,
+    )
+    for position, i in enumerate(ordered, start=1):
+        ranks[i] = position
+    return ranks
+
+
+def fuse(
+    vector_scores: Sequence[Optional[float]],
+    text_scores: Sequence[Optional[float]],
+    params: FusionParams,
+) -> List[float]:
+    scorer = SCORERS[params.strategy]
+    return [
+        scorer(vector_score or 0.0, text_score or 0.0, vector_rank, text_rank, params)
+        for vector_score, text_score, vector_rank, text_rank in zip(
+            vector_scores, text_scores, rank(vector_scores), rank(text_scores)
+        )
+    ]
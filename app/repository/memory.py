@@ -0,0 +1,468 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from app.repository.fusion import FusionParams
+from app.repository.pgvector import (
+    DEFAULT_TABLE_NAME,
+    ChunkAggregation,
+    CopyFormat,
+    InsertBatch,
+    InsertVector,
+    PoolStats,
+    SearchQuery,
+    VectorRecord,
+    fuse_rows,
+)
+
+# pg_trgm の pg_trgm.word_similarity_threshold の既定値（%> 演算子の閾値）
+WORD_SIMILARITY_THRESHOLD = 0.6
+# 類似度行列 (クエリ数, 件数) が大きくなりすぎないよう、この件数ずつクエリを処理する
+QUERY_BLOCK_SIZE = 64
+
+_WORD = re.compile(r"[^\W_]+")
+_FIELDS = ("title", "text")
+
+
+class UnsupportedSearchError(ValueError):
+    pass
+
+
+def ordered_trigrams(text: str) -> List[str]:
+    # pg_trgmと同じく、小文字にした単語の前に空白2つ・後ろに空白1つを付けて3文字ずつ切り出す
+    result: List[str] = []
+    for word in _WORD.findall(text.lower()):
+        padded = f"  {word} "
+        result.extend(padded[i : i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def trigrams(text: str) -> Set[str]:
+    return set(ordered_trigrams(text))
+
+
+def word_similarity(query_trigrams: Set[str], text: str) -> float:
+    # 本文のトライグラム列の連続する範囲のうち、クエリとの類似度が最大のものを探す。
+    # 両端がクエリに含まれない範囲は類似度が下がるだけなので、含まれる位置だけを端にする
+    sequence = ordered_trigrams(text)
+    positions = [i for i, trigram in enumerate(sequence) if trigram in query_trigrams]
+    best = 0.0
+    for start in positions:
+        shared: Set[str] = set()
+        extra: Set[str] = set()
+        for trigram in sequence[start : positions[-1] + 1]:
+            (shared if trigram in query_trigrams else extra).add(trigram)
+            if trigram in query_trigrams:
+                best = max(best, len(shared) / (len(query_trigrams) + len(extra)))
+    return best
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return (embeddings / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+
+class InMemoryVectorRepository:
+    def __init__(
+        self,
+        vector_dim: int,
+        table_name: str = DEFAULT_TABLE_NAME,
+        snapshot_dir: Optional[str] = None,
+    ):
+        self.table_name = table_name
+        self.vector_dim = vector_dim
+        self.snapshot_dir = snapshot_dir
+        self.generation = 0
+        self._lock = threading.Lock()
+        # 正規化済みのベクトル。容量を倍々に確保し、先頭 _size 行を使う
+        self._embeddings = np.empty((0, vector_dim), dtype=np.float32)
+        # ゼロベクトルはpgvectorのコサイン距離がNaNになり候補にならないため除外する
+        self._zero = np.empty(0, dtype=bool)
+        self._size = 0
+        self._categories: List[str] = []
+        self._titles: List[str] = []
+        self._texts: List[str] = []
+        self._created_at: List[datetime] = []
+        self._category_rows: Dict[str, List[int]] = {}
+        # フィールドごとのトライグラムの転置インデックスと、行ごとのトライグラム数
+        self._postings: Dict[str, Dict[str, List[int]]] = {f: {} for f in _FIELDS}
+        self._trigram_counts: Dict[str, List[int]] = {f: [] for f in _FIELDS}
+        # 挿入のたびに破棄する、検索用のNumPy配列のキャッシュ
+        self._arrays: Dict[Tuple[str, str], np.ndarray] = {}
+        self._haystacks: Dict[str, Tuple[str, np.ndarray]] = {}
+        self._tables: Dict[str, "InMemoryVectorRepository"] = {table_name: self}
+        self._tables_lock = threading.Lock()
+
+    @classmethod
+    def load(
+        cls,
+        snapshot_dir: Optional[str],
+        vector_dim: int,
+        table_name: str = DEFAULT_TABLE_NAME,
+    ) -> "InMemoryVectorRepository":
+        repository = cls(vector_dim, table_name=table_name, snapshot_dir=snapshot_dir)
+        path = repository._snapshot_path()
+        if path is None or not (path / "embeddings.npy").exists():
+            return repository
+        # ベクトルはメモリマップで読み込み、最初の挿入時にメモリへコピーする
+        embeddings = np.load(path / "embeddings.npy", mmap_mode="r")
+        with (path / "documents.jsonl").open(encoding="utf-8") as f:
+            documents = [json.loads(line) for line in f]
+        if embeddings.shape != (len(documents), vector_dim):
+            raise ValueError(
+                f"snapshot {path} has shape {embeddings.shape}, "
+                f"expected ({len(documents)}, {vector_dim})"
+            )
+        repository._embeddings = embeddings
+        repository._zero = ~np.any(embeddings, axis=1)
+        for document in documents:
+            repository._append_document(
+                document["category"],
+                document["title"],
+                document["text"],
+                datetime.fromisoformat(document["created_at"]),
+            )
+        repository._size = len(documents)
+        return repository
+
+    def close(self):
+        pass
+
+    def pool_stats(self) -> PoolStats:
+        return PoolStats(
+            size=0, available=0, in_use=0, waiting=0, requests=0, wait_ms=0, errors=0
+        )
+
+    def create_table(self, vector_dim: int = 384):
+        if vector_dim != self.vector_dim:
+            raise ValueError(
+                f"table {self.table_name} stores {self.vector_dim} dimensions"
+            )
+
+    def for_table(self, table_name: str, vector_dim: int) -> "InMemoryVectorRepository":
+        with self._tables_lock:
+            repository = self._tables.get(table_name)
+            if repository is None:
+                repository = InMemoryVectorRepository.load(
+                    self.snapshot_dir, vector_dim, table_name=table_name
+                )
+                repository._tables = self._tables
+                repository._tables_lock = self._tables_lock
+                self._tables[table_name] = repository
+        return repository
+
+    def copy(self, items: List[InsertVector]):
+        self.copy_batch(InsertBatch.from_items(items))
+
+    def copy_batch(self, batch: InsertBatch, copy_format: CopyFormat = "binary"):
+        # チャンクはpgvectorのテーブルにのみ保存するため、ここでは文書のベクトルだけを扱う
+        if not batch.categories:
+            return
+        count = len(batch.categories)
+        embeddings = _normalize(batch.embeddings)
+        created_at = datetime.now(timezone.utc)
+        with self._lock:
+            self._reserve(count)
+            start = self._size
+            self._embeddings[start : start + count] = embeddings
+            self._zero[start : start + count] = ~np.any(embeddings, axis=1)
+            for category, title, text in zip(
+                batch.categories, batch.titles, batch.texts
+            ):
+                self._append_document(category, title, text, created_at)
+            self._size += count
+            self._arrays.clear()
+            self._haystacks.clear()
+            self.generation += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        # for_table で作成したモデルごとのテーブルも含め、すべてのテーブルを保存する
+        with self._tables_lock:
+            tables = list(self._tables.values())
+        return {table.table_name: table._snapshot_table() for table in tables}
+
+    def _snapshot_table(self) -> int:
+        path = self._snapshot_path()
+        if path is None:
+            raise ValueError("snapshot_dir is not configured")
+        path.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            size = self._size
+            embeddings = self._embeddings[:size]
+            documents = list(
+                zip(
+                    self._categories[:size],
+                    self._titles[:size],
+                    self._texts[:size],
+                    self._created_at[:size],
+                )
+            )
+        # 書き込み途中で中断されても壊れないよう、一時ファイルに書いてから置き換える
+        with (path / "embeddings.npy.tmp").open("wb") as f:
+            np.save(f, embeddings)
+        with (path / "documents.jsonl.tmp").open("w", encoding="utf-8") as f:
+            for category, title, text, created_at in documents:
+                f.write(
+                    json.dumps(
+                        {
+                            "category": category,
+                            "title": title,
+                            "text": text,
+                            "created_at": created_at.isoformat(),
+                        },
+                        ensure_ascii=False,
+                    )
+                    + "\n"
+                )
+        os.replace(path / "embeddings.npy.tmp", path / "embeddings.npy")
+        os.replace(path / "documents.jsonl.tmp", path / "documents.jsonl")
+        return size
+
+    def hybrid_search(
+        self,
+        embedding: np.ndarray,
+        query: str,
+        category: Optional[str] = None,
+        limit: int = 10,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+        vector_candidates: int = 100,
+        text_candidates: int = 100,
+        max_distance: Optional[float] = 0.5,
+        rescore_candidates: Optional[int] = None,
+        fusion: Optional[FusionParams] = None,
+        chunk_aggregation: Optional[ChunkAggregation] = None,
+        chunk_candidates: int = 300,
+    ) -> List[VectorRecord]:
+        return self.hybrid_search_batch(
+            [
+                SearchQuery(
+                    embedding=embedding,
+                    query=query,
+                    category=category,
+                    limit=limit,
+                    ef_search=ef_search,
+                    probes=probes,
+                    vector_candidates=vector_candidates,
+                    text_candidates=text_candidates,
+                    max_distance=max_distance,
+                    rescore_candidates=rescore_candidates,
+                    fusion=fusion or FusionParams(),
+                    chunk_aggregation=chunk_aggregation,
+                    chunk_candidates=chunk_candidates,
+                )
+            ]
+        )[0]
+
+    def hybrid_search_batch(
+        self, queries: List[SearchQuery]
+    ) -> List[List[VectorRecord]]:
+        if any(search.chunk_aggregation is not None for search in queries):
+            raise UnsupportedSearchError(
+                "chunk_aggregation is not supported by the in-memory repository"
+            )
+        with self._lock:
+            size = self._size
+            embeddings = self._embeddings[:size]
+            zero = self._zero[:size]
+        results = []
+        # 全件との内積をクエリのまとまりごとに1回の行列積で求める（正規化済みなのでコサイン類似度）
+        for start in range(0, len(queries), QUERY_BLOCK_SIZE):
+            block = queries[start : start + QUERY_BLOCK_SIZE]
+            matrix = _normalize(np.stack([search.embedding for search in block]))
+            scores = matrix @ embeddings.T
+            for search, query_vector, row_scores in zip(block, matrix, scores):
+                results.append(
+                    self._search(search, size, row_scores, zero, query_vector)
+                )
+        return results
+
+    def _search(
+        self,
+        search: SearchQuery,
+        size: int,
+        scores: np.ndarray,
+        zero: np.ndarray,
+        query_vector: np.ndarray,
+    ) -> List[VectorRecord]:
+        rows = self._category_array(search.category, size)
+        vector_scores: Dict[int, float] = {}
+        if np.any(query_vector):
+            vector_scores = self._vector_candidates(search, rows, scores, zero)
+        text_scores = self._text_candidates(search, rows, size)
+        records = [
+            (
+                row + 1,
+                self._categories[row],
+                self._titles[row],
+                self._texts[row],
+                vector_scores.get(row),
+                text_scores.get(row),
+                self._created_at[row],
+            )
+            for row in dict.fromkeys([*vector_scores, *text_scores])
+        ]
+        return fuse_rows(records, search.fusion, search.limit)
+
+    def _vector_candidates(
+        self,
+        search: SearchQuery,
+        rows: Optional[np.ndarray],
+        scores: np.ndarray,
+        zero: np.ndarray,
+    ) -> Dict[int, float]:
+        if rows is None:
+            rows = np.arange(len(scores))
+        candidates = scores[rows]
+        keep = ~zero[rows]
+        if search.max_distance is not None:
+            keep &= 1 - candidates < search.max_distance
+        rows = rows[keep]
+        candidates = candidates[keep]
+        count = min(search.vector_candidates, len(rows))
+        if count < len(rows):
+            top = np.argpartition(-candidates, count - 1)[:count]
+        else:
+            top = np.arange(len(rows))
+        return {int(rows[i]): float(candidates[i]) for i in top}
+
+    def _text_candidates(
+        self, search: SearchQuery, rows: Optional[np.ndarray], size: int
+    ) -> Dict[int, float]:
+        query_trigrams = trigrams(search.query)
+        # ILIKE '%query%' に相当する部分一致（タイトルまたは本文）
+        matched = np.zeros(size, dtype=bool)
+        needle = search.query.lower()
+        for field in _FIELDS:
+            matched[self._substring_rows(field, needle, size)] = True
+        in_category = np.ones(size, dtype=bool)
+        if rows is not None:
+            in_category[:] = False
+            in_category[rows] = True
+        similarity = np.zeros(size, dtype=np.float32)
+        word_similar = np.zeros(size, dtype=bool)
+        for field, weight in (("title", 0.6), ("text", 0.4)):
+            hits = self._trigram_hits(field, query_trigrams, size)
+            counts = self._array(("trigram_counts", field), size)
+            union = counts + len(query_trigrams) - hits
+            similarity += weight * np.divide(
+                hits, union, out=np.zeros(size, dtype=np.float32), where=union > 0
+            )
+            if not query_trigrams:
+                continue
+            # word_similarity はクエリのトライグラムが含まれる割合を超えないため、
+            # それで絞り込んだ行だけ %> と同じ値を計算する
+            bound = hits / len(query_trigrams) >= WORD_SIMILARITY_THRESHOLD
+            values = self._titles if field == "title" else self._texts
+            for row in np.flatnonzero(bound & in_category & ~matched & ~word_similar):
+                word_similar[row] = (
+                    word_similarity(query_trigrams, values[row])
+                    >= WORD_SIMILARITY_THRESHOLD
+                )
+        candidate = (matched | word_similar) & in_category
+        candidate_rows = np.flatnonzero(candidate)
+        text_scores = np.maximum(matched[candidate_rows], similarity[candidate_rows])
+        count = min(search.text_candidates, len(candidate_rows))
+        if count < len(candidate_rows):
+            top = np.argpartition(-text_scores, count - 1)[:count]
+        else:
+            top = np.arange(len(candidate_rows))
+        return {int(candidate_rows[i]): float(text_scores[i]) for i in top}
+
+    def _substring_rows(self, field: str, needle: str, size: int) -> np.ndarray:
+        if not needle:
+            return np.arange(size)
+        with self._lock:
+            haystack = self._haystacks.get(field)
+            if haystack is None:
+                # 全行を区切り文字で連結した1つの文字列に対して str.find で探す
+                values = self._titles if field == "title" else self._texts
+                lowered = [value.lower() for value in values[:size]]
+                starts = np.cumsum([0] + [len(value) + 1 for value in lowered])
+                haystack = ("\0".join(lowered), starts[:-1])
+                self._haystacks[field] = haystack
+        text, starts = haystack
+        rows = []
+        position = text.find(needle)
+        while position != -1:
+            row = int(np.searchsorted(starts, position, side="right")) - 1
+            rows.append(row)
+            # 同じ行の残りは飛ばして次の行から探す
+            position = text.find(
+                needle, starts[row + 1] if row + 1 < len(starts) else len(text)
+            )
+        return np.array([row for row in rows if row < size], dtype=np.intp)
+
+    def _trigram_hits(self, field: str, query_trigrams: Set[str], size: int):
+        hits = np.zeros(size, dtype=np.float32)
+        for trigram in query_trigrams:
+            # 各行のトライグラムは集合なので、転置リストに同じ行は1度しか現れない
+            hits[self._array(("posting", field, trigram), size)] += 1
+        return hits
+
+    def _category_array(
+        self, category: Optional[str], size: int
+    ) -> Optional[np.ndarray]:
+        if category is None:
+            return None
+        return self._array(("category", category), size)
+
+    def _array(self, key: tuple, size: int) -> np.ndarray:
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is None:
+                if key[0] == "category":
+                    values = self._category_rows.get(key[1], [])
+                    dtype = np.intp
+                elif key[0] == "posting":
+                    values = self._postings[key[1]].get(key[2], [])
+                    dtype = np.intp
+                else:
+                    values = self._trigram_counts[key[1]]
+                    dtype = np.float32
+                array = np.array(values, dtype=dtype)
+                self._arrays[key] = array
+        if key[0] == "trigram_counts":
+            return array[:size]
+        return array[array < size]
+
+    def _append_document(
+        self, category: str, title: str, text: str, created_at: datetime
+    ):
+        row = len(self._categories)
+        self._categories.append(category)
+        self._titles.append(title)
+        self._texts.append(text)
+        self._created_at.append(created_at)
+        self._category_rows.setdefault(category, []).append(row)
+        for field, value in (("title", title), ("text", text)):
+            value_trigrams = trigrams(value)
+            self._trigram_counts[field].append(len(value_trigrams))
+            postings = self._postings[field]
+            for trigram in value_trigrams:
+                postings.setdefault(trigram, []).append(row)
+
+    def _reserve(self, count: int):
+        capacity = len(self._embeddings)
+        # メモリマップで読み込んだ読み取り専用の行列も、ここでメモリ上の配列に置き換わる
+        if self._size + count <= capacity and self._embeddings.flags.writeable:
+            return
+        capacity = max(capacity * 2, self._size + count, 1024)
+        embeddings = np.empty((capacity, self.vector_dim), dtype=np.float32)
+        embeddings[: self._size] = self._embeddings[: self._size]
+        zero = np.zeros(capacity, dtype=bool)
+        zero[: self._size] = self._zero[: self._size]
+        self._embeddings = embeddings
+        self._zero = zero
+
+    def _snapshot_path(self) -> Optional[Path]:
+        if self.snapshot_dir is None:
+            return None
+        return Path(self.snapshot_dir) / self.table_name
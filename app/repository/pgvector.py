@@ -1,15 +1,25 @@
+import copy
+import math
+import struct
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
-from functools import lru_cache
-from typing import List, Optional
+from functools import lru_cache, partial
+from typing import Dict, Iterator, List, Literal, Optional, Tuple
 
 import numpy as np
 import psycopg
 from fastapi import Depends
 from pgvector.psycopg import register_vector
 from psycopg import sql
+from psycopg_pool import ConnectionPool
 from pydantic import BaseModel, BeforeValidator, ConfigDict
 from typing_extensions import Annotated
 
+from app.metrics import STAGE_SECONDS
+from app.profiling import active_profile
+from app.repository.fusion import FusionParams, fuse
 from app.settings import Settings, get_settings
 
 
@@ -23,6 +33,121 @@ class InsertVector(BaseModel):
     ]
 
 
+class ChunkBatch(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    # 各チャンクが属する文書の InsertBatch 内での位置
+    documents: List[int]
+    positions: List[int]
+    texts: List[str]
+    embeddings: Annotated[
+        np.ndarray,
+        BeforeValidator(lambda v: np.ascontiguousarray(v, dtype=np.float32)),
+    ]
+
+
+class InsertBatch(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    categories: List[str]
+    titles: List[str]
+    texts: List[str]
+    # (件数, 次元) の行列。float32かつC連続であればコピーせずにそのまま保持する
+    embeddings: Annotated[
+        np.ndarray,
+        BeforeValidator(lambda v: np.ascontiguousarray(v, dtype=np.float32)),
+    ]
+    chunks: Optional[ChunkBatch] = None
+
+    @classmethod
+    def from_items(cls, items: List[InsertVector]) -> "InsertBatch":
+        return cls(
+            categories=[item.category for item in items],
+            titles=[item.title for item in items],
+            texts=[item.text for item in items],
+            embeddings=(
+                np.stack([item.embedding for item in items])
+                if items
+                else np.empty((0, 0), dtype=np.float32)
+            ),
+        )
+
+
+CopyFormat = Literal["binary", "text"]
+
+IndexType = Literal["hnsw", "ivfflat"]
+
+Quantization = Literal["none", "halfvec", "binary"]
+
+ChunkAggregation = Literal["max", "sum"]
+
+DEFAULT_TABLE_NAME = "embeddings"
+
+EMBEDDING_INDEX = "idx_documents_embedding"
+CHUNK_EMBEDDING_INDEX = "idx_document_chunks_embedding"
+
+# pgvectorの hnsw.ef_search の既定値
+DEFAULT_EF_SEARCH = 40
+# pgvectorが受け付ける hnsw.ef_search の上限
+MAX_EF_SEARCH = 1000
+# pgvectorの ivfflat.probes の既定値
+DEFAULT_PROBES = 1
+
+INDEX_NAMES = (
+    EMBEDDING_INDEX,
+    "idx_documents_category_trgm",
+    "idx_documents_title_trgm",
+    "idx_documents_text_trgm",
+    CHUNK_EMBEDDING_INDEX,
+    "idx_document_chunks_document_id",
+)
+
+_AGGREGATES = {"max": sql.SQL("MAX"), "sum": sql.SQL("SUM")}
+
+_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+_COPY_FIELD_COUNT = struct.pack("!h", 4)
+_COPY_BLOCK_SIZE = 1 << 20
+
+
+def _binary_vectors(embeddings: np.ndarray) -> np.ndarray:
+    # pgvectorのバイナリ表現（長さ, 次元, 未使用, ビッグエンディアンfloat4配列）を
+    # 行列全体に対して一括で組み立てる
+    count, dim = embeddings.shape
+    vectors = np.empty(
+        count,
+        dtype=np.dtype(
+            [
+                ("size", ">i4"),
+                ("dim", ">u2"),
+                ("unused", ">u2"),
+                ("values", ">f4", (dim,)),
+            ]
+        ),
+    )
+    vectors["size"] = 4 + 4 * dim
+    vectors["dim"] = dim
+    vectors["unused"] = 0
+    vectors["values"] = embeddings
+    return vectors.view(np.uint8).reshape(count, -1)
+
+
+def _binary_copy_blocks(batch: InsertBatch) -> Iterator[bytearray]:
+    buffer = bytearray(_COPY_SIGNATURE)
+    for category, title, text, vector in zip(
+        batch.categories, batch.titles, batch.texts, _binary_vectors(batch.embeddings)
+    ):
+        buffer += _COPY_FIELD_COUNT
+        for value in (category, title, text):
+            data = value.encode("utf-8")
+            buffer += struct.pack("!i", len(data))
+            buffer += data
+        buffer += vector.data
+        if len(buffer) >= _COPY_BLOCK_SIZE:
+            yield buffer
+            buffer = bytearray()
+    buffer += _COPY_TRAILER
+    yield buffer
+
+
 class VectorRecord(BaseModel):
     id: int
     category: str
@@ -34,41 +159,342 @@ class VectorRecord(BaseModel):
     created_at: datetime
 
 
+class VectorIndexConfig(BaseModel):
+    index_type: IndexType = "hnsw"
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 64
+    # Noneの場合はインデックス作成時の行数から算出する
+    ivfflat_lists: Optional[int] = None
+    # ANNインデックスに格納する表現。halfvec/binary の場合は候補を取得した後、
+    # テーブルのfloat32ベクトルで再スコアリングする
+    quantization: Quantization = "none"
+    # 再スコアリングのために取得する候補数の倍率（vector_candidates に対して）
+    rescore_factor: int = 4
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "VectorIndexConfig":
+        return cls(
+            index_type=settings.vector_index_type,
+            hnsw_m=settings.hnsw_m,
+            hnsw_ef_construction=settings.hnsw_ef_construction,
+            ivfflat_lists=settings.ivfflat_lists,
+            quantization=settings.vector_quantization,
+            rescore_factor=settings.rescore_factor,
+        )
+
+
+class ReindexResult(BaseModel):
+    index_type: IndexType
+    rows: int
+    lists: Optional[int] = None
+    elapsed_seconds: float
+
+
+def ivfflat_lists(rows: int) -> int:
+    # pgvectorの推奨値: 100万行までは rows / 1000、それ以上は sqrt(rows)
+    if rows <= 1_000_000:
+        return max(rows // 1000, 1)
+    return int(math.sqrt(rows))
+
+
+class SearchQuery(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    embedding: Annotated[
+        np.ndarray, BeforeValidator(lambda v: np.asarray(v, dtype=np.float32))
+    ]
+    query: str
+    category: Optional[str] = None
+    limit: int = 10
+    ef_search: Optional[int] = None
+    probes: Optional[int] = None
+    vector_candidates: int = 100
+    text_candidates: int = 100
+    max_distance: Optional[float] = 0.5
+    # 量子化インデックスから取得する再スコアリング前の候補数
+    rescore_candidates: Optional[int] = None
+    fusion: FusionParams = FusionParams()
+    # 指定した場合はチャンク単位でベクトル検索し、文書ごとにスコアを集約する
+    chunk_aggregation: Optional[ChunkAggregation] = None
+    chunk_candidates: int = 300
+
+
+def fuse_rows(
+    rows: List[tuple], fusion: FusionParams, limit: int
+) -> List[VectorRecord]:
+    scores = fuse([row[4] for row in rows], [row[5] for row in rows], fusion)
+    records = [
+        VectorRecord(
+            id=row[0],
+            category=row[1],
+            title=row[2],
+            text=row[3],
+            vector_score=row[4] or 0.0,
+            text_score=row[5] or 0.0,
+            hibrid_score=score,
+            created_at=row[6],
+        )
+        for row, score in zip(rows, scores)
+        if (row[4] or 0.0) + (row[5] or 0.0) > 0
+    ]
+    records.sort(key=lambda record: record.hibrid_score, reverse=True)
+    return records[:limit]
+
+
+class PoolStats(BaseModel):
+    size: int
+    available: int
+    in_use: int
+    waiting: int
+    requests: int
+    wait_ms: int
+    errors: int
+
+
+def _configure_connection(conn: psycopg.Connection):
+    register_vector(conn)
+    conn.commit()
+
+
 class PgVectorRepository:
-    def __init__(self, db_string: str, table_name: str = "embeddings"):
+    def __init__(
+        self,
+        db_string: str,
+        table_name: str = DEFAULT_TABLE_NAME,
+        min_size: int = 1,
+        max_size: int = 10,
+        max_lifetime: float = 3600.0,
+        timeout: float = 30.0,
+        index_config: Optional[VectorIndexConfig] = None,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+    ):
         self.table_name = table_name
-        self.conn = psycopg.connect(db_string)
-        self.conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-        self.conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
-        register_vector(self.conn)
+        self.chunk_table_name = f"{table_name}_chunks"
+        self.index_config = index_config or VectorIndexConfig()
+        self.ef_search = ef_search
+        self.probes = probes
+        self.vector_dim: Optional[int] = None
+        # テーブルの内容が変わるたびに増える世代番号。検索結果キャッシュのキーに使う
+        self.generation = 0
+        self._generation_lock = threading.Lock()
+        # 同じ接続プールを共有する、モデルごとのテーブルのリポジトリ
+        self._tables: Dict[str, "PgVectorRepository"] = {table_name: self}
+        self._tables_lock = threading.Lock()
+        with psycopg.connect(db_string, autocommit=True) as conn:
+            conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+            conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        self.pool = ConnectionPool(
+            db_string,
+            min_size=min_size,
+            max_size=max_size,
+            max_lifetime=max_lifetime,
+            timeout=timeout,
+            configure=_configure_connection,
+            check=ConnectionPool.check_connection,
+            open=True,
+        )
+
+    def close(self):
+        self.pool.close()
+
+    def pool_stats(self) -> PoolStats:
+        stats = self.pool.get_stats()
+        return PoolStats(
+            size=stats.get("pool_size", 0),
+            available=stats.get("pool_available", 0),
+            in_use=stats.get("pool_size", 0) - stats.get("pool_available", 0),
+            waiting=stats.get("requests_waiting", 0),
+            requests=stats.get("requests_num", 0),
+            wait_ms=stats.get("requests_wait_ms", 0),
+            errors=stats.get("connections_errors", 0),
+        )
+
+    def for_table(self, table_name: str, vector_dim: int) -> "PgVectorRepository":
+        with self._tables_lock:
+            repository = self._tables.get(table_name)
+            if repository is None:
+                repository = copy.copy(self)
+                repository.table_name = table_name
+                repository.chunk_table_name = f"{table_name}_chunks"
+                repository.vector_dim = None
+                repository.generation = 0
+                repository._generation_lock = threading.Lock()
+                repository.create_table(vector_dim=vector_dim)
+                self._tables[table_name] = repository
+        return repository
+
+    def _index_name(self, name: str) -> str:
+        # インデックス名はスキーマ内で一意のため、既定以外のテーブルではテーブル名を含める
+        if self.table_name == DEFAULT_TABLE_NAME:
+            return name
+        return name.replace("idx_documents", f"idx_{self.table_name}", 1).replace(
+            "idx_document_chunks", f"idx_{self.table_name}_chunks", 1
+        )
 
     def create_table(self, vector_dim: int = 384):
-        self.conn.execute(f"""
-            CREATE TABLE IF NOT EXISTS {self.table_name} (
-                id SERIAL PRIMARY KEY,
-                category TEXT NOT NULL,
-                title TEXT NOT NULL,
-                text TEXT NOT NULL,
-                embedding VECTOR({vector_dim}) NOT NULL,
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-        """)
-        self.conn.execute(f"""
-            CREATE INDEX IF NOT EXISTS idx_documents_embedding
-            ON {self.table_name} USING ivfflat (embedding vector_cosine_ops);
-        """)
-        self.conn.execute(f"""
-            CREATE INDEX IF NOT EXISTS idx_documents_category_trgm
-            ON {self.table_name} USING gin (category gin_trgm_ops);
-        """)
-        self.conn.execute(f"""
-            CREATE INDEX IF NOT EXISTS idx_documents_title_trgm
-            ON {self.table_name} USING gin (title gin_trgm_ops);
-        """)
-        self.conn.execute(f"""
-            CREATE INDEX IF NOT EXISTS idx_documents_text_trgm
-            ON {self.table_name} USING gin (text gin_trgm_ops);
-        """)
+        self.vector_dim = vector_dim
+        with self.pool.connection() as conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    id SERIAL PRIMARY KEY,
+                    category TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    embedding VECTOR({vector_dim}) NOT NULL,
+                    created_at TIMESTAMPTZ DEFAULT NOW()
+                );
+            """)
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.chunk_table_name} (
+                    id SERIAL PRIMARY KEY,
+                    document_id INTEGER NOT NULL
+                        REFERENCES {self.table_name} (id) ON DELETE CASCADE,
+                    position INTEGER NOT NULL,
+                    category TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    embedding VECTOR({vector_dim}) NOT NULL
+                );
+            """)
+        self.create_indexes()
+
+    def create_indexes(self):
+        with self.pool.connection() as conn:
+            self._load_vector_dim(conn)
+            for index_name, table_name in self._embedding_indexes():
+                if self.index_config.index_type == "hnsw":
+                    conn.execute(self._embedding_index_sql(index_name, table_name, 0))
+                else:
+                    # IVFFlatのセントロイドは作成時点の行から学習されるため、
+                    # 空のテーブルには作成せずデータ投入後の reindex に任せる
+                    rows = self._count(conn, table_name)
+                    if rows > 0:
+                        conn.execute(
+                            self._embedding_index_sql(index_name, table_name, rows)
+                        )
+            conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self._index_name("idx_documents_category_trgm")}
+                ON {self.table_name} USING gin (category gin_trgm_ops);
+            """)
+            conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self._index_name("idx_documents_title_trgm")}
+                ON {self.table_name} USING gin (title gin_trgm_ops);
+            """)
+            conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self._index_name("idx_documents_text_trgm")}
+                ON {self.table_name} USING gin (text gin_trgm_ops);
+            """)
+            conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS {self._index_name("idx_document_chunks_document_id")}
+                ON {self.chunk_table_name} (document_id);
+            """)
+
+    def drop_indexes(self):
+        with self.pool.connection() as conn:
+            for index_name in INDEX_NAMES:
+                conn.execute(
+                    sql.SQL("DROP INDEX IF EXISTS {};").format(
+                        sql.Identifier(self._index_name(index_name))
+                    )
+                )
+
+    def reindex(self) -> ReindexResult:
+        started = time.perf_counter()
+        with self.pool.connection() as conn:
+            self._load_vector_dim(conn)
+            rows = self._count(conn, self.table_name)
+            conn.commit()
+            lists = None
+            if self.index_config.index_type == "ivfflat":
+                lists = self.index_config.ivfflat_lists or ivfflat_lists(rows)
+            for index_name, table_name in self._embedding_indexes():
+                self._rebuild_index(conn, index_name, table_name)
+        # 量子化や演算子クラスが変わると検索結果も変わるため、キャッシュの世代を進める
+        self._bump_generation()
+        return ReindexResult(
+            index_type=self.index_config.index_type,
+            rows=rows,
+            lists=lists,
+            elapsed_seconds=time.perf_counter() - started,
+        )
+
+    def _embedding_indexes(self) -> List[Tuple[str, str]]:
+        return [
+            (self._index_name(EMBEDDING_INDEX), self.table_name),
+            (self._index_name(CHUNK_EMBEDDING_INDEX), self.chunk_table_name),
+        ]
+
+    def _rebuild_index(self, conn: psycopg.Connection, index_name: str, table: str):
+        building = f"{index_name}_new"
+        rows = self._count(conn, table)
+        conn.commit()
+        if self.index_config.index_type == "ivfflat" and rows == 0:
+            return
+        # 検索を止めないよう別名でCONCURRENTLYに作成してから差し替える
+        conn.autocommit = True
+        try:
+            conn.execute(
+                sql.SQL("DROP INDEX IF EXISTS {};").format(sql.Identifier(building))
+            )
+            conn.execute(
+                self._embedding_index_sql(building, table, rows, concurrently=True)
+            )
+        finally:
+            conn.autocommit = False
+        with conn.transaction():
+            conn.execute(
+                sql.SQL("DROP INDEX IF EXISTS {};").format(sql.Identifier(index_name))
+            )
+            conn.execute(
+                sql.SQL("ALTER INDEX {} RENAME TO {};").format(
+                    sql.Identifier(building), sql.Identifier(index_name)
+                )
+            )
+        conn.execute(sql.SQL("ANALYZE {};").format(sql.Identifier(table)))
+
+    def _load_vector_dim(self, conn: psycopg.Connection):
+        # 量子化したインデックス・検索式のキャストに次元数が必要になる
+        if self.vector_dim is None:
+            self.vector_dim = conn.execute(
+                "SELECT atttypmod FROM pg_attribute "
+                "WHERE attrelid = %s::regclass AND attname = 'embedding';",
+                (self.table_name,),
+            ).fetchone()[0]
+
+    def _count(self, conn: psycopg.Connection, table: str) -> int:
+        return conn.execute(
+            sql.SQL("SELECT COUNT(*) FROM {};").format(sql.Identifier(table))
+        ).fetchone()[0]
+
+    def _embedding_index_sql(
+        self, index_name: str, table: str, rows: int, concurrently: bool = False
+    ) -> sql.Composed:
+        config = self.index_config
+        if config.quantization == "halfvec":
+            operand = sql.SQL("((embedding::halfvec({})) halfvec_cosine_ops)").format(
+                sql.Literal(self.vector_dim)
+            )
+        elif config.quantization == "binary":
+            operand = sql.SQL(
+                "((binary_quantize(embedding)::bit({})) bit_hamming_ops)"
+            ).format(sql.Literal(self.vector_dim))
+        else:
+            operand = sql.SQL("(embedding vector_cosine_ops)")
+        if config.index_type == "hnsw":
+            method = sql.SQL("hnsw {} WITH (m = {}, ef_construction = {})").format(
+                operand,
+                sql.Literal(config.hnsw_m),
+                sql.Literal(config.hnsw_ef_construction),
+            )
+        else:
+            method = sql.SQL("ivfflat {} WITH (lists = {})").format(
+                operand, sql.Literal(config.ivfflat_lists or ivfflat_lists(rows))
+            )
+        return sql.SQL("CREATE INDEX {} IF NOT EXISTS {} ON {} USING {};").format(
+            sql.SQL("CONCURRENTLY" if concurrently else ""),
+            sql.Identifier(index_name),
+            sql.Identifier(table),
+            method,
+        )
 
     def hybrid_search(
         self,
@@ -76,121 +502,416 @@ class PgVectorRepository:
         query: str,
         category: Optional[str] = None,
         limit: int = 10,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+        vector_candidates: int = 100,
+        text_candidates: int = 100,
+        max_distance: Optional[float] = 0.5,
+        rescore_candidates: Optional[int] = None,
+        fusion: Optional[FusionParams] = None,
+        chunk_aggregation: Optional[ChunkAggregation] = None,
+        chunk_candidates: int = 300,
     ) -> List[VectorRecord]:
-        with self.conn.cursor() as cur:
-            sql_query = sql.SQL("""
-                WITH vector_search AS (
-                    SELECT
-                        id,
-                        category,
-                        title,
-                        text,
-                        created_at,
-                        1 - (embedding <=> %s::vector) as vector_score
-                    FROM {}
-                    WHERE embedding <=> %s::vector < 0.5
-                    AND (%s::text IS NULL OR category = %s)
-                    ORDER BY embedding <=> %s::vector
-                    LIMIT 100
-                ),
-                text_search AS (
-                    SELECT
-                        id,
-                        category,
-                        title,
-                        text,
-                        created_at,
-                        GREATEST(
-                            -- 完全一致の場合は高いスコア
-                            CASE
-                                WHEN title ILIKE '%%' || %s || '%%' THEN 1.0
-                                WHEN text ILIKE '%%' || %s || '%%' THEN 1.0
-                                ELSE 0.0
-                            END,
-                            -- pg_trgmの類似度も使用（fallback）
-                            (
-                                similarity(title, %s) * 0.6 +
-                                similarity(text, %s) * 0.4
-                            )
-                        ) as text_score
-                    FROM {}
-                    WHERE (%s::text IS NULL OR category = %s)
+        return self.hybrid_search_batch(
+            [
+                SearchQuery(
+                    embedding=embedding,
+                    query=query,
+                    category=category,
+                    limit=limit,
+                    ef_search=ef_search,
+                    probes=probes,
+                    vector_candidates=vector_candidates,
+                    text_candidates=text_candidates,
+                    max_distance=max_distance,
+                    rescore_candidates=rescore_candidates,
+                    fusion=fusion or FusionParams(),
+                    chunk_aggregation=chunk_aggregation,
+                    chunk_candidates=chunk_candidates,
                 )
-                SELECT
-                    COALESCE(v.id, t.id) as id,
-                    COALESCE(v.category, t.category) as category,
-                    COALESCE(v.title, t.title) as title,
-                    COALESCE(v.text, t.text) as text,
-                    COALESCE(v.vector_score, 0) as vector_score,
-                    COALESCE(t.text_score, 0) as text_score,
-                    (
-                        COALESCE(v.vector_score, 0) * 0.7 +
-                        COALESCE(t.text_score, 0) * 0.3
-                    ) as hybrid_score,
-                    COALESCE(v.created_at, t.created_at) as created_at
-                FROM vector_search v
-                FULL OUTER JOIN text_search t ON v.id = t.id
-                WHERE (COALESCE(v.vector_score, 0) + COALESCE(t.text_score, 0)) > 0
-                ORDER BY hybrid_score DESC
-                LIMIT %s;
-            """).format(
-                sql.Identifier(self.table_name), sql.Identifier(self.table_name)
+            ]
+        )[0]
+
+    def hybrid_search_batch(
+        self, queries: List[SearchQuery]
+    ) -> List[List[VectorRecord]]:
+        if not queries:
+            return []
+        with self._connection() as conn:
+            self._load_vector_dim(conn)
+            started = time.perf_counter()
+            # 1つの接続上でパイプライン実行し、全クエリ分の往復を1回にまとめる
+            cursors: List[psycopg.Cursor] = []
+            with conn.pipeline():
+                for search in queries:
+                    cur = conn.cursor()
+                    self._set_search_params(cur, search)
+                    cur.execute(*self._hybrid_search_query(search))
+                    cursors.append(cur)
+            rows = []
+            for cur in cursors:
+                rows.append(cur.fetchall())
+                cur.close()
+            STAGE_SECONDS.observe(time.perf_counter() - started, "db_query")
+        profile = active_profile()
+        if profile is not None:
+            # プロファイル対象のリクエストに限り、同じクエリの実行計画を後で取得する
+            profile.explains.extend(
+                partial(self.explain_hybrid_search, search, analyze=True)
+                for search in queries
             )
+        with STAGE_SECONDS.time("fusion"):
+            return [
+                fuse_rows(result, search.fusion, search.limit)
+                for result, search in zip(rows, queries)
+            ]
+
+    def vector_search_batch(
+        self, queries: List[SearchQuery]
+    ) -> List[List[Tuple[int, float]]]:
+        # ハイブリッド検索のベクトル側の候補 (id, スコア) だけを返す。再現率の評価に使う
+        if not queries:
+            return []
+        with self._connection() as conn:
+            self._load_vector_dim(conn)
+            cursors: List[psycopg.Cursor] = []
+            with conn.pipeline():
+                for search in queries:
+                    cur = conn.cursor()
+                    self._set_search_params(cur, search)
+                    cur.execute(
+                        sql.SQL("SELECT id, vector_score FROM ({}) v").format(
+                            self._vector_search_query(search)
+                        ),
+                        self._search_params(search),
+                    )
+                    cursors.append(cur)
+            results = []
+            for cur in cursors:
+                results.append([(row[0], row[1]) for row in cur.fetchall()])
+                cur.close()
+        return results
 
+    def explain_hybrid_search(self, search: SearchQuery, analyze: bool = False) -> str:
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            self._load_vector_dim(conn)
+            self._set_search_params(cur, search)
+            sql_query, params = self._hybrid_search_query(search)
             cur.execute(
-                query=sql_query,
-                params=(
-                    embedding,
-                    embedding,
-                    category,
-                    category,
-                    embedding,
-                    query,
-                    query,
-                    query,
-                    query,
-                    category,
-                    category,
-                    limit,
+                sql.SQL("EXPLAIN (ANALYZE {}, BUFFERS {}) {}").format(
+                    sql.SQL("true" if analyze else "false"),
+                    sql.SQL("true" if analyze else "false"),
+                    sql_query,
                 ),
+                params,
             )
+            return "\n".join(row[0] for row in cur.fetchall())
 
-            return [
-                VectorRecord(
-                    id=row[0],
-                    category=row[1],
-                    title=row[2],
-                    text=row[3],
-                    vector_score=row[4],
-                    text_score=row[5],
-                    hibrid_score=row[6],
-                    created_at=row[7],
+    @contextmanager
+    def _connection(self) -> Iterator[psycopg.Connection]:
+        started = time.perf_counter()
+        with self.pool.connection() as conn:
+            STAGE_SECONDS.observe(time.perf_counter() - started, "db_pool_wait")
+            yield conn
+
+    def _ann_candidates(self, search: SearchQuery) -> int:
+        candidates = (
+            search.vector_candidates
+            if search.chunk_aggregation is None
+            else search.chunk_candidates
+        )
+        if self.index_config.quantization == "none":
+            return candidates
+        return search.rescore_candidates or (
+            candidates * self.index_config.rescore_factor
+        )
+
+    def _set_search_params(self, cur: psycopg.Cursor, search: SearchQuery):
+        # トランザクション内でのみ有効な設定として、リクエストごとに探索幅を変える。
+        # 同じトランザクションで続くクエリに値が残らないよう、毎回両方を設定する
+        ef_search = search.ef_search or self.ef_search or DEFAULT_EF_SEARCH
+        if self.index_config.index_type == "hnsw":
+            # HNSWは ef_search 件までしか返さないため、候補数に満たない場合は引き上げる
+            ef_search = min(max(ef_search, self._ann_candidates(search)), MAX_EF_SEARCH)
+        cur.execute(
+            "SELECT set_config('hnsw.ef_search', %s, true), "
+            "set_config('ivfflat.probes', %s, true);",
+            (str(ef_search), str(search.probes or self.probes or DEFAULT_PROBES)),
+        )
+
+    def _nearest_query(
+        self, table: str, columns: sql.Composable, limit: str
+    ) -> sql.Composed:
+        quantization = self.index_config.quantization
+        if quantization == "none":
+            return sql.SQL("""
+                SELECT
+                    {columns},
+                    1 - (embedding <=> %(embedding)s::vector) as vector_score
+                FROM {table}
+                WHERE (
+                    %(max_distance)s::float8 IS NULL
+                    OR embedding <=> %(embedding)s::vector < %(max_distance)s
                 )
-                for row in cur.fetchall()
-            ]
+                AND (%(category)s::text IS NULL OR category = %(category)s)
+                ORDER BY embedding <=> %(embedding)s::vector
+                LIMIT {limit}
+            """).format(
+                columns=columns,
+                table=sql.Identifier(table),
+                limit=sql.Placeholder(limit),
+            )
+        # 量子化したインデックスで多めに候補を取得し、float32のベクトルで並べ直す
+        if quantization == "halfvec":
+            ann_distance = sql.SQL(
+                "embedding::halfvec({dim}) <=> %(embedding)s::vector::halfvec({dim})"
+            ).format(dim=sql.Literal(self.vector_dim))
+        else:
+            ann_distance = sql.SQL(
+                "binary_quantize(embedding)::bit({dim}) "
+                "<~> binary_quantize(%(embedding)s::vector)::bit({dim})"
+            ).format(dim=sql.Literal(self.vector_dim))
+        return sql.SQL("""
+            SELECT
+                {columns},
+                1 - (embedding <=> %(embedding)s::vector) as vector_score
+            FROM (
+                SELECT *
+                FROM {table}
+                WHERE %(category)s::text IS NULL OR category = %(category)s
+                ORDER BY {ann_distance}
+                LIMIT %(ann_candidates)s
+            ) candidates
+            WHERE (
+                %(max_distance)s::float8 IS NULL
+                OR embedding <=> %(embedding)s::vector < %(max_distance)s
+            )
+            ORDER BY embedding <=> %(embedding)s::vector
+            LIMIT {limit}
+        """).format(
+            columns=columns,
+            table=sql.Identifier(table),
+            ann_distance=ann_distance,
+            limit=sql.Placeholder(limit),
+        )
 
-    def copy(self, items: List[InsertVector]):
-        with self.conn.cursor() as cur:
-            with cur.copy(f"""
-                COPY {self.table_name} (
+    def _vector_search_query(self, search: SearchQuery) -> sql.Composed:
+        if search.chunk_aggregation is None:
+            return self._nearest_query(
+                self.table_name,
+                sql.SQL("id, category, title, text, created_at"),
+                "vector_candidates",
+            )
+        # 近傍のチャンクを取得し、親の文書ごとにスコアを集約する
+        return sql.SQL("""
+            SELECT
+                d.id,
+                d.category,
+                d.title,
+                d.text,
+                d.created_at,
+                {aggregate}(c.vector_score) as vector_score
+            FROM ({chunks}) c
+            JOIN {table} d ON d.id = c.document_id
+            GROUP BY d.id
+            ORDER BY vector_score DESC
+            LIMIT %(vector_candidates)s
+        """).format(
+            aggregate=_AGGREGATES[search.chunk_aggregation],
+            chunks=self._nearest_query(
+                self.chunk_table_name, sql.SQL("document_id"), "chunk_candidates"
+            ),
+            table=sql.Identifier(self.table_name),
+        )
+
+    def _hybrid_search_query(self, search: SearchQuery) -> Tuple[sql.Composed, dict]:
+        # ベクトル検索・テキスト検索それぞれで上位の候補に絞り、
+        # 和集合のスコアをアプリケーション側で統合する
+        sql_query = sql.SQL("""
+            WITH vector_search AS (
+                {vector_search}
+            ),
+            text_search AS (
+                SELECT
+                    id,
                     category,
                     title,
                     text,
-                    embedding
+                    created_at,
+                    GREATEST(
+                        -- 完全一致の場合は高いスコア
+                        CASE
+                            WHEN title ILIKE '%%' || %(query)s || '%%' THEN 1.0
+                            WHEN text ILIKE '%%' || %(query)s || '%%' THEN 1.0
+                            ELSE 0.0
+                        END,
+                        -- pg_trgmの類似度も使用（fallback）
+                        (
+                            similarity(title, %(query)s) * 0.6 +
+                            similarity(text, %(query)s) * 0.4
+                        )
+                    ) as text_score
+                FROM {table}
+                -- いずれの条件もトライグラムのGINインデックスで絞り込める
+                WHERE (
+                    title ILIKE '%%' || %(query)s || '%%'
+                    OR text ILIKE '%%' || %(query)s || '%%'
+                    OR title %%> %(query)s
+                    OR text %%> %(query)s
                 )
-                FROM STDIN;
-            """) as copy:
-                for item in items:
-                    copy.write_row(
-                        (item.category, item.title, item.text, item.embedding)
+                AND (%(category)s::text IS NULL OR category = %(category)s)
+                ORDER BY text_score DESC
+                LIMIT %(text_candidates)s
+            )
+            SELECT
+                COALESCE(v.id, t.id) as id,
+                COALESCE(v.category, t.category) as category,
+                COALESCE(v.title, t.title) as title,
+                COALESCE(v.text, t.text) as text,
+                v.vector_score,
+                t.text_score,
+                COALESCE(v.created_at, t.created_at) as created_at
+            FROM vector_search v
+            FULL OUTER JOIN text_search t ON v.id = t.id;
+        """).format(
+            vector_search=self._vector_search_query(search),
+            table=sql.Identifier(self.table_name),
+        )
+        return sql_query, self._search_params(search)
+
+    def _search_params(self, search: SearchQuery) -> dict:
+        return {
+            "embedding": search.embedding,
+            "query": search.query,
+            "category": search.category,
+            "max_distance": search.max_distance,
+            "vector_candidates": search.vector_candidates,
+            "chunk_candidates": search.chunk_candidates,
+            "ann_candidates": self._ann_candidates(search),
+            "text_candidates": search.text_candidates,
+        }
+
+    def copy(self, items: List[InsertVector]):
+        self.copy_batch(InsertBatch.from_items(items))
+
+    def copy_batch(self, batch: InsertBatch, copy_format: CopyFormat = "binary"):
+        if not batch.categories:
+            return
+        with self._connection() as conn, conn.cursor() as cur:
+            if batch.chunks is not None:
+                self._copy_chunked(cur, batch)
+            elif copy_format == "binary":
+                with cur.copy(f"""
+                    COPY {self.table_name} (
+                        category,
+                        title,
+                        text,
+                        embedding
                     )
-            self.conn.commit()
+                    FROM STDIN WITH (FORMAT BINARY);
+                """) as copy:
+                    for block in _binary_copy_blocks(batch):
+                        copy.write(block)
+            else:
+                with cur.copy(f"""
+                    COPY {self.table_name} (
+                        category,
+                        title,
+                        text,
+                        embedding
+                    )
+                    FROM STDIN;
+                """) as copy:
+                    for row in zip(
+                        batch.categories, batch.titles, batch.texts, batch.embeddings
+                    ):
+                        copy.write_row(row)
+        # コミット後に世代を進め、それ以前の検索結果をキャッシュから参照されないようにする
+        self._bump_generation()
+
+    def _copy_chunked(self, cur: psycopg.Cursor, batch: InsertBatch):
+        # チャンクから親の文書を参照するため、先にシーケンスからIDを確保してから
+        # 文書とチャンクを同じトランザクションでCOPYする
+        cur.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s);",
+            (self.table_name, len(batch.categories)),
+        )
+        ids = sorted(row[0] for row in cur.fetchall())
+        with cur.copy(f"""
+            COPY {self.table_name} (
+                id,
+                category,
+                title,
+                text,
+                embedding
+            )
+            FROM STDIN;
+        """) as copy:
+            for row in zip(
+                ids, batch.categories, batch.titles, batch.texts, batch.embeddings
+            ):
+                copy.write_row(row)
+        chunks = batch.chunks
+        with cur.copy(f"""
+            COPY {self.chunk_table_name} (
+                document_id,
+                position,
+                category,
+                text,
+                embedding
+            )
+            FROM STDIN;
+        """) as copy:
+            for document, position, text, embedding in zip(
+                chunks.documents, chunks.positions, chunks.texts, chunks.embeddings
+            ):
+                copy.write_row(
+                    (
+                        ids[document],
+                        position,
+                        batch.categories[document],
+                        text,
+                        embedding,
+                    )
+                )
+
+    def _bump_generation(self):
+        with self._generation_lock:
+            self.generation += 1
 
 
 @lru_cache(maxsize=1)
 def get_pgvector_repository(
     settings: Annotated[Settings, Depends(get_settings)],
 ) -> PgVectorRepository:
-    repo = PgVectorRepository(settings.connection_string)
-    repo.create_table()
+    if settings.search_backend == "memory":
+        from app.repository.memory import InMemoryVectorRepository
+
+        return InMemoryVectorRepository.load(
+            settings.memory_snapshot_dir,
+            settings.vector_dimension,
+            table_name=settings.table_name,
+        )
+    repo = PgVectorRepository(
+        settings.connection_string,
+        table_name=settings.table_name,
+        min_size=settings.db_pool_min_size,
+        max_size=settings.db_pool_max_size,
+        max_lifetime=settings.db_pool_max_lifetime,
+        timeout=settings.db_pool_timeout,
+        index_config=VectorIndexConfig.from_settings(settings),
+        ef_search=settings.hnsw_ef_search,
+        probes=settings.ivfflat_probes,
+    )
+    repo.create_table(vector_dim=settings.vector_dimension)
     return repo
+
+
+def get_pool_stats(
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> Optional[PoolStats]:
+    # /metrics の取得でプールを開いたりテーブルを作成したりしないよう、作成済みの場合だけ返す
+    if get_pgvector_repository.cache_info().currsize == 0:
+        return None
+    return get_pgvector_repository(settings).pool_stats()
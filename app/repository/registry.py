@@ -0,0 +1,145 @@
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Annotated, Callable, List, Optional, Sequence, Tuple
+
+from fastapi import Depends
+from pydantic import BaseModel
+
+from app.repository.batcher import (
+    EmbeddingBatcher,
+    build_embedding_batcher,
+    get_embedding_batcher,
+)
+from app.repository.sentence_transformer import build_sentence_transformer_repository
+from app.settings import Settings, get_settings
+
+
+class UnknownModelError(Exception):
+    pass
+
+
+class LoadedModel(BaseModel):
+    model_name: str
+    bytes: int
+    default: bool
+
+
+class ModelRegistryStats(BaseModel):
+    models: List[LoadedModel]
+    bytes: int
+    max_bytes: int
+    loads: int
+    evictions: int
+
+
+def model_table_name(model_name: str) -> str:
+    # 例: intfloat/multilingual-e5-large -> embeddings_multilingual_e5_large
+    slug = re.sub(r"[^0-9a-z]+", "_", model_name.rsplit("/", 1)[-1].lower())
+    return f"embeddings_{slug.strip('_')}"
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        default_model: str,
+        default: EmbeddingBatcher,
+        factory: Callable[[str], EmbeddingBatcher],
+        model_names: Sequence[str],
+        max_bytes: int,
+    ):
+        self.default_model = default_model
+        self.default = default
+        self.model_names = list(model_names)
+        self.max_bytes = max_bytes
+        self._factory = factory
+        # 既定のモデルは常に読み込んだままにし、それ以外をLRUで管理する
+        self._entries: OrderedDict[str, Tuple[EmbeddingBatcher, int]] = OrderedDict()
+        self._bytes = 0
+        self._loads = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+        # 同じモデルを並行して二重に読み込まないよう、読み込みは直列に行う
+        self._load_lock = threading.Lock()
+
+    def is_default(self, model_name: Optional[str]) -> bool:
+        return model_name is None or model_name == self.default_model
+
+    def get(self, model_name: Optional[str]) -> EmbeddingBatcher:
+        if self.is_default(model_name):
+            return self.default
+        if model_name not in self.model_names:
+            raise UnknownModelError(f"model is not served: {model_name}")
+        batcher = self._lookup(model_name)
+        if batcher is not None:
+            return batcher
+        with self._load_lock:
+            batcher = self._lookup(model_name)
+            if batcher is not None:
+                return batcher
+            batcher = self._factory(model_name)
+            size = batcher.repository.memory_bytes()
+            with self._lock:
+                self._entries[model_name] = (batcher, size)
+                self._bytes += size
+                self._loads += 1
+                evicted = self._evict()
+        for old in evicted:
+            old.close()
+        return batcher
+
+    def stats(self) -> ModelRegistryStats:
+        with self._lock:
+            models = [
+                LoadedModel(model_name=model_name, bytes=size, default=False)
+                for model_name, (_, size) in self._entries.items()
+            ]
+            return ModelRegistryStats(
+                models=[
+                    LoadedModel(
+                        model_name=self.default_model,
+                        bytes=self.default.repository.memory_bytes(),
+                        default=True,
+                    ),
+                    *models,
+                ],
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+                loads=self._loads,
+                evictions=self._evictions,
+            )
+
+    def _lookup(self, model_name: str) -> Optional[EmbeddingBatcher]:
+        with self._lock:
+            entry = self._entries.get(model_name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(model_name)
+            return entry[0]
+
+    def _evict(self) -> List[EmbeddingBatcher]:
+        # 読み込んだばかりのモデルは上限を超えていても残す
+        evicted = []
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, (batcher, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._evictions += 1
+            evicted.append(batcher)
+        return evicted
+
+
+@lru_cache(maxsize=1)
+def get_model_registry(
+    settings: Annotated[Settings, Depends(get_settings)],
+    batcher: Annotated[EmbeddingBatcher, Depends(get_embedding_batcher)],
+) -> ModelRegistry:
+    return ModelRegistry(
+        settings.sentence_transformer_model,
+        batcher,
+        factory=lambda model_name: build_embedding_batcher(
+            settings, build_sentence_transformer_repository(settings, model_name)
+        ),
+        model_names=settings.model_names,
+        max_bytes=settings.model_memory_budget_bytes,
+    )
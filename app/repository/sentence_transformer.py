@@ -1,28 +1,303 @@
 from functools import lru_cache
-from typing import Annotated, Tuple
+from itertools import chain
+from pathlib import Path
+from typing import Annotated, Any, Dict, List, Literal, Optional, Sequence, Tuple
 
 import numpy as np
+import torch
 from fastapi import Depends
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import (
+    SentenceTransformer,
+    export_dynamic_quantized_onnx_model,
+)
 
+from app.metrics import STAGE_SECONDS
+from app.repository.cache import EmbeddingCache
+from app.repository.disk_cache import DiskEmbeddingCache
 from app.settings import Settings, get_settings
 
+Backend = Literal["torch", "onnx", "onnx-int8"]
+QuantizationConfig = Literal["arm64", "avx2", "avx512", "avx512_vnni"]
+
+
+def onnx_model_file(
+    model_name: str,
+    backend: Backend,
+    export_dir: str = ".onnx",
+    quantization_config: QuantizationConfig = "avx512_vnni",
+) -> Path:
+    path = Path(export_dir) / model_name.replace("/", "__")
+    if backend == "onnx":
+        return path / "onnx" / "model.onnx"
+    return path / "onnx" / f"model_qint8_{quantization_config}.onnx"
+
+
+def onnx_model_kwargs(num_threads: Optional[int]) -> Dict[str, Any]:
+    if num_threads is None:
+        return {}
+    # ONNX Runtimeは torch.set_num_threads の影響を受けないため、セッションで指定する
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    return {"session_options": options}
+
+
+def load_model(
+    model_name: str,
+    backend: Backend = "torch",
+    export_dir: str = ".onnx",
+    quantization_config: QuantizationConfig = "avx512_vnni",
+    num_threads: Optional[int] = None,
+) -> SentenceTransformer:
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    # ONNXへの変換結果はモデルごとのディレクトリに保存し、次回以降の起動で再利用する
+    path = Path(export_dir) / model_name.replace("/", "__")
+    if not onnx_model_file(model_name, "onnx", export_dir).exists():
+        SentenceTransformer(model_name, backend="onnx").save_pretrained(str(path))
+    model_kwargs = onnx_model_kwargs(num_threads)
+    if backend == "onnx":
+        if model_kwargs:
+            return SentenceTransformer(
+                str(path), backend="onnx", model_kwargs=model_kwargs
+            )
+        return SentenceTransformer(str(path), backend="onnx")
+    file_name = f"onnx/model_qint8_{quantization_config}.onnx"
+    if not onnx_model_file(
+        model_name, backend, export_dir, quantization_config
+    ).exists():
+        export_dynamic_quantized_onnx_model(
+            SentenceTransformer(str(path), backend="onnx"),
+            quantization_config,
+            str(path),
+        )
+    return SentenceTransformer(
+        str(path),
+        backend="onnx",
+        model_kwargs={"file_name": file_name, **model_kwargs},
+    )
+
+
+def truncate_embeddings(embeddings: np.ndarray, dimension: Optional[int]) -> np.ndarray:
+    # Matryoshka表現: 先頭 dimension 次元を切り出し、L2ノルムが1になるよう正規化し直す
+    if dimension is None or dimension >= embeddings.shape[-1]:
+        return embeddings
+    truncated = embeddings[..., :dimension]
+    norms = np.linalg.norm(truncated, axis=-1, keepdims=True)
+    return (truncated / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+
+def mean_embeddings(
+    embeddings: np.ndarray, groups: Sequence[int], count: int
+) -> np.ndarray:
+    # チャンクのベクトルをグループ（文書）ごとに平均し、L2ノルムが1になるよう正規化する
+    pooled = np.zeros((count, embeddings.shape[-1]), dtype=np.float32)
+    np.add.at(pooled, np.asarray(groups, dtype=np.intp), embeddings)
+    norms = np.linalg.norm(pooled, axis=-1, keepdims=True)
+    return (pooled / np.where(norms == 0, 1, norms)).astype(np.float32)
+
+
+def chunk_spans(
+    offsets: Sequence[Tuple[int, int]], max_tokens: int, overlap: int = 0
+) -> List[Tuple[int, int]]:
+    # トークンの文字位置から、max_tokens トークンずつ overlap だけ重ねた窓の文字範囲を求める
+    if not offsets:
+        return [(0, 0)]
+    max_tokens = max(max_tokens, 1)
+    # 重なりが窓に近いと1トークンずつしか進まず、チャンク数がトークン数ほどに増えるため、
+    # 重なりは窓の半分までにする
+    step = max_tokens - min(max(overlap, 0), max_tokens // 2)
+    spans = []
+    for start in range(0, len(offsets), step):
+        window = offsets[start : start + max_tokens]
+        spans.append((window[0][0], window[-1][1]))
+        if start + max_tokens >= len(offsets):
+            break
+    return spans
+
+
+def token_budget_batches(
+    lengths: Sequence[int], max_tokens: int, max_items: Optional[int] = None
+) -> List[List[int]]:
+    # 長さの降順に並べ、パディング後のトークン数 (件数 x 最長) が予算に収まる範囲でまとめる
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    longest = 0
+    for i in order:
+        if batch and (
+            (len(batch) + 1) * longest > max_tokens
+            or (max_items is not None and len(batch) >= max_items)
+        ):
+            batches.append(batch)
+            batch = []
+        if not batch:
+            longest = max(lengths[i], 1)
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
 
 class SentenceTransformerRepository:
-    def __init__(self, model_name: str):
-        self.model = SentenceTransformer(model_name)
+    def __init__(
+        self,
+        model_name: str,
+        num_threads: Optional[int] = None,
+        cache: Optional[EmbeddingCache] = None,
+        batch_size: int = 32,
+        backend: Backend = "torch",
+        export_dir: str = ".onnx",
+        quantization_config: QuantizationConfig = "avx512_vnni",
+        max_batch_tokens: Optional[int] = None,
+    ):
+        if num_threads is not None:
+            # ONNXバックエンドでは load_model でONNX Runtimeのスレッド数も指定する
+            torch.set_num_threads(num_threads)
+        self.model_name = model_name
+        self.backend = backend
+        self.model = load_model(
+            model_name, backend, export_dir, quantization_config, num_threads
+        )
+        self.model_file: Optional[Path] = None
+        if backend != "torch":
+            self.model_file = onnx_model_file(
+                model_name, backend, export_dir, quantization_config
+            )
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+
+    def memory_bytes(self) -> int:
+        # PyTorchはパラメータとバッファの合計、ONNXは読み込んだモデルファイルの大きさで概算する
+        if self.model_file is not None:
+            return self.model_file.stat().st_size
+        return sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in chain(self.model.parameters(), self.model.buffers())
+        )
 
-    @lru_cache
     def encode_text(self, text: str) -> np.ndarray:
-        return self.model.encode(text)
+        return self.encode_texts([text])[0]
+
+    def encode_texts(self, texts: Sequence[str]) -> np.ndarray:
+        if self.cache is None:
+            return self._encode(list(texts))
+        embeddings = self.cache.get_many(texts)
+        missing = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+        if missing:
+            computed = self._encode(missing)
+            self.cache.put_many(missing, computed)
+            rows = dict(zip(missing, computed))
+            embeddings = [
+                rows[t] if e is None else e for t, e in zip(texts, embeddings)
+            ]
+        if not embeddings:
+            return np.empty(
+                (0, self.model.get_sentence_embedding_dimension()), dtype=np.float32
+            )
+        return np.stack(embeddings)
 
-    @lru_cache
-    def encode_texts(self, texts: Tuple[str]) -> np.ndarray:
-        return self.model.encode(list(texts))
+    def _encode(self, texts: Sequence[str]) -> np.ndarray:
+        texts = list(texts)
+        if self.max_batch_tokens is None or len(texts) <= 1:
+            with STAGE_SECONDS.time("inference"):
+                return self.model.encode(texts, batch_size=self.batch_size)
+        with STAGE_SECONDS.time("tokenize"):
+            lengths = self._token_lengths(texts)
+        # 短い文ばかりでも1回の推論の件数は batch_size を超えないようにする
+        batches = token_budget_batches(
+            lengths, self.max_batch_tokens, max_items=self.batch_size
+        )
+        embeddings = np.empty(
+            (len(texts), self.model.get_sentence_embedding_dimension()),
+            dtype=np.float32,
+        )
+        for batch in batches:
+            # 予算内の1グループを1回の推論で処理し、元の順序の位置に書き戻す
+            with STAGE_SECONDS.time("inference"):
+                embeddings[batch] = self.model.encode(
+                    [texts[i] for i in batch], batch_size=len(batch)
+                )
+        return embeddings
+
+    def chunk_texts(
+        self,
+        titles: Sequence[str],
+        texts: Sequence[str],
+        max_tokens: Optional[int] = None,
+        overlap: int = 0,
+    ) -> List[List[str]]:
+        tokenizer = self.model.tokenizer
+        title_lengths = [
+            len(ids)
+            for ids in tokenizer(list(titles), add_special_tokens=False)["input_ids"]
+        ]
+        offsets = tokenizer(
+            list(texts), add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        chunks = []
+        for title_length, text, text_offsets in zip(title_lengths, texts, offsets):
+            # 「タイトル 本文」が切り捨てられないよう、特殊トークンとタイトルの分を除いた
+            # 長さを本文の窓の上限にする。ただしタイトルが長くても窓は入力上限の半分を残す
+            budget = self.model.max_seq_length - tokenizer.num_special_tokens_to_add()
+            window = budget - min(title_length, budget // 2)
+            if max_tokens is not None:
+                window = min(window, max_tokens)
+            chunks.append(
+                [
+                    text[start:end]
+                    for start, end in chunk_spans(text_offsets, window, overlap)
+                ]
+            )
+        return chunks
+
+    def _token_lengths(self, texts: List[str]) -> List[int]:
+        encoded = self.model.tokenizer(
+            texts, truncation=True, max_length=self.model.max_seq_length
+        )
+        return [len(ids) for ids in encoded["input_ids"]]
+
+
+def build_sentence_transformer_repository(
+    settings: Settings, model_name: str
+) -> SentenceTransformerRepository:
+    cache = None
+    if settings.embedding_cache_max_bytes > 0 or settings.embedding_cache_path:
+        # バックエンドごとに出力がわずかに異なるため、キャッシュのキーを分ける
+        cache_model_name = model_name
+        if settings.inference_backend != "torch":
+            cache_model_name = f"{cache_model_name}#{settings.inference_backend}"
+        disk = None
+        if settings.embedding_cache_path:
+            disk = DiskEmbeddingCache(
+                settings.embedding_cache_path,
+                cache_model_name,
+                max_rows=settings.embedding_cache_disk_max_rows,
+                ttl_seconds=settings.embedding_cache_ttl_seconds,
+            )
+        cache = EmbeddingCache(
+            cache_model_name,
+            max_bytes=settings.embedding_cache_max_bytes,
+            ttl_seconds=settings.embedding_cache_ttl_seconds,
+            disk=disk,
+        )
+    return SentenceTransformerRepository(
+        model_name,
+        num_threads=settings.inference_threads,
+        cache=cache,
+        backend=settings.inference_backend,
+        export_dir=settings.onnx_export_dir,
+        quantization_config=settings.onnx_quantization_config,
+        max_batch_tokens=settings.max_batch_tokens,
+    )
 
 
 @lru_cache(maxsize=1)
 def get_sentence_transformer_repository(
     settings: Annotated[Settings, Depends(get_settings)],
 ) -> SentenceTransformerRepository:
-    return SentenceTransformerRepository(settings.sentence_transformer_model)
+    return build_sentence_transformer_repository(
+        settings, settings.sentence_transformer_model
+    )
@@ -0,0 +1,88 @@
+from typing import Annotated, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from app.profiling import (
+    ProfileStore,
+    ProfileSummary,
+    RequestProfile,
+    get_profile_store,
+)
+from app.repository.memory import InMemoryVectorRepository
+from app.repository.pgvector import (
+    PgVectorRepository,
+    ReindexResult,
+    get_pgvector_repository,
+)
+from app.repository.registry import UnknownModelError, model_table_name
+from app.settings import MODEL_DIMENSIONS, Settings, get_settings
+
+router = APIRouter()
+
+
+class SnapshotResponse(BaseModel):
+    rows: int
+    # テーブルごとの保存した件数
+    tables: Dict[str, int]
+
+
+@router.post("/admin/reindex")
+async def reindex(
+    pgvector: Annotated[PgVectorRepository, Depends(get_pgvector_repository)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    model: Optional[str] = None,
+) -> ReindexResult:
+    if isinstance(pgvector, InMemoryVectorRepository):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="the in-memory search backend has no index to rebuild",
+        )
+    if model is not None and model != settings.sentence_transformer_model:
+        # モデルを読み込まずに、そのモデルのテーブルだけを対象にする
+        if model not in settings.model_names:
+            raise UnknownModelError(f"model is not served: {model}")
+        pgvector = await run_in_threadpool(
+            pgvector.for_table, model_table_name(model), MODEL_DIMENSIONS[model]
+        )
+    return await run_in_threadpool(pgvector.reindex)
+
+
+@router.post("/admin/snapshot")
+async def snapshot(
+    pgvector: Annotated[PgVectorRepository, Depends(get_pgvector_repository)],
+) -> SnapshotResponse:
+    if not isinstance(pgvector, InMemoryVectorRepository):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="snapshots are only available with SEARCH_BACKEND=memory",
+        )
+    if pgvector.snapshot_dir is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="MEMORY_SNAPSHOT_DIR is not configured",
+        )
+    tables = await run_in_threadpool(pgvector.snapshot)
+    return SnapshotResponse(rows=sum(tables.values()), tables=tables)
+
+
+@router.get("/admin/profiles")
+async def list_profiles(
+    store: Annotated[ProfileStore, Depends(get_profile_store)],
+) -> List[ProfileSummary]:
+    return store.list()
+
+
+@router.get("/admin/profiles/{profile_id}")
+async def get_profile(
+    profile_id: int,
+    store: Annotated[ProfileStore, Depends(get_profile_store)],
+) -> RequestProfile:
+    profile = store.get(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"profile {profile_id} not found",
+        )
+    return profile
@@ -1,50 +1,178 @@
-from typing import Annotated, List
+import base64
+import io
+from typing import Annotated, List, Literal, Optional, Union
 
-from fastapi import APIRouter, Depends
-from pydantic import BaseModel
+import numpy as np
+from fastapi import APIRouter, Depends, Header, HTTPException, status
+from fastapi.responses import Response
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 
-from app.repository.sentence_transformer import (
-    SentenceTransformerRepository,
-    get_sentence_transformer_repository,
-)
+from app.repository.batcher import EmbeddingBatcher
+from app.repository.registry import ModelRegistry, get_model_registry
+from app.repository.sentence_transformer import truncate_embeddings
+from app.settings import MODEL_DIMENSIONS, Settings, get_settings
+
+OCTET_STREAM = "application/octet-stream"
+NPY = "application/x-npy"
+
+Encoding = Literal["float", "base64"]
+DType = Literal["float32", "float16"]
 
 
 class TextRequest(BaseModel):
     text: str
+    # 省略時はサーバーの既定のモデル
+    model: Optional[str] = None
+    # 指定した場合は先頭の次元だけを切り出して正規化し直す（Matryoshka）
+    dimension: Optional[int] = Field(default=None, ge=1)
+    # JSONで返す場合の表現。base64 はリトルエンディアンの生バイト列をエンコードしたもの
+    encoding: Encoding = "float"
+    dtype: DType = "float32"
 
 
 class TextListRequest(BaseModel):
     texts: List[str]
+    model: Optional[str] = None
+    dimension: Optional[int] = Field(default=None, ge=1)
+    encoding: Encoding = "float"
+    dtype: DType = "float32"
 
 
 class EmbeddingResponse(BaseModel):
-    embedding: List[float]
+    embedding: Union[List[float], str]
 
 
 class EmbeddingListResponse(BaseModel):
-    embeddings: List[List[float]]
+    embeddings: Union[List[List[float]], List[str]]
 
 
 router = APIRouter()
 
 
-@router.post("/embed")
+@router.post(
+    "/embed",
+    response_model=EmbeddingResponse,
+    responses={200: {"content": {OCTET_STREAM: {}, NPY: {}}}},
+)
 async def embed_text(
     request: TextRequest,
-    service: Annotated[
-        SentenceTransformerRepository, Depends(get_sentence_transformer_repository)
-    ],
+    registry: Annotated[ModelRegistry, Depends(get_model_registry)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    accept: Annotated[Optional[str], Header()] = None,
 ):
-    embedding = service.encode_text(request.text)
+    _check_dtype(request.encoding, request.dtype, accept)
+    # モデルの読み込み（他のモデルの解放を伴う場合がある）より前に検証する
+    _check_dimension(request.dimension, request.model, settings)
+    batcher = await _batcher(registry, request.model)
+    embedding = await batcher.encode_text(request.text)
+    embedding = truncate_embeddings(embedding, request.dimension)
+    binary = _binary_response(embedding, request.dtype, accept)
+    if binary is not None:
+        return binary
+    if request.encoding == "base64":
+        return EmbeddingResponse(embedding=_base64(embedding, request.dtype))
     return EmbeddingResponse(embedding=embedding.tolist())
 
 
-@router.post("/embed/batch")
+@router.post(
+    "/embed/batch",
+    response_model=EmbeddingListResponse,
+    responses={200: {"content": {OCTET_STREAM: {}, NPY: {}}}},
+)
 async def embed_texts(
     request: TextListRequest,
-    service: Annotated[
-        SentenceTransformerRepository, Depends(get_sentence_transformer_repository)
-    ],
+    registry: Annotated[ModelRegistry, Depends(get_model_registry)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    accept: Annotated[Optional[str], Header()] = None,
 ):
-    embeddings = service.encode_texts(tuple(request.texts))
+    _check_dtype(request.encoding, request.dtype, accept)
+    _check_dimension(request.dimension, request.model, settings)
+    batcher = await _batcher(registry, request.model)
+    embeddings = await batcher.encode_texts(request.texts)
+    embeddings = truncate_embeddings(embeddings, request.dimension)
+    binary = _binary_response(embeddings, request.dtype, accept)
+    if binary is not None:
+        return binary
+    if request.encoding == "base64":
+        return EmbeddingListResponse(
+            embeddings=[_base64(embedding, request.dtype) for embedding in embeddings]
+        )
     return EmbeddingListResponse(embeddings=embeddings.tolist())
+
+
+async def _batcher(registry: ModelRegistry, model: Optional[str]) -> EmbeddingBatcher:
+    if registry.is_default(model):
+        return registry.default
+    # 初回はモデルの読み込みに時間がかかるため、スレッドで行う
+    return await run_in_threadpool(registry.get, model)
+
+
+def _check_dimension(
+    dimension: Optional[int], model: Optional[str], settings: Settings
+):
+    # 未知のモデルはこの後の _batcher で404にする
+    model_dimension = MODEL_DIMENSIONS.get(model or settings.sentence_transformer_model)
+    if (
+        model_dimension is not None
+        and dimension is not None
+        and dimension > model_dimension
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"dimension must be at most {model_dimension}",
+        )
+
+
+def _check_dtype(encoding: Encoding, dtype: DType, accept: Optional[str]):
+    # JSONの数値配列では半精度に丸めても表現が短くならないため、バイト列で返す場合に限る
+    if (
+        dtype == "float16"
+        and encoding == "float"
+        and _binary_media_type(accept) is None
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="dtype float16 requires base64 encoding or a binary Accept header",
+        )
+
+
+def _little_endian(embeddings: np.ndarray, dtype: DType) -> np.ndarray:
+    return np.ascontiguousarray(embeddings, dtype=np.dtype(dtype).newbyteorder("<"))
+
+
+def _base64(embedding: np.ndarray, dtype: DType) -> str:
+    return base64.b64encode(_little_endian(embedding, dtype).data).decode("ascii")
+
+
+def _binary_response(
+    embeddings: np.ndarray, dtype: DType, accept: Optional[str]
+) -> Optional[Response]:
+    media_type = _binary_media_type(accept)
+    if media_type is None:
+        return None
+    array = _little_endian(embeddings, dtype)
+    if media_type == NPY:
+        buffer = io.BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        return Response(content=buffer.getvalue(), media_type=NPY)
+    # 形状と型はヘッダーで返し、本文は np.frombuffer でそのまま読める生バイト列にする
+    return Response(
+        content=array.tobytes(),
+        media_type=OCTET_STREAM,
+        headers={
+            "X-Embedding-Shape": ",".join(str(n) for n in array.shape),
+            "X-Embedding-Dtype": f"<{'f4' if dtype == 'float32' else 'f2'}",
+        },
+    )
+
+
+def _binary_media_type(accept: Optional[str]) -> Optional[str]:
+    if not accept:
+        return None
+    media_types = [media_type.split(";")[0].strip() for media_type in accept.split(",")]
+    if NPY in media_types:
+        return NPY
+    if OCTET_STREAM in media_types:
+        return OCTET_STREAM
+    return None
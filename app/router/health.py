@@ -1,4 +1,26 @@
-from fastapi import APIRouter
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Depends
+
+from app.repository.cache import (
+    CacheStats,
+    SearchResultCache,
+    get_search_result_cache,
+)
+from app.repository.pgvector import (
+    PgVectorRepository,
+    PoolStats,
+    get_pgvector_repository,
+)
+from app.repository.registry import (
+    ModelRegistry,
+    ModelRegistryStats,
+    get_model_registry,
+)
+from app.repository.sentence_transformer import (
+    SentenceTransformerRepository,
+    get_sentence_transformer_repository,
+)
 
 router = APIRouter()
 
@@ -6,3 +28,39 @@ router = APIRouter()
 @router.get("/health")
 async def health_check():
     return
+
+
+@router.get("/health/db")
+async def db_pool_stats(
+    pgvector: Annotated[PgVectorRepository, Depends(get_pgvector_repository)],
+) -> PoolStats:
+    return pgvector.pool_stats()
+
+
+@router.get("/health/cache")
+async def embedding_cache_stats(
+    sentence_transformer: Annotated[
+        SentenceTransformerRepository, Depends(get_sentence_transformer_repository)
+    ],
+) -> Optional[CacheStats]:
+    if sentence_transformer.cache is None:
+        return None
+    return sentence_transformer.cache.stats()
+
+
+@router.get("/health/search-cache")
+async def search_cache_stats(
+    search_cache: Annotated[
+        Optional[SearchResultCache], Depends(get_search_result_cache)
+    ],
+) -> Optional[CacheStats]:
+    if search_cache is None:
+        return None
+    return search_cache.stats()
+
+
+@router.get("/health/models")
+async def model_registry_stats(
+    registry: Annotated[ModelRegistry, Depends(get_model_registry)],
+) -> ModelRegistryStats:
+    return registry.stats()
@@ -1,24 +1,62 @@
+import asyncio
+import time
+from collections import defaultdict
 from datetime import datetime
-from typing import Annotated, List, Optional
+from typing import Annotated, AsyncIterator, Dict, List, Optional, Tuple
 
 import numpy as np
-from fastapi import APIRouter, Depends
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import Response
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from starlette.concurrency import run_in_threadpool
 
+from app.metrics import STAGE_SECONDS
+from app.repository.batcher import EmbeddingBatcher, ModelUnloadedError, QueueFullError
+from app.repository.cache import SearchResultCache, get_search_result_cache
+from app.repository.fusion import FusionParams
 from app.repository.pgvector import (
-    InsertVector,
+    ChunkAggregation,
+    ChunkBatch,
+    InsertBatch,
     PgVectorRepository,
+    SearchQuery,
+    VectorRecord,
     get_pgvector_repository,
 )
+from app.repository.registry import ModelRegistry, get_model_registry, model_table_name
 from app.repository.sentence_transformer import (
-    SentenceTransformerRepository,
-    get_sentence_transformer_repository,
+    mean_embeddings,
+    truncate_embeddings,
 )
+from app.settings import MODEL_DIMENSIONS, Settings, get_settings
+
+# ストリーム挿入で推論キューが満杯の場合に送り直す間隔
+QUEUE_FULL_RETRY_SECONDS = 0.05
 
 
 class SearchRequest(BaseModel):
+    # 省略時はサーバーの既定のモデル。モデルごとに別のテーブルを検索する
+    model: Optional[str] = None
     category: Optional[str] = None
     query: str
+    limit: int = Field(default=10, ge=1, le=100)
+    # 省略時はサーバーの設定値を使う。大きいほど再現率が上がり、レイテンシが増える
+    ef_search: Optional[int] = Field(default=None, ge=1, le=1000)
+    probes: Optional[int] = Field(default=None, ge=1)
+    vector_candidates: int = Field(default=100, ge=1, le=1000)
+    text_candidates: int = Field(default=100, ge=1, le=1000)
+    # コサイン距離がこれ以上の候補はベクトル検索の結果から除外する（nullで無効）
+    max_distance: Optional[float] = Field(default=0.5, gt=0, le=2)
+    # 量子化インデックス使用時に再スコアリングする候補数（省略時は候補数×倍率）
+    rescore_candidates: Optional[int] = Field(default=None, ge=1, le=1000)
+    fusion: FusionParams = FusionParams()
+    # チャンク単位で検索し、文書ごとに max / sum でスコアを集約する（nullで文書単位）
+    chunk_aggregation: Optional[ChunkAggregation] = None
+    chunk_candidates: int = Field(default=300, ge=1, le=1000)
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[SearchRequest] = Field(min_length=1, max_length=1000)
 
 
 class SearchResponse(BaseModel):
@@ -39,47 +77,325 @@ class InsertRequest(BaseModel):
 
 
 class BulkRequest(BaseModel):
+    model: Optional[str] = None
     items: List[InsertRequest]
 
 
+class IngestResponse(BaseModel):
+    inserted: int
+    chunks: int
+    elapsed_seconds: float
+
+
+SEARCH_RESULTS = TypeAdapter(List[SearchResponse])
+BATCH_SEARCH_RESULTS = TypeAdapter(List[List[SearchResponse]])
+
 router = APIRouter()
 
 
-@router.post("/hybrid/search")
+def _to_results(records: List[VectorRecord]) -> List[SearchResponse]:
+    return [SearchResponse(**record.model_dump()) for record in records]
+
+
+# JSONへのエンコードも serialization の時間に含めるため、本文まで作って返す
+def _to_response(records: List[VectorRecord]) -> Response:
+    with STAGE_SECONDS.time("serialization"):
+        return Response(
+            SEARCH_RESULTS.dump_json(_to_results(records)),
+            media_type="application/json",
+        )
+
+
+def _to_batch_response(results: List[List[VectorRecord]]) -> Response:
+    with STAGE_SECONDS.time("serialization"):
+        return Response(
+            BATCH_SEARCH_RESULTS.dump_json([_to_results(r) for r in results]),
+            media_type="application/json",
+        )
+
+
+@router.post("/hybrid/search", response_model=List[SearchResponse])
 async def hybrid_search(
     request: SearchRequest,
-    sentence_transformer: Annotated[
-        SentenceTransformerRepository, Depends(get_sentence_transformer_repository)
-    ],
+    registry: Annotated[ModelRegistry, Depends(get_model_registry)],
     pgvector: Annotated[PgVectorRepository, Depends(get_pgvector_repository)],
+    search_cache: Annotated[
+        Optional[SearchResultCache], Depends(get_search_result_cache)
+    ],
+    settings: Annotated[Settings, Depends(get_settings)],
 ):
-    embedding = sentence_transformer.encode_text(request.query)
-    results = pgvector.hybrid_search(
+    batcher, pgvector, dimension = await _resolve_model(
+        request.model, registry, pgvector, settings
+    )
+    key = None
+    if search_cache is not None:
+        key = search_cache.key(request.model_dump(), pgvector.generation)
+        cached = search_cache.get(key)
+        if cached is not None:
+            return _to_response(cached)
+    embedding = truncate_embeddings(await batcher.encode_text(request.query), dimension)
+    results = await run_in_threadpool(
+        pgvector.hybrid_search,
         embedding=embedding,
         query=request.query,
         category=request.category,
+        limit=request.limit,
+        ef_search=request.ef_search,
+        probes=request.probes,
+        vector_candidates=request.vector_candidates,
+        text_candidates=request.text_candidates,
+        max_distance=request.max_distance,
+        rescore_candidates=request.rescore_candidates,
+        fusion=request.fusion,
+        chunk_aggregation=request.chunk_aggregation,
+        chunk_candidates=request.chunk_candidates,
     )
-    return [SearchResponse(**result.model_dump()) for result in results]
+    if key is not None:
+        search_cache.put(key, results)
+    return _to_response(results)
+
+
+@router.post("/hybrid/search/batch", response_model=List[List[SearchResponse]])
+async def hybrid_search_batch(
+    request: BatchSearchRequest,
+    registry: Annotated[ModelRegistry, Depends(get_model_registry)],
+    pgvector: Annotated[PgVectorRepository, Depends(get_pgvector_repository)],
+    search_cache: Annotated[
+        Optional[SearchResultCache], Depends(get_search_result_cache)
+    ],
+    settings: Annotated[Settings, Depends(get_settings)],
+) -> Response:
+    results: List[Optional[List[VectorRecord]]] = [None] * len(request.queries)
+    keys: List[Optional[bytes]] = [None] * len(request.queries)
+    models = {
+        model: await _resolve_model(model, registry, pgvector, settings)
+        for model in dict.fromkeys(search.model for search in request.queries)
+    }
+    if search_cache is not None:
+        for i, search in enumerate(request.queries):
+            generation = models[search.model][1].generation
+            keys[i] = search_cache.key(search.model_dump(), generation)
+            results[i] = search_cache.get(keys[i])
+    missing: Dict[Optional[str], List[int]] = defaultdict(list)
+    for i, records in enumerate(results):
+        if records is None:
+            missing[request.queries[i].model].append(i)
+    for model, indexes in missing.items():
+        batcher, repository, dimension = models[model]
+        # キャッシュにないクエリだけをモデルごとに1回の推論でまとめてベクトル化する
+        embeddings = truncate_embeddings(
+            await batcher.encode_texts([request.queries[i].query for i in indexes]),
+            dimension,
+        )
+        searched = await run_in_threadpool(
+            repository.hybrid_search_batch,
+            [
+                SearchQuery(embedding=embedding, **request.queries[i].model_dump())
+                for i, embedding in zip(indexes, embeddings)
+            ],
+        )
+        for i, records in zip(indexes, searched):
+            results[i] = records
+            if keys[i] is not None:
+                search_cache.put(keys[i], records)
+    return _to_batch_response(results)
 
 
 @router.post("/hybrid/insert")
 async def hybrid_insert(
     request: BulkRequest,
-    service: Annotated[
-        SentenceTransformerRepository, Depends(get_sentence_transformer_repository)
-    ],
+    registry: Annotated[ModelRegistry, Depends(get_model_registry)],
     pgvector: Annotated[PgVectorRepository, Depends(get_pgvector_repository)],
+    settings: Annotated[Settings, Depends(get_settings)],
 ):
-    embeddings: np.ndarray = service.encode_texts(
-        tuple(f"{item.title} {item.text}" for item in request.items)
+    batcher, pgvector, dimension = await _resolve_model(
+        request.model, registry, pgvector, settings
     )
-    data: List[InsertVector] = [
-        InsertVector(
-            category=item.category,
-            title=item.title,
-            text=item.text,
-            embedding=np.array(embedding, dtype=np.float32),
+    batch = await _embed_items(batcher, request.items, settings, dimension)
+    await run_in_threadpool(pgvector.copy_batch, batch)
+
+
+@router.post("/hybrid/insert/stream")
+async def hybrid_insert_stream(
+    request: Request,
+    registry: Annotated[ModelRegistry, Depends(get_model_registry)],
+    pgvector: Annotated[PgVectorRepository, Depends(get_pgvector_repository)],
+    settings: Annotated[Settings, Depends(get_settings)],
+    model: Optional[str] = None,
+) -> IngestResponse:
+    started = time.perf_counter()
+    batcher, pgvector, dimension = await _resolve_model(
+        model, registry, pgvector, settings
+    )
+    inserted = 0
+    chunks = 0
+    pending_copy: Optional[asyncio.Future] = None
+    pending_rows = 0
+    try:
+        async for items in _read_ndjson_chunks(request, settings.ingest_chunk_size):
+            # 前のチャンクのCOPY中に次のチャンクを推論する
+            batch = await _embed_items_waiting(batcher, items, settings, dimension)
+            if pending_copy is not None:
+                await pending_copy
+                inserted += pending_rows
+                pending_copy = None
+            pending_copy = asyncio.ensure_future(
+                run_in_threadpool(pgvector.copy_batch, batch)
+            )
+            pending_rows = len(items)
+            chunks += 1
+        if pending_copy is not None:
+            await pending_copy
+            inserted += pending_rows
+            pending_copy = None
+    except BaseException as e:
+        # 途中までのチャンクはコミット済みのため、再送で重複しないよう挿入件数を返す
+        if pending_copy is not None:
+            (result,) = await asyncio.gather(pending_copy, return_exceptions=True)
+            if not isinstance(result, BaseException):
+                inserted += pending_rows
+        if isinstance(e, HTTPException):
+            e.detail["inserted"] = inserted
+            raise
+        if isinstance(e, QueueFullError):
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail={"message": str(e), "inserted": inserted},
+                headers={"Retry-After": str(settings.retry_after_seconds)},
+            ) from e
+        if isinstance(e, Exception):
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail={"message": f"insert failed: {e}", "inserted": inserted},
+            ) from e
+        raise
+    return IngestResponse(
+        inserted=inserted,
+        chunks=chunks,
+        elapsed_seconds=time.perf_counter() - started,
+    )
+
+
+async def _resolve_model(
+    model: Optional[str],
+    registry: ModelRegistry,
+    pgvector: PgVectorRepository,
+    settings: Settings,
+) -> Tuple[EmbeddingBatcher, PgVectorRepository, Optional[int]]:
+    if registry.is_default(model):
+        return registry.default, pgvector, settings.embedding_dimension
+    # 初回はモデルの読み込みとテーブルの作成に時間がかかるため、スレッドで行う
+    batcher = await run_in_threadpool(registry.get, model)
+    repository = await run_in_threadpool(
+        pgvector.for_table, model_table_name(model), MODEL_DIMENSIONS[model]
+    )
+    return batcher, repository, None
+
+
+async def _embed_items_waiting(
+    batcher: EmbeddingBatcher,
+    items: List[InsertRequest],
+    settings: Settings,
+    dimension: Optional[int],
+) -> InsertBatch:
+    # 一部のチャンクをコミット済みのアップロードを429で失敗させないよう、
+    # 推論キューが空くまで待ってから送り直す
+    deadline = time.monotonic() + settings.ingest_queue_wait_seconds
+    while True:
+        try:
+            return await _embed_items(batcher, items, settings, dimension)
+        except ModelUnloadedError:
+            raise
+        except QueueFullError:
+            if time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(QUEUE_FULL_RETRY_SECONDS)
+
+
+async def _embed_items(
+    batcher: EmbeddingBatcher,
+    items: List[InsertRequest],
+    settings: Settings,
+    dimension: Optional[int],
+) -> InsertBatch:
+    if settings.document_chunking:
+        return await _embed_chunked_items(batcher, items, settings, dimension)
+    embeddings: np.ndarray = await batcher.encode_texts(
+        [f"{item.title} {item.text}" for item in items]
+    )
+    embeddings = truncate_embeddings(embeddings, dimension)
+    return InsertBatch(
+        categories=[item.category for item in items],
+        titles=[item.title for item in items],
+        texts=[item.text for item in items],
+        embeddings=embeddings,
+    )
+
+
+async def _embed_chunked_items(
+    batcher: EmbeddingBatcher,
+    items: List[InsertRequest],
+    settings: Settings,
+    dimension: Optional[int],
+) -> InsertBatch:
+    chunked = await run_in_threadpool(
+        batcher.chunk_texts,
+        [item.title for item in items],
+        [item.text for item in items],
+        settings.chunk_max_tokens,
+        settings.chunk_overlap_tokens,
+    )
+    documents = [i for i, chunks in enumerate(chunked) for _ in chunks]
+    positions = [position for chunks in chunked for position in range(len(chunks))]
+    texts = [chunk for chunks in chunked for chunk in chunks]
+    embeddings = truncate_embeddings(
+        await batcher.encode_texts(
+            [f"{items[i].title} {text}" for i, text in zip(documents, texts)]
+        ),
+        dimension,
+    )
+    # 文書単位の検索のため、文書のベクトルはチャンクのベクトルの平均とする
+    return InsertBatch(
+        categories=[item.category for item in items],
+        titles=[item.title for item in items],
+        texts=[item.text for item in items],
+        embeddings=mean_embeddings(embeddings, documents, len(items)),
+        chunks=ChunkBatch(
+            documents=documents,
+            positions=positions,
+            texts=texts,
+            embeddings=embeddings,
+        ),
+    )
+
+
+async def _read_ndjson_chunks(
+    request: Request, chunk_size: int
+) -> AsyncIterator[List[InsertRequest]]:
+    buffer = b""
+    line_number = 0
+    items: List[InsertRequest] = []
+    async for body in request.stream():
+        buffer += body
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                items.append(_parse_line(line, line_number))
+            if len(items) >= chunk_size:
+                yield items
+                items = []
+    if buffer.strip():
+        items.append(_parse_line(buffer, line_number + 1))
+    if items:
+        yield items
+
+
+def _parse_line(line: bytes, line_number: int) -> InsertRequest:
+    try:
+        return InsertRequest.model_validate_json(line)
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={"line": line_number, "errors": e.errors(include_url=False)},
         )
-        for item, embedding in zip(request.items, list(embeddings))
-    ]
-    pgvector.copy(data)
@@ -0,0 +1,98 @@
+from typing import Annotated, List, Optional
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+from app.metrics import HISTOGRAMS, render_samples
+from app.repository.cache import (
+    CacheStats,
+    SearchResultCache,
+    get_search_result_cache,
+)
+from app.repository.pgvector import PoolStats, get_pool_stats
+from app.repository.registry import ModelRegistry, get_model_registry
+from app.repository.sentence_transformer import (
+    SentenceTransformerRepository,
+    get_sentence_transformer_repository,
+)
+
+router = APIRouter()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _cache_lines(caches: List[tuple]) -> List[str]:
+    stats: List[tuple] = [(name, s) for name, s in caches if s is not None]
+    lines = []
+    for field, metric_type, documentation in (
+        ("hits", "counter", "Cache lookups that found an entry"),
+        ("misses", "counter", "Cache lookups that found no entry"),
+        ("evictions", "counter", "Entries evicted to stay under max_bytes"),
+        ("bytes", "gauge", "Approximate bytes held by the cache"),
+        ("entries", "gauge", "Entries held by the cache"),
+    ):
+        suffix = "_total" if metric_type == "counter" else ""
+        lines += render_samples(
+            f"embedding_api_cache_{field}{suffix}",
+            documentation,
+            metric_type,
+            {(name,): getattr(s, field) for name, s in stats},
+            labelnames=("cache",),
+        )
+    return lines
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(
+    sentence_transformer: Annotated[
+        SentenceTransformerRepository, Depends(get_sentence_transformer_repository)
+    ],
+    search_cache: Annotated[
+        Optional[SearchResultCache], Depends(get_search_result_cache)
+    ],
+    pool: Annotated[Optional[PoolStats], Depends(get_pool_stats)],
+    registry: Annotated[ModelRegistry, Depends(get_model_registry)],
+) -> PlainTextResponse:
+    lines: List[str] = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    embedding_cache: Optional[CacheStats] = None
+    if sentence_transformer.cache is not None:
+        embedding_cache = sentence_transformer.cache.stats()
+    lines += _cache_lines(
+        [
+            ("embedding", embedding_cache),
+            ("search", search_cache.stats() if search_cache is not None else None),
+        ]
+    )
+    if embedding_cache is not None:
+        lines += render_samples(
+            "embedding_api_cache_disk_hits_total",
+            "Embedding cache misses served from the disk cache",
+            "counter",
+            {(): embedding_cache.disk_hits},
+        )
+    # DBに接続する前はプールのメトリクスを出さない
+    if pool is not None:
+        lines += render_samples(
+            "embedding_api_db_pool_connections",
+            "Database pool connections by state",
+            "gauge",
+            {("in_use",): pool.in_use, ("available",): pool.available},
+            labelnames=("state",),
+        )
+        lines += render_samples(
+            "embedding_api_db_pool_waiting",
+            "Requests waiting for a database connection",
+            "gauge",
+            {(): pool.waiting},
+        )
+    models = registry.stats()
+    lines += render_samples(
+        "embedding_api_model_bytes",
+        "Approximate memory held by loaded models",
+        "gauge",
+        {(model.model_name,): model.bytes for model in models.models},
+        labelnames=("model",),
+    )
+    return PlainTextResponse("\n".join(lines) + "\n", media_type=CONTENT_TYPE)
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import subprocess
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+import numpy as np
+from psycopg import sql
+from pydantic import BaseModel
+
+from app.repository.pgvector import (
+    DEFAULT_TABLE_NAME,
+    PgVectorRepository,
+    VectorIndexConfig,
+)
+from app.settings import get_settings
+from benchmarks.corpus import load, make_words
+
+SCENARIOS = ("embed", "embed-batch", "insert", "search")
+
+Payload = Callable[[int], Dict[str, Any]]
+
+
+class ScenarioResult(BaseModel):
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    items_per_request: int
+    elapsed_seconds: float
+    requests_per_second: float
+    items_per_second: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+class BenchmarkReport(BaseModel):
+    commit: Optional[str]
+    started_at: datetime
+    base_url: str
+    table: str
+    corpus_rows: int
+    results: List[ScenarioResult]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def payloads(
+    words: List[str], batch_size: int, categories: int, seed: int = 3
+) -> Dict[str, Payload]:
+    rng = np.random.default_rng(seed)
+    # リクエスト番号ごとに異なる文・クエリを使い、埋め込みと検索結果のキャッシュに
+    # 当たらないようにする（番号は同時実行数やシナリオをまたいで重複させない）
+    sentences = [
+        " ".join(words[j] for j in rng.integers(0, len(words), size=8))
+        for _ in range(4096)
+    ]
+
+    # 合成した単語には重複があるため、検索クエリには重複を除いた単語を使う
+    vocabulary = list(dict.fromkeys(words))
+
+    def sentence(i: int) -> str:
+        return f"{sentences[i % len(sentences)]} {i}"
+
+    return {
+        "embed": lambda i: {"text": sentence(i * batch_size)},
+        "embed-batch": lambda i: {
+            "texts": [sentence(i * batch_size + j) for j in range(batch_size)]
+        },
+        "insert": lambda i: {
+            "items": [
+                {
+                    "category": f"category-{(i + j) % categories}",
+                    "title": sentence(i * batch_size + j)[:40],
+                    "text": sentence(i * batch_size + j),
+                }
+                for j in range(batch_size)
+            ]
+        },
+        "search": lambda i: {
+            "query": vocabulary[i % len(vocabulary)]
+            if i < len(vocabulary)
+            else f"{vocabulary[i % len(vocabulary)]} "
+            f"{vocabulary[i // len(vocabulary) % len(vocabulary)]}",
+            "category": f"category-{i % categories}" if i % 2 else None,
+        },
+    }
+
+
+ENDPOINTS = {
+    "embed": "/embed",
+    "embed-batch": "/embed/batch",
+    "insert": "/hybrid/insert",
+    "search": "/hybrid/search",
+}
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: str,
+    payload: Payload,
+    requests: int,
+    concurrency: int,
+    items_per_request: int = 1,
+    warmup: int = 0,
+    offset: int = 0,
+) -> ScenarioResult:
+    url = ENDPOINTS[scenario]
+    for i in range(warmup):
+        await client.post(url, json=payload(offset + i))
+
+    latencies: List[float] = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal errors, next_index
+        # 各ワーカーが次のリクエスト番号を取り、同時に concurrency 件まで送る
+        while next_index < requests:
+            index = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                response = await client.post(url, json=payload(offset + warmup + index))
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0, 0, 0)
+    succeeded = requests - errors
+    return ScenarioResult(
+        scenario=scenario,
+        concurrency=concurrency,
+        requests=requests,
+        errors=errors,
+        items_per_request=items_per_request,
+        elapsed_seconds=elapsed,
+        requests_per_second=succeeded / elapsed if elapsed > 0 else 0.0,
+        items_per_second=succeeded * items_per_request / elapsed
+        if elapsed > 0
+        else 0.0,
+        p50_ms=p50,
+        p95_ms=p95,
+        p99_ms=p99,
+        max_ms=max(latencies, default=0.0),
+    )
+
+
+async def run(args: argparse.Namespace) -> BenchmarkReport:
+    words = make_words(5_000, np.random.default_rng(1))
+    started_at = datetime.now(timezone.utc)
+    if args.rows > 0:
+        settings = get_settings()
+        # サーバーと同じインデックス設定で、運用中とは別のテーブルに作り直す
+        repo = PgVectorRepository(
+            args.connection_string,
+            index_config=VectorIndexConfig.from_settings(settings),
+        )
+        with repo.pool.connection() as conn:
+            conn.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}, {};").format(
+                    sql.Identifier(f"{args.table}_chunks"), sql.Identifier(args.table)
+                )
+            )
+        load(
+            repo.for_table(args.table, settings.vector_dimension),
+            args.rows,
+            settings.vector_dimension,
+            words,
+            args.categories,
+            args.category_skew,
+        )
+        repo.close()
+
+    scenario_payloads = payloads(words, args.batch_size, args.categories)
+    results = []
+    offset = 0
+    print(
+        f"{'scenario':>12} {'conc':>5} {'req/sec':>9} {'items/sec':>10} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}"
+    )
+    async with httpx.AsyncClient(
+        base_url=args.base_url,
+        timeout=args.timeout,
+        limits=httpx.Limits(max_connections=max(args.concurrency)),
+    ) as client:
+        for scenario in args.scenarios:
+            batched = scenario in ("embed-batch", "insert")
+            for concurrency in args.concurrency:
+                result = await run_scenario(
+                    client,
+                    scenario,
+                    scenario_payloads[scenario],
+                    args.requests,
+                    concurrency,
+                    items_per_request=args.batch_size if batched else 1,
+                    warmup=args.warmup,
+                    offset=offset,
+                )
+                offset += args.warmup + args.requests
+                print(
+                    f"{scenario:>12} {concurrency:>5} "
+                    f"{result.requests_per_second:>9.1f} "
+                    f"{result.items_per_second:>10.1f} {result.p50_ms:>8.2f} "
+                    f"{result.p95_ms:>8.2f} {result.p99_ms:>8.2f} "
+                    f"{result.errors:>7}"
+                )
+                results.append(result)
+    return BenchmarkReport(
+        commit=git_commit(),
+        started_at=started_at,
+        base_url=args.base_url,
+        table=args.table,
+        corpus_rows=args.rows,
+        results=results,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure throughput and latency of the API under concurrency"
+    )
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--connection-string", default=get_settings().connection_string)
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=0,
+        help="recreate the benchmark table with N synthetic rows before measuring",
+    )
+    parser.add_argument(
+        "--table",
+        default="api_benchmark",
+        help="table to load; start the server with TABLE_NAME set to the same name",
+    )
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument(
+        "--category-skew",
+        type=float,
+        default=0.0,
+        help="Zipf exponent of the category distribution (0 = uniform)",
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+    if args.rows > 0 and args.table == DEFAULT_TABLE_NAME:
+        parser.error(f"--table must not be the {DEFAULT_TABLE_NAME} table")
+    report = asyncio.run(run(args))
+    if args.output is not None:
+        args.output.write_text(report.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
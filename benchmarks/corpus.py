@@ -0,0 +1,58 @@
+from typing import List
+
+import numpy as np
+
+from app.repository.pgvector import InsertBatch, PgVectorRepository
+
+SYLLABLES = ["ka", "ri", "to", "mo", "na", "se", "ru", "hi", "yo", "ne", "su", "chi"]
+
+
+def make_words(count: int, rng: np.random.Generator) -> List[str]:
+    return [
+        "".join(rng.choice(SYLLABLES, size=rng.integers(2, 5))) for _ in range(count)
+    ]
+
+
+def category_weights(categories: int, skew: float) -> np.ndarray:
+    # skew=0 で一様、大きいほど先頭のカテゴリに偏る（Zipf分布）
+    weights = 1.0 / np.arange(1, categories + 1) ** skew
+    return weights / weights.sum()
+
+
+def make_batch(
+    rows: int,
+    dim: int,
+    words: List[str],
+    rng: np.random.Generator,
+    categories: int = 10,
+    skew: float = 0.0,
+) -> InsertBatch:
+    picked = rng.integers(0, len(words), size=(rows, 8))
+    assigned = rng.choice(categories, size=rows, p=category_weights(categories, skew))
+    return InsertBatch(
+        categories=[f"category-{c}" for c in assigned],
+        titles=[f"{words[p[0]]} {words[p[1]]}" for p in picked],
+        texts=[" ".join(words[j] for j in p[2:]) for p in picked],
+        embeddings=rng.standard_normal((rows, dim), dtype=np.float32),
+    )
+
+
+def load(
+    repo: PgVectorRepository,
+    rows: int,
+    dim: int,
+    words: List[str],
+    categories: int = 10,
+    skew: float = 0.0,
+    seed: int = 0,
+):
+    rng = np.random.default_rng(seed)
+    # インデックスは投入後にまとめて作成する
+    repo.drop_indexes()
+    for start in range(0, rows, 50_000):
+        repo.copy_batch(
+            make_batch(min(50_000, rows - start), dim, words, rng, categories, skew)
+        )
+    repo.create_indexes()
+    with repo.pool.connection() as conn:
+        conn.execute(f"ANALYZE {repo.table_name};")
@@ -0,0 +1,288 @@
+import argparse
+import itertools
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+from psycopg import sql
+from pydantic import BaseModel
+
+from app.repository.memory import InMemoryVectorRepository
+from app.repository.pgvector import (
+    InsertBatch,
+    PgVectorRepository,
+    SearchQuery,
+    VectorIndexConfig,
+)
+from app.settings import get_settings
+from benchmarks.corpus import load, make_words
+
+
+class SweepResult(BaseModel):
+    ef_search: Optional[int]
+    probes: Optional[int]
+    vector_candidates: int
+    text_candidates: int
+    vector_recall: float
+    hybrid_recall: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+
+class RecallReport(BaseModel):
+    rows: int
+    queries: int
+    k: int
+    index_type: str
+    quantization: str
+    results: List[SweepResult]
+
+
+def read_table(
+    repo: PgVectorRepository, fetch_size: int = 10_000
+) -> Tuple[np.ndarray, InsertBatch]:
+    ids: List[int] = []
+    categories: List[str] = []
+    titles: List[str] = []
+    texts: List[str] = []
+    embeddings: List[np.ndarray] = []
+    with repo.pool.connection() as conn, conn.cursor(name="recall_read") as cur:
+        cur.execute(
+            sql.SQL(
+                "SELECT id, category, title, text, embedding FROM {} ORDER BY id"
+            ).format(sql.Identifier(repo.table_name))
+        )
+        while rows := cur.fetchmany(fetch_size):
+            for id, category, title, text, embedding in rows:
+                ids.append(id)
+                categories.append(category)
+                titles.append(title)
+                texts.append(text)
+                embeddings.append(embedding.to_numpy())
+    return np.array(ids), InsertBatch(
+        categories=categories,
+        titles=titles,
+        texts=texts,
+        embeddings=np.array(embeddings, dtype=np.float32),
+    )
+
+
+def make_queries(
+    batch: InsertBatch,
+    count: int,
+    noise: float,
+    category_ratio: float,
+    rng: np.random.Generator,
+) -> List[SearchQuery]:
+    # 保存済みの行にノイズを加えたベクトルと、その行のタイトルの単語をクエリにする
+    queries = []
+    dim = batch.embeddings.shape[1]
+    for row in rng.choice(len(batch.categories), size=count, replace=False):
+        embedding = batch.embeddings[row] / np.linalg.norm(batch.embeddings[row])
+        embedding = embedding + rng.normal(scale=noise / np.sqrt(dim), size=dim)
+        words = batch.titles[row].split() or [""]
+        queries.append(
+            SearchQuery(
+                embedding=embedding,
+                query=words[rng.integers(0, len(words))],
+                category=batch.categories[row]
+                if rng.random() < category_ratio
+                else None,
+                max_distance=None,
+            )
+        )
+    return queries
+
+
+def exact_vector_top_k(
+    batch: InsertBatch, queries: List[SearchQuery], k: int
+) -> List[np.ndarray]:
+    # 全件との内積をまとめて計算した厳密な近傍（行番号）
+    embeddings = batch.embeddings / np.linalg.norm(
+        batch.embeddings, axis=1, keepdims=True
+    )
+    categories = np.array(batch.categories)
+    matrix = np.stack([q.embedding for q in queries])
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    scores = matrix @ embeddings.T
+    results = []
+    for search, row_scores in zip(queries, scores):
+        if search.category is not None:
+            row_scores = np.where(categories == search.category, row_scores, -np.inf)
+        # 件数の少ないコーパスでは k 件に満たない
+        row_k = min(k, row_scores.shape[0])
+        if row_k == 0:
+            results.append(np.array([], dtype=np.intp))
+            continue
+        top = np.argpartition(-row_scores, row_k - 1)[:row_k]
+        top = top[np.isfinite(row_scores[top])]
+        results.append(top[np.argsort(-row_scores[top])])
+    return results
+
+
+def recall(expected: List[np.ndarray], actual: List[List[int]], k: int) -> float:
+    hits = [
+        len(set(e[:k].tolist()) & set(a[:k])) / min(k, len(e))
+        for e, a in zip(expected, actual)
+        if len(e)
+    ]
+    return float(np.mean(hits)) if hits else 1.0
+
+
+def run(args: argparse.Namespace) -> RecallReport:
+    settings = get_settings()
+    index_config = VectorIndexConfig.from_settings(settings)
+    repo = PgVectorRepository(
+        args.connection_string, table_name=args.table, index_config=index_config
+    )
+    if args.rows > 0:
+        words = make_words(5_000, np.random.default_rng(1))
+        with repo.pool.connection() as conn:
+            conn.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}, {};").format(
+                    sql.Identifier(repo.chunk_table_name),
+                    sql.Identifier(repo.table_name),
+                )
+            )
+        repo.create_table(vector_dim=args.dim)
+        load(repo, args.rows, args.dim, words, args.categories, args.category_skew)
+
+    ids, batch = read_table(repo)
+    queries = make_queries(
+        batch,
+        args.queries,
+        args.noise,
+        args.category_ratio,
+        np.random.default_rng(args.seed),
+    )
+    k = args.k
+    exact_vector = [ids[rows] for rows in exact_vector_top_k(batch, queries, k)]
+
+    # ハイブリッド検索の正解は、最大の候補数で厳密に検索したインメモリ実装の結果
+    memory = InMemoryVectorRepository(vector_dim=batch.embeddings.shape[1])
+    memory.copy_batch(batch)
+    exact_hybrid = [
+        ids[np.array([r.id - 1 for r in records], dtype=np.intp)]
+        for records in memory.hybrid_search_batch(
+            [
+                q.model_copy(
+                    update={
+                        "limit": k,
+                        "vector_candidates": args.reference_candidates,
+                        "text_candidates": args.reference_candidates,
+                    }
+                )
+                for q in queries
+            ]
+        )
+    ]
+
+    results = []
+    print(
+        f"{'ef_search':>9} {'probes':>6} {'vec_cand':>8} {'text_cand':>9} "
+        f"{'vec@k':>6} {'hyb@k':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for ef_search, probes, vector_candidates, text_candidates in itertools.product(
+        args.ef_search, args.probes, args.vector_candidates, args.text_candidates
+    ):
+        sweep = [
+            q.model_copy(
+                update={
+                    "limit": k,
+                    "ef_search": ef_search,
+                    "probes": probes,
+                    "vector_candidates": vector_candidates,
+                    "text_candidates": text_candidates,
+                }
+            )
+            for q in queries
+        ]
+        vector = repo.vector_search_batch(
+            [q.model_copy(update={"vector_candidates": k}) for q in sweep]
+        )
+        latencies = []
+        hybrid = []
+        for search in sweep:
+            started = time.perf_counter()
+            records = repo.hybrid_search(**search.model_dump())
+            latencies.append((time.perf_counter() - started) * 1000)
+            hybrid.append([r.id for r in records])
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        result = SweepResult(
+            ef_search=ef_search,
+            probes=probes,
+            vector_candidates=vector_candidates,
+            text_candidates=text_candidates,
+            vector_recall=recall(
+                exact_vector, [[id for id, _ in rows] for rows in vector], k
+            ),
+            hybrid_recall=recall(exact_hybrid, hybrid, k),
+            p50_ms=p50,
+            p95_ms=p95,
+            p99_ms=p99,
+        )
+        print(
+            f"{str(ef_search):>9} {str(probes):>6} {vector_candidates:>8} "
+            f"{text_candidates:>9} {result.vector_recall:>6.3f} "
+            f"{result.hybrid_recall:>6.3f} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}"
+        )
+        results.append(result)
+    repo.close()
+    return RecallReport(
+        rows=len(ids),
+        queries=len(queries),
+        k=k,
+        index_type=index_config.index_type,
+        quantization=index_config.quantization,
+        results=results,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure recall@k against exact search for parameter sweeps"
+    )
+    parser.add_argument("--connection-string", default=get_settings().connection_string)
+    parser.add_argument("--table", default="recall_benchmark")
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=0,
+        help="recreate the table with N synthetic rows (0 = evaluate it as is)",
+    )
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--category-skew", type=float, default=0.0)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument(
+        "--noise", type=float, default=0.5, help="norm of the noise added to queries"
+    )
+    parser.add_argument(
+        "--category-ratio",
+        type=float,
+        default=0.0,
+        help="fraction of queries filtered by category",
+    )
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[None])
+    parser.add_argument("--probes", type=int, nargs="+", default=[None])
+    parser.add_argument("--vector-candidates", type=int, nargs="+", default=[100])
+    parser.add_argument("--text-candidates", type=int, nargs="+", default=[100])
+    parser.add_argument(
+        "--reference-candidates",
+        type=int,
+        default=1000,
+        help="candidate pools of the exact hybrid search used as ground truth",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the results as JSON")
+    args = parser.parse_args()
+    report = run(args)
+    if args.output is not None:
+        args.output.write_text(report.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
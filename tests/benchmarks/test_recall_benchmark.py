@@ -0,0 +1,64 @@
+import numpy as np
+from pytest import mark
+
+from app.repository.pgvector import InsertBatch, SearchQuery
+from benchmarks.recall_benchmark import exact_vector_top_k, recall
+
+BATCH = InsertBatch(
+    categories=["a", "b", "a"],
+    titles=["t0", "t1", "t2"],
+    texts=["x0", "x1", "x2"],
+    embeddings=np.array([[1, 0], [0.8, 0.6], [0, 1]], dtype=np.float32),
+)
+
+
+def query(embedding, category=None) -> SearchQuery:
+    return SearchQuery(embedding=embedding, query="q", category=category)
+
+
+@mark.ut
+def test_exact_vector_top_k_orders_by_similarity():
+    # when
+    [top] = exact_vector_top_k(BATCH, [query([1, 0.1])], k=2)
+    # then
+    assert top.tolist() == [0, 1]
+
+
+@mark.ut
+def test_exact_vector_top_k_larger_than_corpus():
+    # when
+    [top] = exact_vector_top_k(BATCH, [query([0, 1])], k=10)
+    # then
+    assert top.tolist() == [2, 1, 0]
+
+
+@mark.ut
+def test_exact_vector_top_k_with_category_filter():
+    # when
+    filtered, empty = exact_vector_top_k(
+        BATCH, [query([0, 1], category="a"), query([0, 1], category="c")], k=3
+    )
+    # then
+    # 絞り込みで k 件に満たない場合は、該当する行だけを返す
+    assert filtered.tolist() == [2, 0]
+    assert empty.tolist() == []
+
+
+@mark.ut
+def test_recall():
+    # given
+    expected = [np.array([0, 1, 2]), np.array([3])]
+    actual = [[0, 2, 5], [4]]
+    # when / then
+    # 正解が k 件に満たない場合は正解の件数で割る
+    assert recall(expected, actual, k=3) == (2 / 3 + 0) / 2
+    assert recall(expected, [[2, 1, 0], [3]], k=3) == 1.0
+    assert recall(expected, actual, k=1) == 0.5
+
+
+@mark.ut
+def test_recall_without_ground_truth():
+    # when / then
+    # 絞り込みで正解が0件のクエリは平均から除く
+    assert recall([np.array([], dtype=np.intp)], [[1, 2]], k=10) == 1.0
+    assert recall([np.array([], dtype=np.intp), np.array([1])], [[], [2]], k=10) == 0.0
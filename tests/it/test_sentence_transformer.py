@@ -0,0 +1,28 @@
+from pathlib import Path
+
+import numpy as np
+from pytest import importorskip, mark
+
+from app.repository.sentence_transformer import SentenceTransformerRepository
+from app.settings import get_settings
+
+TEXTS = ["Hello, world!", "ハイブリッド検索のテスト", "pgvector stores embeddings"]
+
+
+@mark.it
+@mark.parametrize(("backend", "tolerance"), [("onnx", 0.9999), ("onnx-int8", 0.98)])
+def test_onnx_backend_matches_torch(backend: str, tolerance: float, tmp_path: Path):
+    importorskip("onnxruntime")
+    # given
+    model_name = get_settings().sentence_transformer_model
+    expected = SentenceTransformerRepository(model_name).encode_texts(TEXTS)
+    repo = SentenceTransformerRepository(
+        model_name, backend=backend, export_dir=str(tmp_path)
+    )
+    # when
+    embeddings = repo.encode_texts(TEXTS)
+    # then
+    similarities = np.sum(embeddings * expected, axis=1) / (
+        np.linalg.norm(embeddings, axis=1) * np.linalg.norm(expected, axis=1)
+    )
+    assert np.all(similarities >= tolerance)
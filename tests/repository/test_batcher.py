@@ -0,0 +1,150 @@
+import asyncio
+from typing import Tuple
+from unittest.mock import Mock
+
+import numpy as np
+from pytest import fixture, mark, raises
+from pytest_mock import MockerFixture
+
+from app.metrics import BATCH_SIZE, STAGE_SECONDS
+from app.repository.batcher import (
+    EmbeddingBatcher,
+    ModelUnloadedError,
+    QueueFullError,
+)
+from app.repository.sentence_transformer import SentenceTransformerRepository
+
+
+def fake_encode(texts: Tuple[str]) -> np.ndarray:
+    return np.array([[float(len(text)), 1.0] for text in texts], dtype=np.float32)
+
+
+@fixture
+def sentence_transformer_repository(mocker: MockerFixture):
+    repository: Mock = mocker.create_autospec(spec=SentenceTransformerRepository)
+    repository.encode_texts.side_effect = fake_encode
+    return repository
+
+
+@mark.ut
+def test_encode_text(sentence_transformer_repository: Mock):
+    # given
+    batcher = EmbeddingBatcher(sentence_transformer_repository)
+    # when
+    embedding = asyncio.run(batcher.encode_text("abc"))
+    # then
+    assert np.array_equal(embedding, np.array([3.0, 1.0], dtype=np.float32))
+    sentence_transformer_repository.encode_texts.assert_called_once_with(("abc",))
+
+
+@mark.ut
+def test_encode_records_stage_metrics(sentence_transformer_repository: Mock):
+    # given
+    batcher = EmbeddingBatcher(sentence_transformer_repository)
+    queue_waits = STAGE_SECONDS.count("queue_wait")
+    encodes = STAGE_SECONDS.count("encode")
+    batches = BATCH_SIZE.count()
+    # when
+    asyncio.run(batcher.encode_texts(["a", "b"]))
+    # then
+    assert STAGE_SECONDS.count("queue_wait") == queue_waits + 1
+    assert STAGE_SECONDS.count("encode") == encodes + 1
+    assert BATCH_SIZE.count() == batches + 1
+
+
+@mark.ut
+def test_concurrent_requests_are_batched(sentence_transformer_repository: Mock):
+    # given
+    batcher = EmbeddingBatcher(
+        sentence_transformer_repository, max_batch_size=8, max_wait_ms=200
+    )
+
+    async def run():
+        return await asyncio.gather(
+            batcher.encode_text("a"),
+            batcher.encode_texts(["bb", "ccc"]),
+            batcher.encode_text("dddd"),
+        )
+
+    # when
+    single, pair, last = asyncio.run(run())
+    # then
+    sentence_transformer_repository.encode_texts.assert_called_once_with(
+        ("a", "bb", "ccc", "dddd")
+    )
+    assert single[0] == 1.0
+    assert pair[:, 0].tolist() == [2.0, 3.0]
+    assert last[0] == 4.0
+
+
+@mark.ut
+def test_batch_is_flushed_at_max_size(sentence_transformer_repository: Mock):
+    # given
+    batcher = EmbeddingBatcher(
+        sentence_transformer_repository, max_batch_size=2, max_wait_ms=200
+    )
+
+    async def run():
+        return await asyncio.gather(*(batcher.encode_text(t) for t in "abcd"))
+
+    # when
+    results = asyncio.run(run())
+    # then
+    assert len(results) == 4
+    assert sentence_transformer_repository.encode_texts.call_count == 2
+
+
+@mark.ut
+def test_encode_error_is_propagated(sentence_transformer_repository: Mock):
+    # given
+    sentence_transformer_repository.encode_texts.side_effect = RuntimeError("boom")
+    batcher = EmbeddingBatcher(sentence_transformer_repository)
+    # when / then
+    with raises(RuntimeError, match="boom"):
+        asyncio.run(batcher.encode_text("abc"))
+
+
+@mark.ut
+def test_submit_rejected_when_queue_is_full(sentence_transformer_repository: Mock):
+    # given
+    batcher = EmbeddingBatcher(
+        sentence_transformer_repository, workers=0, max_queue_size=1
+    )
+
+    async def run():
+        pending = batcher.encode_text("a")
+        waiting = asyncio.ensure_future(pending)
+        await asyncio.sleep(0)
+        try:
+            await batcher.encode_text("b")
+        finally:
+            waiting.cancel()
+
+    # when / then
+    with raises(QueueFullError):
+        asyncio.run(run())
+
+
+@mark.ut
+def test_close_stops_workers_after_queued_jobs(sentence_transformer_repository: Mock):
+    # given
+    sentence_transformer_repository.model_name = "model"
+    batcher = EmbeddingBatcher(
+        sentence_transformer_repository, workers=2, max_wait_ms=50
+    )
+
+    async def run():
+        queued = asyncio.ensure_future(batcher.encode_text("abc"))
+        await asyncio.sleep(0)
+        batcher.close()
+        return await queued
+
+    # when
+    embedding = asyncio.run(run())
+    # then
+    assert embedding[0] == 3.0
+    for worker in batcher._workers:
+        worker.join(timeout=5)
+        assert not worker.is_alive()
+    with raises(ModelUnloadedError):
+        asyncio.run(batcher.encode_text("abc"))
@@ -0,0 +1,142 @@
+from datetime import datetime
+
+import numpy as np
+from pytest import mark, raises
+from pytest_mock import MockerFixture
+
+from app.repository.cache import (
+    ENTRY_OVERHEAD_BYTES,
+    EmbeddingCache,
+    LRUCache,
+    SearchResultCache,
+    embedding_key,
+)
+from app.repository.pgvector import VectorRecord
+
+
+def make_cache(entries: int, ttl_seconds=None) -> LRUCache[bytes]:
+    return LRUCache(
+        max_bytes=entries * (10 + ENTRY_OVERHEAD_BYTES),
+        sizeof=len,
+        ttl_seconds=ttl_seconds,
+    )
+
+
+@mark.ut
+def test_lru_cache_evicts_least_recently_used():
+    # given
+    cache = make_cache(entries=2)
+    cache.put("a", b"0123456789")
+    cache.put("b", b"0123456789")
+    cache.get("a")
+    # when
+    cache.put("c", b"0123456789")
+    # then
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    stats = cache.stats()
+    assert stats.entries == 2
+    assert stats.evictions == 1
+    assert stats.bytes <= stats.max_bytes
+
+
+@mark.ut
+def test_lru_cache_counts_hits_and_misses():
+    # given
+    cache = make_cache(entries=2)
+    cache.put("a", b"0123456789")
+    # when
+    cache.get("a")
+    cache.get("a")
+    cache.get("missing")
+    # then
+    stats = cache.stats()
+    assert stats.hits == 2
+    assert stats.misses == 1
+
+
+@mark.ut
+def test_lru_cache_skips_values_larger_than_budget():
+    # given
+    cache = make_cache(entries=1)
+    # when
+    cache.put("a", b"0" * 1000)
+    # then
+    assert cache.get("a") is None
+    assert cache.stats().bytes == 0
+
+
+@mark.ut
+def test_lru_cache_expires_entries(mocker: MockerFixture):
+    # given
+    monotonic = mocker.patch("app.repository.cache.time.monotonic", return_value=0)
+    cache = make_cache(entries=2, ttl_seconds=10)
+    cache.put("a", b"0123456789")
+    # when
+    monotonic.return_value = 11
+    # then
+    assert cache.get("a") is None
+    assert cache.stats().entries == 0
+
+
+@mark.ut
+def test_embedding_key_normalizes_text():
+    assert embedding_key("m", " ｶﾞ") != embedding_key("m", "ガ")
+    assert embedding_key("m", "が") == embedding_key("m", "が ")
+    assert embedding_key("m", "text") != embedding_key("other", "text")
+
+
+@mark.ut
+def test_embedding_cache_returns_read_only_rows():
+    # given
+    cache = EmbeddingCache("model", max_bytes=1024 * 1024)
+    embeddings = np.array([[0.1, 0.2], [0.3, 0.4]], dtype=np.float32)
+    # when
+    cache.put_many(["a", "b"], embeddings)
+    a, missing, b = cache.get_many(["a", "c", "b"])
+    # then
+    assert missing is None
+    assert np.array_equal(a, embeddings[0])
+    assert np.array_equal(b, embeddings[1])
+    with raises(ValueError):
+        a[0] = 1.0
+
+
+@mark.ut
+def test_search_result_cache_key_depends_on_generation_and_request():
+    # given
+    cache = SearchResultCache("model", max_bytes=1024 * 1024)
+    request = {"query": "牡羊座", "category": None, "limit": 10}
+    # then
+    assert cache.key(request, 0) == cache.key({**request, "query": " 牡羊座 "}, 0)
+    assert cache.key(request, 0) != cache.key(request, 1)
+    assert cache.key(request, 0) != cache.key({**request, "limit": 5}, 0)
+    assert cache.key(request, 0) != SearchResultCache("other", max_bytes=1024).key(
+        request, 0
+    )
+
+
+@mark.ut
+def test_search_result_cache_is_bounded_by_bytes():
+    # given
+    record = VectorRecord(
+        id=1,
+        category="c",
+        title="t",
+        text="x" * 1000,
+        vector_score=0.5,
+        text_score=0.5,
+        hibrid_score=0.5,
+        created_at=datetime(2024, 1, 1),
+    )
+    cache = SearchResultCache("model", max_bytes=4096)
+    # when
+    for generation in range(5):
+        cache.put(cache.key({"query": "q"}, generation), [record, record])
+    # then
+    stats = cache.stats()
+    assert stats.bytes <= 4096
+    assert stats.evictions > 0
+    assert cache.get(cache.key({"query": "q"}, 4)) == [record, record]
+    assert cache.get(cache.key({"query": "q"}, 0)) is None
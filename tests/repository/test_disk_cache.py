@@ -0,0 +1,126 @@
+import itertools
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+from pytest import MonkeyPatch, mark
+
+from app.repository.cache import EmbeddingCache, embedding_key
+from app.repository.disk_cache import DiskEmbeddingCache
+
+
+@mark.ut
+def test_disk_cache_survives_reopen(tmp_path: Path):
+    # given
+    path = str(tmp_path / "embeddings.sqlite")
+    keys = [embedding_key("model", "a"), embedding_key("model", "b")]
+    embeddings = np.array([[0.1, 0.2], [0.3, 0.4]], dtype=np.float32)
+    cache = DiskEmbeddingCache(path, "model")
+    cache.put_many(keys, embeddings)
+    cache.close()
+    # when
+    found = DiskEmbeddingCache(path, "model").get_many(
+        keys + [embedding_key("model", "c")]
+    )
+    # then
+    assert set(found) == set(keys)
+    assert np.array_equal(found[keys[0]], embeddings[0])
+    assert np.array_equal(found[keys[1]], embeddings[1])
+
+
+@mark.ut
+def test_disk_cache_is_shared_between_instances(tmp_path: Path):
+    # given
+    path = str(tmp_path / "embeddings.sqlite")
+    writer = DiskEmbeddingCache(path, "model")
+    reader = DiskEmbeddingCache(path, "model")
+    key = embedding_key("model", "a")
+    # when
+    writer.put_many([key], np.array([[1.0, 2.0]], dtype=np.float32))
+    # then
+    assert np.array_equal(reader.get_many([key])[key], [1.0, 2.0])
+    assert reader.count() == 1
+
+
+@mark.ut
+def test_disk_cache_evicts_least_recently_accessed_rows(
+    tmp_path: Path, monkeypatch: MonkeyPatch
+):
+    # given
+    clock = itertools.count(1)
+    monkeypatch.setattr("app.repository.disk_cache.time.time", lambda: next(clock))
+    cache = DiskEmbeddingCache(str(tmp_path / "embeddings.sqlite"), "model", max_rows=2)
+    keys = [embedding_key("model", text) for text in "abc"]
+    vector = np.array([[1.0, 2.0]], dtype=np.float32)
+    cache.put_many(keys[:1], vector)
+    cache.put_many(keys[1:2], vector)
+    # 最初の行を参照しておく
+    cache.get_many(keys[:1])
+    cache.put_many(keys[2:], vector)
+    # when
+    cache.prune()
+    # then
+    assert cache.count() == 2
+    assert set(cache.get_many(keys)) == {keys[0], keys[2]}
+
+
+@mark.ut
+def test_disk_cache_skips_and_deletes_expired_rows(tmp_path: Path):
+    # given
+    cache = DiskEmbeddingCache(
+        str(tmp_path / "embeddings.sqlite"), "model", ttl_seconds=-1
+    )
+    key = embedding_key("model", "a")
+    cache.put_many([key], np.array([[1.0, 2.0]], dtype=np.float32))
+    # when
+    found = cache.get_many([key])
+    cache.prune()
+    # then
+    assert found == {}
+    assert cache.count() == 0
+
+
+@mark.ut
+def test_disk_cache_migrates_file_without_accessed_at(tmp_path: Path):
+    # given
+    path = str(tmp_path / "embeddings.sqlite")
+    key = embedding_key("model", "a")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE embeddings (key BLOB PRIMARY KEY, model TEXT NOT NULL, "
+        "dim INTEGER NOT NULL, vector BLOB NOT NULL, created_at REAL NOT NULL) "
+        "WITHOUT ROWID;"
+    )
+    conn.execute(
+        "INSERT INTO embeddings VALUES (?, 'model', 2, ?, 1.0);",
+        (key, np.array([1.0, 2.0], dtype="<f4").tobytes()),
+    )
+    conn.commit()
+    conn.close()
+    # when
+    cache = DiskEmbeddingCache(path, "model", max_rows=10)
+    # then
+    assert np.array_equal(cache.get_many([key])[key], [1.0, 2.0])
+
+
+@mark.ut
+def test_embedding_cache_falls_back_to_disk(tmp_path: Path):
+    # given
+    path = str(tmp_path / "embeddings.sqlite")
+    embeddings = np.array([[0.1, 0.2]], dtype=np.float32)
+    EmbeddingCache(
+        "model", max_bytes=1024 * 1024, disk=DiskEmbeddingCache(path, "model")
+    ).put_many(["a"], embeddings)
+    cache = EmbeddingCache(
+        "model", max_bytes=1024 * 1024, disk=DiskEmbeddingCache(path, "model")
+    )
+    # when
+    first, missing = cache.get_many(["a", "b"])
+    (second,) = cache.get_many(["a"])
+    # then
+    assert np.array_equal(first, embeddings[0])
+    assert missing is None
+    assert np.array_equal(second, embeddings[0])
+    stats = cache.stats()
+    assert stats.disk_hits == 1
+    assert stats.hits == 1
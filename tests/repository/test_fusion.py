@@ -0,0 +1,36 @@
+from pytest import approx, mark
+
+from app.repository.fusion import FusionParams, fuse, rank
+
+
+@mark.ut
+def test_rank():
+    assert rank([0.2, None, 0.9, 0.5]) == [3, None, 1, 2]
+
+
+@mark.ut
+def test_fuse_linear():
+    # when
+    scores = fuse([0.8, None], [0.5, 1.0], FusionParams())
+    # then
+    assert scores == approx([0.8 * 0.7 + 0.5 * 0.3, 0.3])
+
+
+@mark.ut
+def test_fuse_rrf():
+    # given
+    params = FusionParams(strategy="rrf", vector_weight=1.0, text_weight=1.0, rrf_k=10)
+    # when
+    scores = fuse([0.9, 0.1, None], [None, 0.8, 0.9], params)
+    # then
+    assert scores == approx([1 / 11, 1 / 12 + 1 / 12, 1 / 11])
+
+
+@mark.ut
+def test_fuse_max():
+    # given
+    params = FusionParams(strategy="max", vector_weight=1.0, text_weight=0.5)
+    # when
+    scores = fuse([0.4, None], [1.0, 0.6], params)
+    # then
+    assert scores == approx([0.5, 0.3])
@@ -0,0 +1,274 @@
+import math
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from pytest import fixture, mark, raises
+from testcontainers.postgres import PostgresContainer
+
+from app.repository.memory import (
+    InMemoryVectorRepository,
+    UnsupportedSearchError,
+    trigrams,
+    word_similarity,
+)
+from app.repository.pgvector import (
+    InsertBatch,
+    InsertVector,
+    PgVectorRepository,
+    SearchQuery,
+)
+
+
+@fixture(scope="function")
+def pgvector():
+    container = PostgresContainer("pgvector/pgvector:pg17")
+    container.start()
+    connection_string = container.get_connection_url(driver=None)
+    yield connection_string
+    container.stop()
+
+
+@fixture(scope="module")
+def dummy_data() -> List[InsertVector]:
+    names = ["牡羊座", "金牛座", "双子座", "蟹座", "獅子座", "乙女座"]
+    names += ["天秤座", "蠍座", "射手座", "山羊座", "水瓶座", "魚座"]
+    data = []
+    for i, name in enumerate(names):
+        radian = math.radians(i * 30)
+        data.append(
+            InsertVector(
+                category="前半" if i < 6 else "後半",
+                title=f"星座：{name}",
+                text=f"{name}の説明。アンタレス" if name == "蠍座" else f"{name}の説明",
+                embedding=[math.cos(radian), math.sin(radian)],
+            )
+        )
+    return data
+
+
+def random_batch(rows: int, dim: int, seed: int) -> InsertBatch:
+    rng = np.random.default_rng(seed)
+    words = ["alpha", "beta", "gamma", "delta", "omega", "vector", "search", "index"]
+    return InsertBatch(
+        categories=[f"c{i % 3}" for i in range(rows)],
+        titles=[" ".join(rng.choice(words, 2)) for _ in range(rows)],
+        texts=[" ".join(rng.choice(words, 6)) for _ in range(rows)],
+        embeddings=rng.normal(size=(rows, dim)).astype(np.float32),
+    )
+
+
+@mark.ut
+def test_trigrams():
+    # when
+    result = trigrams("Cat, dog")
+    # then
+    assert result == {"  c", " ca", "cat", "at ", "  d", " do", "dog", "og "}
+
+
+@mark.ut
+@mark.parametrize(
+    "query, text, expected",
+    [
+        ("word", "two words", 0.8),
+        ("word", "word", 1.0),
+        ("cat", "dog", 0.0),
+    ],
+)
+def test_word_similarity(query: str, text: str, expected: float):
+    # when
+    result = word_similarity(trigrams(query), text)
+    # then
+    assert math.isclose(result, expected)
+
+
+@mark.ut
+@mark.parametrize(
+    "embedding, query, category, expected_title",
+    [
+        ([1.0, 0.0], "関係ないクエリ", "前半", "星座：牡羊座"),
+        ([1.0, 0.0], "関係ないクエリ", None, "星座：牡羊座"),
+        ([0.0, 0.0], "獅子座", "前半", "星座：獅子座"),
+        ([0.0, 0.0], "獅子座", None, "星座：獅子座"),
+        ([0.0, 0.0], "アンタレス", "後半", "星座：蠍座"),
+        ([0.0, 0.0], "アンタレス", "前半", None),
+    ],
+)
+def test_hybrid_search(
+    dummy_data: List[InsertVector],
+    embedding: List[float],
+    query: str,
+    category: str,
+    expected_title: str,
+):
+    # given
+    repo = InMemoryVectorRepository(vector_dim=2)
+    repo.copy(dummy_data)
+    # when
+    results = repo.hybrid_search(
+        embedding=embedding, query=query, category=category, limit=5
+    )
+    # then
+    assert len(results) <= 5
+    assert all(category is None or r.category == category for r in results)
+    if expected_title is None:
+        assert results == []
+    else:
+        assert results[0].title == expected_title
+        assert (
+            results[0].id
+            == dummy_data.index(
+                next(d for d in dummy_data if d.title == expected_title)
+            )
+            + 1
+        )
+
+
+@mark.ut
+def test_hybrid_search_batch_matches_single_search(dummy_data: List[InsertVector]):
+    # given
+    repo = InMemoryVectorRepository(vector_dim=2)
+    repo.copy(dummy_data)
+    queries = [
+        SearchQuery(embedding=[1.0, 0.0], query="関係ないクエリ", limit=2),
+        SearchQuery(embedding=[0.0, 1.0], query="獅子座", category="前半"),
+        SearchQuery(embedding=[0.0, 0.0], query="座", max_distance=None),
+    ]
+    # when
+    results = repo.hybrid_search_batch(queries)
+    # then
+    assert len(results[0]) == 2
+    assert results[0][0].vector_score == 1.0
+    for query, records in zip(queries, results):
+        assert records == repo.hybrid_search(**query.model_dump())
+
+
+@mark.ut
+def test_hybrid_search_rejects_chunk_aggregation(dummy_data: List[InsertVector]):
+    # given
+    repo = InMemoryVectorRepository(vector_dim=2)
+    repo.copy(dummy_data)
+    # when / then
+    with raises(UnsupportedSearchError):
+        repo.hybrid_search(embedding=[1.0, 0.0], query="", chunk_aggregation="max")
+
+
+@mark.ut
+def test_copy_grows_storage_and_bumps_generation():
+    # given
+    repo = InMemoryVectorRepository(vector_dim=8)
+    # when
+    for seed in range(3):
+        repo.copy_batch(random_batch(700, 8, seed))
+    # then
+    assert repo.generation == 3
+    results = repo.hybrid_search(
+        embedding=random_batch(700, 8, 2).embeddings[-1],
+        query="zzz",
+        limit=1,
+        max_distance=None,
+    )
+    assert results[0].id == 2100
+
+
+@mark.ut
+def test_snapshot_and_load(tmp_path: Path, dummy_data: List[InsertVector]):
+    # given
+    repo = InMemoryVectorRepository(vector_dim=2, snapshot_dir=str(tmp_path))
+    repo.copy(dummy_data)
+    expected = repo.hybrid_search(embedding=[0.0, 1.0], query="獅子座")
+    # when
+    rows = repo.snapshot()
+    loaded = InMemoryVectorRepository.load(str(tmp_path), vector_dim=2)
+    # then
+    assert rows == {"embeddings": 12}
+    assert (tmp_path / "embeddings" / "embeddings.npy").exists()
+    assert loaded.hybrid_search(embedding=[0.0, 1.0], query="獅子座") == expected
+    # 読み込んだ後も挿入できる
+    loaded.copy(dummy_data[:1])
+    results = loaded.hybrid_search(embedding=[1.0, 0.0], query="", limit=2)
+    assert [r.id for r in results] == [1, 13]
+
+
+@mark.ut
+def test_snapshot_saves_every_table(tmp_path: Path, dummy_data: List[InsertVector]):
+    # given
+    repo = InMemoryVectorRepository(vector_dim=2, snapshot_dir=str(tmp_path))
+    repo.copy(dummy_data)
+    other = repo.for_table("embeddings_other", 3)
+    other.copy_batch(random_batch(5, 3, 0))
+    # when
+    rows = other.snapshot()
+    loaded = InMemoryVectorRepository.load(str(tmp_path), vector_dim=2)
+    # then
+    assert rows == {"embeddings": 12, "embeddings_other": 5}
+    results = loaded.for_table("embeddings_other", 3).hybrid_search(
+        [0.0, 0.0, 0.0], "", limit=20
+    )
+    assert len(results) == 5
+
+
+@mark.ut
+def test_for_table_keeps_tables_separate(dummy_data: List[InsertVector]):
+    # given
+    repo = InMemoryVectorRepository(vector_dim=2)
+    repo.copy(dummy_data)
+    # when
+    other = repo.for_table("embeddings_other", 3)
+    other.copy_batch(random_batch(5, 3, 0))
+    # then
+    assert repo.for_table("embeddings_other", 3) is other
+    assert other.for_table("embeddings", 2) is repo
+    assert len(repo.hybrid_search([0.0, 0.0], "説明", limit=20)) == 12
+    assert len(other.hybrid_search([0.0, 0.0, 0.0], "", limit=20)) == 5
+
+
+@mark.ut
+def test_results_match_exact_pgvector_search(pgvector: str):
+    # given
+    batch = random_batch(300, 16, 0)
+    separator = "&" if "?" in pgvector else "?"
+    # インデックスを使わない厳密な検索と比べる
+    exact = PgVectorRepository(
+        f"{pgvector}{separator}options=-c%20enable_indexscan%3Doff"
+        "%20-c%20enable_bitmapscan%3Doff"
+    )
+    exact.create_table(vector_dim=16)
+    exact.copy_batch(batch)
+    memory = InMemoryVectorRepository(vector_dim=16)
+    memory.copy_batch(batch)
+    queries = [
+        SearchQuery(
+            embedding=embedding,
+            query=query,
+            category=category,
+            limit=20,
+            vector_candidates=30,
+            text_candidates=300,
+            max_distance=max_distance,
+        )
+        for embedding, query, category, max_distance in zip(
+            random_batch(5, 16, 1).embeddings,
+            ["nothing", "gamma delta", "vector", "omega", "gamm delt"],
+            [None, "c1", None, "c2", None],
+            [None, 0.9, 0.5, None, 0.1],
+        )
+    ]
+    # when
+    expected = exact.hybrid_search_batch(queries)
+    actual = memory.hybrid_search_batch(queries)
+    # then
+    exact.close()
+    for expected_records, actual_records in zip(expected, actual):
+        # 同点の並びは実装によって異なるため、スコアの並びと共通する文書のスコアを比べる
+        assert np.allclose(
+            [r.hibrid_score for r in actual_records],
+            [r.hibrid_score for r in expected_records],
+            atol=1e-5,
+        )
+        expected_scores = {r.id: r for r in expected_records}
+        for a in actual_records:
+            e = expected_scores.get(a.id)
+            if e is not None:
+                assert math.isclose(a.vector_score, e.vector_score, abs_tol=1e-5)
+                assert math.isclose(a.text_score, e.text_score, abs_tol=1e-5)
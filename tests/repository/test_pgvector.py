@@ -1,10 +1,24 @@
 import math
 from typing import List
 
+import numpy as np
+import psycopg
 from pytest import fixture, mark
 from testcontainers.postgres import PostgresContainer
 
-from app.repository.pgvector import InsertVector, PgVectorRepository, VectorRecord
+from app.profiling import ActiveProfile, _active
+from app.repository.fusion import FusionParams
+from app.repository.pgvector import (
+    ChunkBatch,
+    InsertBatch,
+    InsertVector,
+    PgVectorRepository,
+    PoolStats,
+    SearchQuery,
+    VectorIndexConfig,
+    VectorRecord,
+    ivfflat_lists,
+)
 
 
 @fixture(scope="function")
@@ -93,7 +107,7 @@ def test_create_table(pgvector: str):
     # when
     repo.create_table(vector_dim=2)
     # then
-    with repo.conn.cursor() as cursor:
+    with repo.pool.connection() as conn, conn.cursor() as cursor:
         cursor.execute("SELECT to_regclass('embeddings');")
         result = cursor.fetchone()
         assert result[0] == "embeddings"
@@ -169,7 +183,421 @@ def test_insert(pgvector: str, dummy_data: List[InsertVector]):
     repo.copy(dummy_data)
 
     # then
-    with repo.conn.cursor() as cursor:
+    with repo.pool.connection() as conn, conn.cursor() as cursor:
         cursor.execute("SELECT COUNT(*) FROM embeddings;")
         count = cursor.fetchone()[0]
         assert count == len(dummy_data)
+    assert repo.generation == 1
+
+
+@mark.ut
+@mark.parametrize("copy_format", ["binary", "text"])
+def test_copy_batch(pgvector: str, dummy_data: List[InsertVector], copy_format: str):
+    # given
+    repo = PgVectorRepository(pgvector)
+    repo.create_table(vector_dim=2)
+    batch = InsertBatch.from_items(dummy_data)
+
+    # when
+    repo.copy_batch(batch, copy_format=copy_format)
+
+    # then
+    with repo.pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT category, title, text, embedding::real[] FROM embeddings;"
+        )
+        rows = cursor.fetchall()
+    assert [row[1] for row in rows] == batch.titles
+    assert [row[0] for row in rows] == batch.categories
+    assert [row[2] for row in rows] == batch.texts
+    assert np.allclose(np.array([row[3] for row in rows]), batch.embeddings)
+    repo.close()
+
+
+@mark.ut
+def test_pool_stats(pgvector: str, dummy_data: List[InsertVector]):
+    # given
+    repo = PgVectorRepository(pgvector, min_size=1, max_size=2)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+
+    # when
+    stats: PoolStats = repo.pool_stats()
+
+    # then
+    assert stats.size >= 1
+    assert stats.in_use == 0
+    assert stats.requests >= 2
+    repo.close()
+
+
+@mark.ut
+def test_connection_is_recovered_after_termination(
+    pgvector: str, dummy_data: List[InsertVector]
+):
+    # given
+    repo = PgVectorRepository(pgvector, min_size=1, max_size=1)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+    with repo.pool.connection() as conn:
+        pid = conn.info.backend_pid
+    with psycopg.connect(pgvector, autocommit=True) as conn:
+        conn.execute("SELECT pg_terminate_backend(%s);", (pid,))
+
+    # when
+    results = repo.hybrid_search(embedding=[1.0, 0.0], query="牡羊座", limit=1)
+
+    # then
+    assert len(results) == 1
+    repo.close()
+
+
+def embedding_index_definition(repo: PgVectorRepository) -> str:
+    with repo.pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE indexname = 'idx_documents_embedding';"
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+@mark.ut
+def test_create_table_with_hnsw_index(pgvector: str):
+    # given
+    repo = PgVectorRepository(
+        pgvector, index_config=VectorIndexConfig(hnsw_m=8, hnsw_ef_construction=32)
+    )
+    # when
+    repo.create_table(vector_dim=2)
+    # then
+    definition = embedding_index_definition(repo)
+    assert "USING hnsw" in definition
+    assert "m='8'" in definition
+    assert "ef_construction='32'" in definition
+    repo.close()
+
+
+@mark.ut
+def test_ivfflat_index_is_built_by_reindex(
+    pgvector: str, dummy_data: List[InsertVector]
+):
+    # given
+    repo = PgVectorRepository(
+        pgvector, index_config=VectorIndexConfig(index_type="ivfflat")
+    )
+    repo.create_table(vector_dim=2)
+    assert embedding_index_definition(repo) is None
+    repo.copy(dummy_data)
+    # when
+    result = repo.reindex()
+    # then
+    assert result.index_type == "ivfflat"
+    assert result.rows == len(dummy_data)
+    assert result.lists == 1
+    assert "USING ivfflat" in embedding_index_definition(repo)
+    repo.close()
+
+
+@mark.ut
+def test_reindex_bumps_generation(pgvector: str, dummy_data: List[InsertVector]):
+    # given
+    repo = PgVectorRepository(pgvector)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+    # when
+    repo.reindex()
+    # then
+    assert repo.generation == 2
+    repo.close()
+
+
+@mark.ut
+@mark.parametrize(
+    "rows, expected",
+    [(0, 1), (50_000, 50), (1_000_000, 1000), (4_000_000, 2000)],
+)
+def test_ivfflat_lists(rows: int, expected: int):
+    assert ivfflat_lists(rows) == expected
+
+
+@mark.ut
+def test_hybrid_search_with_ef_search(pgvector: str, dummy_data: List[InsertVector]):
+    # given
+    repo = PgVectorRepository(pgvector, ef_search=100)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+    # when
+    results = repo.hybrid_search(
+        embedding=[1.0, 0.0], query="牡羊座", limit=3, ef_search=200, probes=5
+    )
+    # then
+    assert results[0].title.startswith("星座：牡羊座")
+    with repo.pool.connection() as conn, conn.cursor() as cursor:
+        # SET LOCAL 相当のため、プールに戻った接続には残らない
+        cursor.execute("SHOW hnsw.ef_search;")
+        assert cursor.fetchone()[0] == "40"
+    repo.close()
+
+
+@mark.ut
+def test_hybrid_search_text_branch_uses_trigram_indexes(pgvector: str):
+    # given
+    # 小さなテーブルではコスト上シーケンシャルスキャンが選ばれるため、
+    # インデックスで実行可能なプランが存在するかを検証する
+    separator = "&" if "?" in pgvector else "?"
+    repo = PgVectorRepository(f"{pgvector}{separator}options=-c%20enable_seqscan%3Doff")
+    repo.create_table(vector_dim=2)
+    rng = np.random.default_rng(0)
+    count = 2000
+    repo.copy_batch(
+        InsertBatch(
+            categories=["前半" if i % 2 else "後半" for i in range(count)],
+            titles=[f"タイトル{i}" for i in range(count)],
+            texts=[f"文書{i}の本文テキスト" for i in range(count)],
+            embeddings=rng.standard_normal((count, 2)),
+        )
+    )
+    with repo.pool.connection() as conn:
+        conn.execute("ANALYZE embeddings;")
+
+    # when
+    plan = repo.explain_hybrid_search(
+        SearchQuery(embedding=[1.0, 0.0], query="タイトル1234", category="前半")
+    )
+
+    # then
+    # テキスト検索がテーブル全体を走査せず、トライグラムインデックスで絞り込まれていること
+    assert "Seq Scan on embeddings" not in plan
+    assert "idx_documents_title_trgm" in plan
+    assert "idx_documents_text_trgm" in plan
+    repo.close()
+
+
+@mark.ut
+@mark.parametrize("strategy", ["linear", "rrf", "max"])
+def test_hybrid_search_with_fusion_strategy(
+    pgvector: str, dummy_data: List[InsertVector], strategy: str
+):
+    # given
+    repo = PgVectorRepository(pgvector)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+    # when
+    results = repo.hybrid_search(
+        embedding=[0.0, 1.0],
+        query="獅子座",
+        limit=3,
+        vector_candidates=5,
+        text_candidates=5,
+        max_distance=None,
+        fusion=FusionParams(strategy=strategy, vector_weight=0.0, text_weight=1.0),
+    )
+    # then
+    assert len(results) == 3
+    assert results[0].title.startswith("星座：獅子座")
+    assert [r.hibrid_score for r in results] == sorted(
+        [r.hibrid_score for r in results], reverse=True
+    )
+    repo.close()
+
+
+@mark.ut
+def test_hybrid_search_batch(pgvector: str, dummy_data: List[InsertVector]):
+    # given
+    repo = PgVectorRepository(pgvector)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+    queries = [
+        SearchQuery(embedding=[1.0, 0.0], query="関係ないクエリ", limit=2),
+        SearchQuery(
+            embedding=[0.0, 0.0], query="獅子座", category="前半", ef_search=80
+        ),
+        SearchQuery(embedding=[0.0, 0.0], query="獅子座", category="後半"),
+    ]
+
+    # when
+    results = repo.hybrid_search_batch(queries)
+
+    # then
+    assert len(results) == 3
+    assert len(results[0]) <= 2
+    assert results[0][0].title.startswith("星座：牡羊座")
+    assert results[1][0].title.startswith("星座：獅子座")
+    assert all(r.category == "後半" for r in results[2])
+    for query, records in zip(queries, results):
+        assert records == repo.hybrid_search(**query.model_dump())
+    repo.close()
+
+
+@mark.ut
+@mark.parametrize("quantization", ["halfvec", "binary"])
+def test_hybrid_search_with_quantized_index(
+    pgvector: str, dummy_data: List[InsertVector], quantization: str
+):
+    # given
+    separator = "&" if "?" in pgvector else "?"
+    repo = PgVectorRepository(
+        f"{pgvector}{separator}options=-c%20enable_seqscan%3Doff",
+        index_config=VectorIndexConfig(quantization=quantization),
+    )
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+    search = SearchQuery(embedding=[1.0, 0.0], query="関係ないクエリ", limit=3)
+
+    # when
+    results = repo.hybrid_search_batch([search])[0]
+    plan = repo.explain_hybrid_search(search)
+
+    # then
+    # 量子化インデックスで候補を取得し、float32のベクトルで再スコアリングしていること
+    assert results[0].title.startswith("星座：牡羊座")
+    assert results[0].vector_score == 1.0
+    assert "idx_documents_embedding" in plan
+    definition = embedding_index_definition(repo)
+    if quantization == "halfvec":
+        assert "halfvec_cosine_ops" in definition
+    else:
+        assert "bit_hamming_ops" in definition
+    repo.close()
+
+
+@mark.ut
+@mark.parametrize(
+    "chunk_aggregation, expected_titles, expected_scores",
+    [
+        ("max", ["短い文書", "長い文書"], [0.8, 0.6]),
+        ("sum", ["長い文書", "短い文書"], [1.2, 0.8]),
+    ],
+)
+def test_hybrid_search_with_chunk_aggregation(
+    pgvector: str,
+    chunk_aggregation: str,
+    expected_titles: List[str],
+    expected_scores: List[float],
+):
+    # given
+    repo = PgVectorRepository(pgvector)
+    repo.create_table(vector_dim=2)
+    batch = InsertBatch(
+        categories=["cat", "cat"],
+        titles=["長い文書", "短い文書"],
+        texts=["前半 後半", "本文"],
+        embeddings=[[1.0, 0.0], [0.8, 0.6]],
+        chunks=ChunkBatch(
+            documents=[0, 0, 1],
+            positions=[0, 1, 0],
+            texts=["前半", "後半", "本文"],
+            embeddings=[[0.6, 0.8], [0.6, -0.8], [0.8, 0.6]],
+        ),
+    )
+    repo.copy_batch(batch)
+
+    # when
+    results = repo.hybrid_search(
+        embedding=[1.0, 0.0],
+        query="関係ないクエリ",
+        max_distance=None,
+        chunk_aggregation=chunk_aggregation,
+    )
+
+    # then
+    assert [r.title for r in results] == expected_titles
+    assert np.allclose([r.vector_score for r in results], expected_scores)
+    assert repo.generation == 1
+    with repo.pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT d.title, c.position, c.category, c.text FROM embeddings_chunks c "
+            "JOIN embeddings d ON d.id = c.document_id ORDER BY c.id;"
+        )
+        assert cursor.fetchall() == [
+            ("長い文書", 0, "cat", "前半"),
+            ("長い文書", 1, "cat", "後半"),
+            ("短い文書", 0, "cat", "本文"),
+        ]
+    repo.close()
+
+
+@mark.ut
+def test_for_table(pgvector: str, dummy_data: List[InsertVector]):
+    # given
+    repo = PgVectorRepository(pgvector)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+
+    # when
+    other = repo.for_table("embeddings_other", 3)
+    other.copy_batch(
+        InsertBatch(
+            categories=["cat"],
+            titles=["三次元"],
+            texts=["別のモデルの文書"],
+            embeddings=[[0.0, 0.0, 1.0]],
+        )
+    )
+
+    # then
+    assert repo.for_table("embeddings_other", 3) is other
+    assert repo.for_table("embeddings", 2) is repo
+    assert other.pool is repo.pool
+    assert (repo.generation, other.generation) == (1, 1)
+    results = other.hybrid_search(embedding=[0.0, 0.0, 1.0], query="関係ないクエリ")
+    assert [r.title for r in results] == ["三次元"]
+    with repo.pool.connection() as conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes "
+            "WHERE tablename IN ('embeddings_other', 'embeddings_other_chunks');"
+        )
+        assert {row[0] for row in cursor.fetchall()} >= {
+            "idx_embeddings_other_embedding",
+            "idx_embeddings_other_text_trgm",
+            "idx_embeddings_other_chunks_embedding",
+        }
+    repo.close()
+
+
+@mark.ut
+def test_vector_search_batch(pgvector: str, dummy_data: List[InsertVector]):
+    # given
+    repo = PgVectorRepository(pgvector)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+    queries = [
+        SearchQuery(embedding=[1.0, 0.0], query="獅子座", vector_candidates=3),
+        SearchQuery(embedding=[0.0, 1.0], query="", category="後半"),
+    ]
+
+    # when
+    results = repo.vector_search_batch(queries)
+
+    # then
+    assert results[0][0][0] == 1
+    assert {id for id, _ in results[0]} == {1, 2, 12}
+    assert math.isclose(results[0][0][1], 1.0, abs_tol=1e-6)
+    assert {id for id, _ in results[1]} <= set(range(7, 13))
+    assert all(score > 0.5 for _, score in results[1])
+    repo.close()
+
+
+@mark.ut
+def test_hybrid_search_batch_defers_explain_for_active_profile(
+    pgvector: str, dummy_data: List[InsertVector]
+):
+    # given
+    repo = PgVectorRepository(pgvector)
+    repo.create_table(vector_dim=2)
+    repo.copy(dummy_data)
+    profile = ActiveProfile()
+    token = _active.set(profile)
+    # when
+    try:
+        repo.hybrid_search_batch(
+            [SearchQuery(embedding=[1.0, 0.0], query="獅子座", limit=2)]
+        )
+    finally:
+        _active.reset(token)
+    repo.hybrid_search(embedding=[1.0, 0.0], query="獅子座")
+    # then
+    assert len(profile.explains) == 1
+    plan = profile.explains[0]()
+    assert "actual time" in plan
+    repo.close()
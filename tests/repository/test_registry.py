@@ -0,0 +1,121 @@
+from typing import Dict
+from unittest.mock import Mock
+
+from pytest import fixture, mark, raises
+from pytest_mock import MockerFixture
+
+from app.repository.batcher import EmbeddingBatcher
+from app.repository.registry import (
+    ModelRegistry,
+    UnknownModelError,
+    model_table_name,
+)
+
+MODEL_BYTES = {"default": 100, "a": 60, "b": 50, "c": 40}
+
+
+@fixture
+def batchers(mocker: MockerFixture) -> Dict[str, Mock]:
+    batchers = {}
+    for model_name, size in MODEL_BYTES.items():
+        batcher: Mock = mocker.create_autospec(spec=EmbeddingBatcher)
+        batcher.repository = Mock()
+        batcher.repository.memory_bytes.return_value = size
+        batchers[model_name] = batcher
+    return batchers
+
+
+@fixture
+def factory(batchers: Dict[str, Mock]) -> Mock:
+    return Mock(side_effect=lambda model_name: batchers[model_name])
+
+
+def make_registry(batchers: Dict[str, Mock], factory: Mock) -> ModelRegistry:
+    return ModelRegistry(
+        "default",
+        batchers["default"],
+        factory=factory,
+        model_names=["default", "a", "b", "c"],
+        max_bytes=120,
+    )
+
+
+@mark.ut
+def test_default_model_is_not_loaded_by_registry(
+    batchers: Dict[str, Mock], factory: Mock
+):
+    # given
+    registry = make_registry(batchers, factory)
+    # when / then
+    assert registry.get(None) is batchers["default"]
+    assert registry.get("default") is batchers["default"]
+    factory.assert_not_called()
+
+
+@mark.ut
+def test_models_are_loaded_lazily_once(batchers: Dict[str, Mock], factory: Mock):
+    # given
+    registry = make_registry(batchers, factory)
+    # when
+    first = registry.get("a")
+    second = registry.get("a")
+    # then
+    assert first is second is batchers["a"]
+    factory.assert_called_once_with("a")
+
+
+@mark.ut
+def test_least_recently_used_model_is_evicted(batchers: Dict[str, Mock], factory: Mock):
+    # given
+    registry = make_registry(batchers, factory)
+    registry.get("a")
+    registry.get("c")
+    registry.get("a")
+    # when
+    registry.get("b")
+    # then
+    # a(60) + c(40) + b(50) が上限の120を超えるため、最も古く使われた c を解放する
+    stats = registry.stats()
+    assert [m.model_name for m in stats.models] == ["default", "a", "b"]
+    assert stats.bytes == 110
+    assert stats.evictions == 1
+    batchers["c"].close.assert_called_once()
+    batchers["a"].close.assert_not_called()
+    registry.get("c")
+    assert [m.model_name for m in registry.stats().models] == ["default", "b", "c"]
+    assert registry.stats().loads == 4
+
+
+@mark.ut
+def test_unknown_model_is_rejected(batchers: Dict[str, Mock], factory: Mock):
+    # given
+    registry = make_registry(batchers, factory)
+    # when / then
+    with raises(UnknownModelError):
+        registry.get("unknown")
+    factory.assert_not_called()
+
+
+@mark.ut
+def test_model_table_name():
+    assert (
+        model_table_name("intfloat/multilingual-e5-large")
+        == "embeddings_multilingual_e5_large"
+    )
+    assert (
+        model_table_name("sentence-transformers/all-MiniLM-L6-v2")
+        == "embeddings_all_minilm_l6_v2"
+    )
+
+
+@mark.ut
+def test_model_larger_than_budget_is_kept(batchers: Dict[str, Mock], factory: Mock):
+    # given
+    batchers["a"].repository.memory_bytes.return_value = 500
+    registry = make_registry(batchers, factory)
+    registry.get("b")
+    # when
+    registry.get("a")
+    # then
+    assert [m.model_name for m in registry.stats().models] == ["default", "a"]
+    batchers["b"].close.assert_called_once()
@@ -0,0 +1,311 @@
+import sys
+from pathlib import Path
+from typing import List
+from unittest.mock import Mock, call
+
+import numpy as np
+from pytest import fixture, mark
+from pytest_mock import MockerFixture
+
+from app.repository.cache import EmbeddingCache
+from app.repository.sentence_transformer import (
+    SentenceTransformerRepository,
+    chunk_spans,
+    load_model,
+    mean_embeddings,
+    token_budget_batches,
+    truncate_embeddings,
+)
+
+
+def fake_encode(texts: List[str], batch_size: int = 32) -> np.ndarray:
+    return np.array([[float(len(text)), 1.0] for text in texts], dtype=np.float32)
+
+
+@fixture
+def model(mocker: MockerFixture) -> Mock:
+    model = mocker.patch("app.repository.sentence_transformer.SentenceTransformer")
+    model.return_value.encode.side_effect = fake_encode
+    model.return_value.get_sentence_embedding_dimension.return_value = 2
+    return model.return_value
+
+
+@mark.ut
+def test_encode_texts_without_cache(model: Mock):
+    # given
+    repo = SentenceTransformerRepository("model")
+    # when
+    embeddings = repo.encode_texts(["a", "bb"])
+    # then
+    assert embeddings[:, 0].tolist() == [1.0, 2.0]
+    model.encode.assert_called_once_with(["a", "bb"], batch_size=32)
+
+
+@mark.ut
+def test_encode_texts_only_encodes_uncached_texts(model: Mock):
+    # given
+    cache = EmbeddingCache("model", max_bytes=1024 * 1024)
+    repo = SentenceTransformerRepository("model", cache=cache)
+    repo.encode_texts(["a", "bb"])
+    # when
+    embeddings = repo.encode_texts(["bb", "ccc", "a", "ccc"])
+    # then
+    assert embeddings[:, 0].tolist() == [2.0, 3.0, 1.0, 3.0]
+    assert model.encode.call_args_list[-1].args == (["ccc"],)
+    assert cache.stats().hits == 2
+
+
+@mark.ut
+def test_encode_text_returns_cached_embedding(model: Mock):
+    # given
+    repo = SentenceTransformerRepository(
+        "model", cache=EmbeddingCache("model", max_bytes=1024 * 1024)
+    )
+    first = repo.encode_text("abc")
+    # when
+    second = repo.encode_text("abc")
+    # then
+    assert np.array_equal(first, second)
+    model.encode.assert_called_once()
+
+
+@mark.ut
+def test_encode_empty_texts(model: Mock):
+    # given
+    repo = SentenceTransformerRepository(
+        "model", cache=EmbeddingCache("model", max_bytes=1024 * 1024)
+    )
+    # when
+    embeddings = repo.encode_texts([])
+    # then
+    assert embeddings.shape == (0, 2)
+    model.encode.assert_not_called()
+
+
+@mark.ut
+def test_truncate_embeddings():
+    # given
+    embeddings = np.array([[3.0, 4.0, 12.0], [0.0, 0.0, 1.0]], dtype=np.float32)
+    # when
+    truncated = truncate_embeddings(embeddings, 2)
+    # then
+    assert truncated.dtype == np.float32
+    assert np.allclose(truncated, [[0.6, 0.8], [0.0, 0.0]])
+    assert truncate_embeddings(embeddings, None) is embeddings
+    assert truncate_embeddings(embeddings, 3) is embeddings
+
+
+@mark.ut
+def test_load_model_with_torch_backend(mocker: MockerFixture):
+    # given
+    model = mocker.patch("app.repository.sentence_transformer.SentenceTransformer")
+    # when
+    loaded = load_model("org/model")
+    # then
+    assert loaded is model.return_value
+    model.assert_called_once_with("org/model")
+
+
+@mark.ut
+def test_load_model_exports_onnx_once(mocker: MockerFixture, tmp_path: Path):
+    # given
+    model = mocker.patch("app.repository.sentence_transformer.SentenceTransformer")
+    path = tmp_path / "org__model"
+
+    def save_pretrained(target: str):
+        (Path(target) / "onnx").mkdir(parents=True)
+        (Path(target) / "onnx" / "model.onnx").touch()
+
+    model.return_value.save_pretrained.side_effect = save_pretrained
+    # when
+    load_model("org/model", "onnx", str(tmp_path))
+    load_model("org/model", "onnx", str(tmp_path))
+    # then
+    assert model.call_args_list == [
+        call("org/model", backend="onnx"),
+        call(str(path), backend="onnx"),
+        call(str(path), backend="onnx"),
+    ]
+
+
+@mark.ut
+def test_load_model_quantizes_onnx_once(mocker: MockerFixture, tmp_path: Path):
+    # given
+    model = mocker.patch("app.repository.sentence_transformer.SentenceTransformer")
+    export = mocker.patch(
+        "app.repository.sentence_transformer.export_dynamic_quantized_onnx_model"
+    )
+    path = tmp_path / "org__model"
+    (path / "onnx").mkdir(parents=True)
+    (path / "onnx" / "model.onnx").touch()
+    export.side_effect = lambda *_: (path / "onnx" / "model_qint8_avx2.onnx").touch()
+    file_name = "onnx/model_qint8_avx2.onnx"
+    # when
+    load_model("org/model", "onnx-int8", str(tmp_path), "avx2")
+    loaded = load_model("org/model", "onnx-int8", str(tmp_path), "avx2")
+    # then
+    assert loaded is model.return_value
+    export.assert_called_once_with(model.return_value, "avx2", str(path))
+    model.assert_called_with(
+        str(path), backend="onnx", model_kwargs={"file_name": file_name}
+    )
+
+
+@mark.ut
+def test_load_model_sets_onnx_runtime_threads(mocker: MockerFixture, tmp_path: Path):
+    # given
+    model = mocker.patch("app.repository.sentence_transformer.SentenceTransformer")
+    onnxruntime = mocker.Mock()
+    mocker.patch.dict(sys.modules, {"onnxruntime": onnxruntime})
+    path = tmp_path / "org__model"
+    (path / "onnx").mkdir(parents=True)
+    (path / "onnx" / "model.onnx").touch()
+    (path / "onnx" / "model_qint8_avx2.onnx").touch()
+    # when
+    load_model("org/model", "onnx", str(tmp_path), num_threads=2)
+    load_model("org/model", "onnx-int8", str(tmp_path), "avx2", num_threads=2)
+    # then
+    options = onnxruntime.SessionOptions.return_value
+    assert options.intra_op_num_threads == 2
+    assert model.call_args_list == [
+        call(str(path), backend="onnx", model_kwargs={"session_options": options}),
+        call(
+            str(path),
+            backend="onnx",
+            model_kwargs={
+                "file_name": "onnx/model_qint8_avx2.onnx",
+                "session_options": options,
+            },
+        ),
+    ]
+
+
+@mark.ut
+def test_token_budget_batches():
+    # given
+    lengths = [5, 100, 10, 90, 0, 8]
+    # when
+    batches = token_budget_batches(lengths, max_tokens=200)
+    # then
+    assert batches == [[1, 3], [2, 5, 0, 4]]
+    assert token_budget_batches(lengths, max_tokens=200, max_items=1) == [
+        [1],
+        [3],
+        [2],
+        [5],
+        [0],
+        [4],
+    ]
+    assert token_budget_batches([], max_tokens=200) == []
+
+
+@mark.ut
+def test_encode_texts_by_token_budget(model: Mock):
+    # given
+    model.tokenizer.side_effect = lambda texts, **_: {
+        "input_ids": [[0] * len(text) for text in texts]
+    }
+    repo = SentenceTransformerRepository("model", max_batch_tokens=8)
+    texts = ["a", "bbbb", "cc", "dddd"]
+    # when
+    embeddings = repo.encode_texts(texts)
+    # then
+    assert np.array_equal(embeddings, fake_encode(texts))
+    assert [c.args[0] for c in model.encode.call_args_list] == [
+        ["bbbb", "dddd"],
+        ["cc", "a"],
+    ]
+
+
+@mark.ut
+def test_encode_texts_by_token_budget_caps_batch_size(model: Mock):
+    # given
+    model.tokenizer.side_effect = lambda texts, **_: {
+        "input_ids": [[0] * len(text) for text in texts]
+    }
+    repo = SentenceTransformerRepository("model", batch_size=2, max_batch_tokens=100)
+    texts = ["a", "b", "c", "d", "e"]
+    # when
+    embeddings = repo.encode_texts(texts)
+    # then
+    assert np.array_equal(embeddings, fake_encode(texts))
+    assert [len(c.args[0]) for c in model.encode.call_args_list] == [2, 2, 1]
+
+
+@mark.ut
+def test_chunk_spans():
+    # given
+    offsets = [(0, 2), (3, 5), (6, 8), (9, 11), (12, 14)]
+    # when
+    spans = chunk_spans(offsets, max_tokens=3, overlap=1)
+    # then
+    assert spans == [(0, 8), (6, 14)]
+    assert chunk_spans(offsets, max_tokens=8, overlap=2) == [(0, 14)]
+    assert chunk_spans([], max_tokens=3) == [(0, 0)]
+
+
+@mark.ut
+def test_chunk_spans_limits_overlap_to_half_window():
+    # given
+    offsets = [(i, i + 1) for i in range(1000)]
+    # when
+    spans = chunk_spans(offsets, max_tokens=32, overlap=32)
+    # then
+    # 1トークンずつ進むのではなく、窓の半分ずつ進む
+    assert len(spans) == 62
+    assert spans[:2] == [(0, 32), (16, 48)]
+
+
+@mark.ut
+def test_mean_embeddings():
+    # given
+    embeddings = np.array([[1.0, 0.0], [0.0, 1.0], [0.6, 0.8]], dtype=np.float32)
+    # when
+    pooled = mean_embeddings(embeddings, [0, 0, 1], 2)
+    # then
+    assert pooled.dtype == np.float32
+    assert np.allclose(pooled, [[0.7071068, 0.7071068], [0.6, 0.8]])
+
+
+@mark.ut
+def test_chunk_texts_leaves_room_for_title(model: Mock):
+    # given
+    def tokenize(texts, return_offsets_mapping=False, **_):
+        # 1文字を1トークンとして扱う
+        if return_offsets_mapping:
+            return {
+                "offset_mapping": [[(i, i + 1) for i in range(len(t))] for t in texts]
+            }
+        return {"input_ids": [[0] * len(t) for t in texts]}
+
+    model.tokenizer.side_effect = tokenize
+    model.tokenizer.num_special_tokens_to_add.return_value = 2
+    model.max_seq_length = 8
+    repo = SentenceTransformerRepository("model")
+    # when
+    chunks = repo.chunk_texts(["ab", "a"], ["0123456789", "01"], overlap=1)
+    limited = repo.chunk_texts(["a"], ["0123456789"], max_tokens=3)
+    # then
+    assert chunks == [["0123", "3456", "6789"], ["01"]]
+    assert limited == [["012", "345", "678", "9"]]
+
+
+@mark.ut
+def test_chunk_texts_keeps_window_for_long_title(model: Mock):
+    # given
+    def tokenize(texts, return_offsets_mapping=False, **_):
+        if return_offsets_mapping:
+            return {
+                "offset_mapping": [[(i, i + 1) for i in range(len(t))] for t in texts]
+            }
+        return {"input_ids": [[0] * len(t) for t in texts]}
+
+    model.tokenizer.side_effect = tokenize
+    model.tokenizer.num_special_tokens_to_add.return_value = 2
+    model.max_seq_length = 10
+    repo = SentenceTransformerRepository("model")
+    # when
+    # タイトルが入力上限より長くても、本文の窓は入力上限の半分を残す
+    chunks = repo.chunk_texts(["t" * 20], ["0123456789"], overlap=8)
+    # then
+    assert chunks == [["0123", "2345", "4567", "6789"]]
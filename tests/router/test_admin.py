@@ -0,0 +1,121 @@
+from datetime import datetime, timezone
+from unittest.mock import Mock
+
+from fastapi import status
+from fastapi.testclient import TestClient
+from pytest import mark
+from pytest_mock import MockerFixture
+
+from app.main import app
+from app.profiling import ProfileStore, RequestProfile, get_profile_store
+from app.repository.memory import InMemoryVectorRepository
+from app.repository.pgvector import (
+    InsertVector,
+    PgVectorRepository,
+    ReindexResult,
+    get_pgvector_repository,
+)
+
+client = TestClient(app)
+
+
+@mark.ut
+def test_reindex(mocker: MockerFixture):
+    # given
+    repository: Mock = mocker.create_autospec(spec=PgVectorRepository)
+    repository.reindex.return_value = ReindexResult(
+        index_type="ivfflat", rows=50000, lists=50, elapsed_seconds=1.5
+    )
+    app.dependency_overrides[get_pgvector_repository] = lambda: repository
+    # when
+    response = client.post("/admin/reindex")
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["lists"] == 50
+    repository.reindex.assert_called_once()
+
+
+@mark.ut
+def test_reindex_model_table(mocker: MockerFixture):
+    # given
+    repository: Mock = mocker.create_autospec(spec=PgVectorRepository)
+    other: Mock = mocker.create_autospec(spec=PgVectorRepository)
+    other.reindex.return_value = ReindexResult(
+        index_type="hnsw", rows=10, lists=None, elapsed_seconds=0.1
+    )
+    repository.for_table.return_value = other
+    app.dependency_overrides[get_pgvector_repository] = lambda: repository
+    # when
+    response = client.post(
+        "/admin/reindex", params={"model": "intfloat/multilingual-e5-large"}
+    )
+    unknown = client.post("/admin/reindex", params={"model": "unknown"})
+    del app.dependency_overrides[get_pgvector_repository]
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    repository.for_table.assert_called_once_with(
+        "embeddings_multilingual_e5_large", 1024
+    )
+    other.reindex.assert_called_once()
+    repository.reindex.assert_not_called()
+    assert unknown.status_code == status.HTTP_404_NOT_FOUND
+
+
+@mark.ut
+def test_snapshot(tmp_path):
+    # given
+    repository = InMemoryVectorRepository(vector_dim=2, snapshot_dir=str(tmp_path))
+    repository.copy(
+        [InsertVector(category="a", title="t", text="x", embedding=[1.0, 0.0])]
+    )
+    app.dependency_overrides[get_pgvector_repository] = lambda: repository
+    # when
+    response = client.post("/admin/snapshot")
+    del app.dependency_overrides[get_pgvector_repository]
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"rows": 1, "tables": {"embeddings": 1}}
+    assert (tmp_path / "embeddings" / "documents.jsonl").exists()
+
+
+@mark.ut
+def test_snapshot_requires_memory_backend(mocker: MockerFixture):
+    # given
+    repository: Mock = mocker.create_autospec(spec=PgVectorRepository)
+    app.dependency_overrides[get_pgvector_repository] = lambda: repository
+    # when
+    response = client.post("/admin/snapshot")
+    del app.dependency_overrides[get_pgvector_repository]
+    # then
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@mark.ut
+def test_profiles():
+    # given
+    store = ProfileStore()
+    profile = store.add(
+        RequestProfile(
+            id=store.reserve_id(),
+            method="POST",
+            path="/hybrid/search",
+            trigger="header",
+            started_at=datetime(2026, 1, 1, tzinfo=timezone.utc),
+            elapsed_ms=12.5,
+            status=200,
+            stats="10 function calls",
+            explain=["Limit"],
+        )
+    )
+    app.dependency_overrides[get_profile_store] = lambda: store
+    # when
+    listed = client.get("/admin/profiles")
+    found = client.get(f"/admin/profiles/{profile.id}")
+    missing = client.get("/admin/profiles/999")
+    del app.dependency_overrides[get_profile_store]
+    # then
+    assert listed.status_code == status.HTTP_200_OK
+    assert [p["id"] for p in listed.json()] == [1]
+    assert "stats" not in listed.json()[0]
+    assert found.json()["explain"] == ["Limit"]
+    assert missing.status_code == status.HTTP_404_NOT_FOUND
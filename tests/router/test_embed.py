@@ -1,3 +1,5 @@
+import base64
+import io
 from unittest.mock import Mock
 
 import numpy as np
@@ -7,25 +9,27 @@ from pytest import fixture, mark
 from pytest_mock import MockerFixture
 
 from app.main import app
-from app.repository.sentence_transformer import (
-    SentenceTransformerRepository,
-    get_sentence_transformer_repository,
+from app.repository.batcher import (
+    EmbeddingBatcher,
+    QueueFullError,
+    get_embedding_batcher,
 )
+from app.repository.registry import ModelRegistry, get_model_registry
 
 client = TestClient(app)
 
 
 @fixture
-def sentence_transformer_repository(mocker: MockerFixture):
-    repository: Mock = mocker.create_autospec(spec=SentenceTransformerRepository)
-    repository.encode_text.return_value = np.array([0.1, 0.2, 0.3])
-    repository.encode_texts.return_value = np.array([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]])
-    app.dependency_overrides[get_sentence_transformer_repository] = lambda: repository
-    return repository
+def embedding_batcher(mocker: MockerFixture):
+    batcher: Mock = mocker.create_autospec(spec=EmbeddingBatcher)
+    batcher.encode_text.return_value = np.array([0.1, 0.2, 0.3])
+    batcher.encode_texts.return_value = np.array([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]])
+    app.dependency_overrides[get_embedding_batcher] = lambda: batcher
+    return batcher
 
 
 @mark.ut
-def test_embed_text(sentence_transformer_repository: Mock):
+def test_embed_text(embedding_batcher: Mock):
     # given
     text = "Hello, world!"
     # when
@@ -33,11 +37,11 @@ def test_embed_text(sentence_transformer_repository: Mock):
     # then
     assert response.status_code == status.HTTP_200_OK
     assert response.json() == {"embedding": [0.1, 0.2, 0.3]}
-    sentence_transformer_repository.encode_text.assert_called_once_with(text)
+    embedding_batcher.encode_text.assert_called_once_with(text)
 
 
 @mark.ut
-def test_embed_texts(sentence_transformer_repository: Mock):
+def test_embed_texts(embedding_batcher: Mock):
     # given
     texts = ["Hello, world!", "Goodbye, world!"]
     # when
@@ -45,4 +49,153 @@ def test_embed_texts(sentence_transformer_repository: Mock):
     # then
     assert response.status_code == status.HTTP_200_OK
     assert response.json() == {"embeddings": [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]]}
-    sentence_transformer_repository.encode_texts.assert_called_once_with(tuple(texts))
+    embedding_batcher.encode_texts.assert_called_once_with(texts)
+
+
+@mark.ut
+def test_embed_text_queue_full(embedding_batcher: Mock):
+    # given
+    embedding_batcher.encode_text.side_effect = QueueFullError("full")
+    # when
+    response = client.post("/embed", json={"text": "Hello, world!"})
+    # then
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert response.headers["Retry-After"] == "1"
+
+
+@mark.ut
+def test_embed_texts_with_dimension(embedding_batcher: Mock):
+    # given
+    embedding_batcher.encode_texts.return_value = np.array(
+        [[3.0, 4.0, 1.0], [0.0, 2.0, 1.0]], dtype=np.float32
+    )
+    # when
+    response = client.post("/embed/batch", json={"texts": ["a", "b"], "dimension": 2})
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert np.allclose(response.json()["embeddings"], [[0.6, 0.8], [0.0, 1.0]])
+
+
+@mark.ut
+def test_embed_text_rejects_dimension_larger_than_model(embedding_batcher: Mock):
+    # when
+    response = client.post("/embed", json={"text": "a", "dimension": 100000})
+    # then
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    embedding_batcher.encode_text.assert_not_called()
+
+
+@mark.ut
+def test_embed_texts_as_octet_stream(embedding_batcher: Mock):
+    # when
+    response = client.post(
+        "/embed/batch",
+        json={"texts": ["a", "b"]},
+        headers={"Accept": "application/octet-stream"},
+    )
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/octet-stream"
+    assert response.headers["X-Embedding-Shape"] == "2,3"
+    embeddings = np.frombuffer(
+        response.content, dtype=response.headers["X-Embedding-Dtype"]
+    ).reshape(2, 3)
+    assert np.allclose(embeddings, [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]])
+
+
+@mark.ut
+def test_embed_texts_as_npy_float16(embedding_batcher: Mock):
+    # when
+    response = client.post(
+        "/embed/batch",
+        json={"texts": ["a", "b"], "dtype": "float16"},
+        headers={"Accept": "application/x-npy"},
+    )
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    embeddings = np.load(io.BytesIO(response.content))
+    assert embeddings.dtype == np.float16
+    assert embeddings.shape == (2, 3)
+    assert np.allclose(embeddings, [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]], atol=1e-3)
+
+
+@mark.ut
+def test_embed_text_rejects_float16_as_json_numbers(embedding_batcher: Mock):
+    # when
+    response = client.post("/embed", json={"text": "a", "dtype": "float16"})
+    base64_response = client.post(
+        "/embed", json={"text": "a", "dtype": "float16", "encoding": "base64"}
+    )
+    # then
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert base64_response.status_code == status.HTTP_200_OK
+    embedding = np.frombuffer(
+        base64.b64decode(base64_response.json()["embedding"]), "<f2"
+    )
+    assert np.allclose(embedding, [0.1, 0.2, 0.3], atol=1e-3)
+    embedding_batcher.encode_text.assert_called_once()
+
+
+@mark.ut
+def test_embed_text_as_base64(embedding_batcher: Mock):
+    # when
+    response = client.post("/embed", json={"text": "a", "encoding": "base64"})
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    embedding = np.frombuffer(base64.b64decode(response.json()["embedding"]), "<f4")
+    assert np.allclose(embedding, [0.1, 0.2, 0.3])
+
+
+@mark.ut
+def test_embed_text_with_model(embedding_batcher: Mock, mocker: MockerFixture):
+    # given
+    other: Mock = mocker.create_autospec(spec=EmbeddingBatcher)
+    other.encode_text.return_value = np.array([0.6, 0.8])
+    other.repository = Mock()
+    other.repository.memory_bytes.return_value = 0
+    factory = Mock(return_value=other)
+    app.dependency_overrides[get_model_registry] = lambda: ModelRegistry(
+        "sentence-transformers/all-MiniLM-L6-v2",
+        embedding_batcher,
+        factory=factory,
+        model_names=["intfloat/multilingual-e5-large"],
+        max_bytes=0,
+    )
+    # when
+    response = client.post(
+        "/embed", json={"text": "abc", "model": "intfloat/multilingual-e5-large"}
+    )
+    unknown = client.post("/embed", json={"text": "abc", "model": "unknown"})
+    del app.dependency_overrides[get_model_registry]
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"embedding": [0.6, 0.8]}
+    factory.assert_called_once_with("intfloat/multilingual-e5-large")
+    embedding_batcher.encode_text.assert_not_called()
+    assert unknown.status_code == status.HTTP_404_NOT_FOUND
+
+
+@mark.ut
+def test_embed_text_rejects_dimension_before_loading_model(embedding_batcher: Mock):
+    # given
+    factory = Mock()
+    app.dependency_overrides[get_model_registry] = lambda: ModelRegistry(
+        "sentence-transformers/all-MiniLM-L6-v2",
+        embedding_batcher,
+        factory=factory,
+        model_names=["intfloat/multilingual-e5-large"],
+        max_bytes=0,
+    )
+    # when
+    response = client.post(
+        "/embed",
+        json={
+            "text": "abc",
+            "model": "intfloat/multilingual-e5-large",
+            "dimension": 2048,
+        },
+    )
+    del app.dependency_overrides[get_model_registry]
+    # then
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    factory.assert_not_called()
@@ -1,8 +1,27 @@
+from unittest.mock import Mock
+
 from fastapi import status
 from fastapi.testclient import TestClient
 from pytest import mark
+from pytest_mock import MockerFixture
 
 from app.main import app
+from app.repository.batcher import EmbeddingBatcher
+from app.repository.cache import (
+    CacheStats,
+    SearchResultCache,
+    get_search_result_cache,
+)
+from app.repository.pgvector import (
+    PgVectorRepository,
+    PoolStats,
+    get_pgvector_repository,
+)
+from app.repository.registry import ModelRegistry, get_model_registry
+from app.repository.sentence_transformer import (
+    SentenceTransformerRepository,
+    get_sentence_transformer_repository,
+)
 
 client = TestClient(app)
 
@@ -14,3 +33,83 @@ def test_health_check():
     # then
     assert response.status_code == status.HTTP_200_OK
     assert response.json() is None
+
+
+@mark.ut
+def test_db_pool_stats(mocker: MockerFixture):
+    # given
+    repository: Mock = mocker.create_autospec(spec=PgVectorRepository)
+    repository.pool_stats.return_value = PoolStats(
+        size=4, available=1, in_use=3, waiting=2, requests=10, wait_ms=25, errors=0
+    )
+    app.dependency_overrides[get_pgvector_repository] = lambda: repository
+    # when
+    response = client.get("/health/db")
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["in_use"] == 3
+    assert response.json()["waiting"] == 2
+
+
+@mark.ut
+def test_embedding_cache_stats(mocker: MockerFixture):
+    # given
+    repository: Mock = mocker.create_autospec(spec=SentenceTransformerRepository)
+    repository.cache = mocker.Mock()
+    repository.cache.stats.return_value = CacheStats(
+        hits=3, misses=1, evictions=0, entries=1, bytes=1664, max_bytes=4096
+    )
+    app.dependency_overrides[get_sentence_transformer_repository] = lambda: repository
+    # when
+    response = client.get("/health/cache")
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["hits"] == 3
+    assert response.json()["misses"] == 1
+
+
+@mark.ut
+def test_search_cache_stats():
+    # given
+    cache = SearchResultCache("test-model", max_bytes=4096)
+    app.dependency_overrides[get_search_result_cache] = lambda: cache
+    # when
+    response = client.get("/health/search-cache")
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["max_bytes"] == 4096
+    assert response.json()["entries"] == 0
+
+
+@mark.ut
+def test_model_registry_stats(mocker: MockerFixture):
+    # given
+    default: Mock = mocker.create_autospec(spec=EmbeddingBatcher)
+    default.repository = Mock()
+    default.repository.memory_bytes.return_value = 90_000_000
+    registry = ModelRegistry(
+        "sentence-transformers/all-MiniLM-L6-v2",
+        default,
+        factory=Mock(),
+        model_names=[],
+        max_bytes=1024,
+    )
+    app.dependency_overrides[get_model_registry] = lambda: registry
+    # when
+    response = client.get("/health/models")
+    del app.dependency_overrides[get_model_registry]
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {
+        "models": [
+            {
+                "model_name": "sentence-transformers/all-MiniLM-L6-v2",
+                "bytes": 90_000_000,
+                "default": True,
+            }
+        ],
+        "bytes": 0,
+        "max_bytes": 1024,
+        "loads": 0,
+        "evictions": 0,
+    }
@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 from unittest.mock import Mock
 
@@ -8,33 +9,47 @@ from pytest import fixture, mark
 from pytest_mock import MockerFixture
 
 from app.main import app
+from app.repository.batcher import (
+    EmbeddingBatcher,
+    QueueFullError,
+    get_embedding_batcher,
+)
+from app.repository.cache import SearchResultCache, get_search_result_cache
+from app.repository.fusion import FusionParams
 from app.repository.pgvector import (
     PgVectorRepository,
     VectorRecord,
     get_pgvector_repository,
 )
-from app.repository.sentence_transformer import (
-    SentenceTransformerRepository,
-    get_sentence_transformer_repository,
-)
+from app.repository.registry import ModelRegistry, get_model_registry
+from app.settings import Settings, get_settings
 
 client = TestClient(app)
 
 
 @fixture
-def sentence_transformer_repository(mocker: MockerFixture):
-    repository: Mock = mocker.create_autospec(spec=SentenceTransformerRepository)
-    repository.encode_text.return_value = np.array([0.1, 0.2, 0.3], dtype=np.float32)
-    repository.encode_texts.return_value = np.array(
+def embedding_batcher(mocker: MockerFixture):
+    batcher: Mock = mocker.create_autospec(spec=EmbeddingBatcher)
+    batcher.encode_text.return_value = np.array([0.1, 0.2, 0.3], dtype=np.float32)
+    batcher.encode_texts.return_value = np.array(
         [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]], dtype=np.float32
     )
-    app.dependency_overrides[get_sentence_transformer_repository] = lambda: repository
-    return repository
+    app.dependency_overrides[get_embedding_batcher] = lambda: batcher
+    return batcher
+
+
+@fixture(autouse=True)
+def search_cache():
+    # 既定ではキャッシュを無効にし、各テストで検索が実行されるようにする
+    app.dependency_overrides[get_search_result_cache] = lambda: None
+    yield
+    del app.dependency_overrides[get_search_result_cache]
 
 
 @fixture
 def pgvector_repository(mocker: MockerFixture):
     repository: Mock = mocker.create_autospec(spec=PgVectorRepository)
+    repository.generation = 0
     repository.hybrid_search.return_value = [
         VectorRecord(
             id=1,
@@ -47,15 +62,13 @@ def pgvector_repository(mocker: MockerFixture):
             created_at=datetime(2024, 1, 1, 12, 0, 0),
         )
     ]
-    repository.copy.return_value = None
+    repository.copy_batch.return_value = None
     app.dependency_overrides[get_pgvector_repository] = lambda: repository
     return repository
 
 
 @mark.ut
-def test_hybrid_search(
-    sentence_transformer_repository: Mock, pgvector_repository: Mock
-):
+def test_hybrid_search(embedding_batcher: Mock, pgvector_repository: Mock):
     # given
     request_data = {"category": "test_category", "query": "test query"}
 
@@ -75,7 +88,7 @@ def test_hybrid_search(
     assert response_data[0]["hibrid_score"] == 0.90
     assert response_data[0]["created_at"] == "2024-01-01T12:00:00"
 
-    sentence_transformer_repository.encode_text.assert_called_once_with("test query")
+    embedding_batcher.encode_text.assert_called_once_with("test query")
     pgvector_repository.hybrid_search.assert_called_once()
     call_kwargs = pgvector_repository.hybrid_search.call_args.kwargs
     assert call_kwargs["category"] == "test_category"
@@ -86,9 +99,45 @@ def test_hybrid_search(
 
 
 @mark.ut
-def test_hybrid_insert(
-    sentence_transformer_repository: Mock, pgvector_repository: Mock
+def test_hybrid_search_with_model(
+    embedding_batcher: Mock, pgvector_repository: Mock, mocker: MockerFixture
 ):
+    # given
+    other: Mock = mocker.create_autospec(spec=EmbeddingBatcher)
+    other.encode_text.return_value = np.array([0.6, 0.8], dtype=np.float32)
+    other.repository = Mock()
+    other.repository.memory_bytes.return_value = 0
+    app.dependency_overrides[get_model_registry] = lambda: ModelRegistry(
+        "sentence-transformers/all-MiniLM-L6-v2",
+        embedding_batcher,
+        factory=lambda model_name: other,
+        model_names=["intfloat/multilingual-e5-large"],
+        max_bytes=0,
+    )
+    table: Mock = mocker.create_autospec(spec=PgVectorRepository)
+    table.generation = 0
+    table.hybrid_search.return_value = []
+    pgvector_repository.for_table.return_value = table
+    request_data = {"query": "test query", "model": "intfloat/multilingual-e5-large"}
+
+    # when
+    response = client.post("/hybrid/search", json=request_data)
+    del app.dependency_overrides[get_model_registry]
+
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == []
+    pgvector_repository.for_table.assert_called_once_with(
+        "embeddings_multilingual_e5_large", 1024
+    )
+    pgvector_repository.hybrid_search.assert_not_called()
+    embedding_batcher.encode_text.assert_not_called()
+    other.encode_text.assert_called_once_with("test query")
+    assert np.allclose(table.hybrid_search.call_args.kwargs["embedding"], [0.6, 0.8])
+
+
+@mark.ut
+def test_hybrid_insert(embedding_batcher: Mock, pgvector_repository: Mock):
     # given
     request_data = {
         "items": [
@@ -103,22 +152,338 @@ def test_hybrid_insert(
     # then
     assert response.status_code == status.HTTP_200_OK
 
-    sentence_transformer_repository.encode_texts.assert_called_once_with(
-        ("Title 1 Text 1", "Title 2 Text 2")
+    embedding_batcher.encode_texts.assert_called_once_with(
+        ["Title 1 Text 1", "Title 2 Text 2"]
     )
 
-    pgvector_repository.copy.assert_called_once()
-    call_args = pgvector_repository.copy.call_args[0][0]
-    assert len(call_args) == 2
-    assert call_args[0].category == "cat1"
-    assert call_args[0].title == "Title 1"
-    assert call_args[0].text == "Text 1"
+    pgvector_repository.copy_batch.assert_called_once()
+    batch = pgvector_repository.copy_batch.call_args[0][0]
+    assert batch.categories == ["cat1", "cat2"]
+    assert batch.titles == ["Title 1", "Title 2"]
+    assert batch.texts == ["Text 1", "Text 2"]
     assert np.array_equal(
-        call_args[0].embedding, np.array([0.1, 0.2, 0.3], dtype=np.float32)
+        batch.embeddings,
+        np.array([[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]], dtype=np.float32),
     )
-    assert call_args[1].category == "cat2"
-    assert call_args[1].title == "Title 2"
-    assert call_args[1].text == "Text 2"
-    assert np.array_equal(
-        call_args[1].embedding, np.array([0.4, 0.5, 0.6], dtype=np.float32)
+
+
+@mark.ut
+def test_hybrid_insert_with_chunking(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # given
+    app.dependency_overrides[get_settings] = lambda: Settings(
+        document_chunking=True, chunk_max_tokens=64, chunk_overlap_tokens=8
+    )
+    embedding_batcher.chunk_texts.return_value = [["a1", "a2"], ["b1"]]
+    embedding_batcher.encode_texts.return_value = np.array(
+        [[1.0, 0.0], [0.0, 1.0], [0.6, 0.8]], dtype=np.float32
+    )
+    request_data = {
+        "items": [
+            {"category": "cat", "title": "A", "text": "a1 a2"},
+            {"category": "cat", "title": "B", "text": "b1"},
+        ]
+    }
+
+    # when
+    response = client.post("/hybrid/insert", json=request_data)
+    del app.dependency_overrides[get_settings]
+
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    embedding_batcher.chunk_texts.assert_called_once_with(
+        ["A", "B"], ["a1 a2", "b1"], 64, 8
+    )
+    embedding_batcher.encode_texts.assert_called_once_with(["A a1", "A a2", "B b1"])
+    batch = pgvector_repository.copy_batch.call_args.args[0]
+    assert batch.chunks.documents == [0, 0, 1]
+    assert batch.chunks.positions == [0, 1, 0]
+    assert batch.chunks.texts == ["a1", "a2", "b1"]
+    # 文書のベクトルはチャンクの平均を正規化したもの
+    assert np.allclose(batch.embeddings, [[0.7071068, 0.7071068], [0.6, 0.8]])
+
+
+@fixture
+def ingest_settings():
+    app.dependency_overrides[get_settings] = lambda: Settings(ingest_chunk_size=2)
+    yield
+    del app.dependency_overrides[get_settings]
+
+
+@mark.ut
+def test_hybrid_insert_stream(
+    embedding_batcher: Mock, pgvector_repository: Mock, ingest_settings: None
+):
+    # given
+    embedding_batcher.encode_texts.side_effect = lambda texts: np.ones(
+        (len(texts), 3), dtype=np.float32
+    )
+    lines = [
+        json.dumps({"category": "cat", "title": f"Title {i}", "text": f"Text {i}"})
+        for i in range(5)
+    ]
+    body = "\n".join(lines) + "\n"
+
+    # when
+    response = client.post(
+        "/hybrid/insert/stream",
+        content=body.encode(),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["inserted"] == 5
+    assert response.json()["chunks"] == 3
+    assert pgvector_repository.copy_batch.call_count == 3
+    titles = [
+        title
+        for call in pgvector_repository.copy_batch.call_args_list
+        for title in call.args[0].titles
+    ]
+    assert titles == [f"Title {i}" for i in range(5)]
+
+
+@mark.ut
+def test_hybrid_insert_stream_invalid_line(
+    embedding_batcher: Mock, pgvector_repository: Mock, ingest_settings: None
+):
+    # given
+    embedding_batcher.encode_texts.side_effect = lambda texts: np.ones(
+        (len(texts), 3), dtype=np.float32
+    )
+    line = json.dumps({"category": "cat", "title": "Title", "text": "Text"})
+    body = "\n".join([line, line, line, '{"title": "missing fields"}'])
+
+    # when
+    response = client.post("/hybrid/insert/stream", content=body.encode())
+
+    # then
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert response.json()["detail"]["line"] == 4
+    assert response.json()["detail"]["inserted"] == 2
+
+
+@mark.ut
+def test_hybrid_insert_stream_waits_for_full_queue(
+    embedding_batcher: Mock, pgvector_repository: Mock, ingest_settings: None
+):
+    # given
+    ones = np.ones((2, 3), dtype=np.float32)
+    embedding_batcher.encode_texts.side_effect = [
+        ones,
+        QueueFullError("embedding queue is full (1)"),
+        ones,
+    ]
+    line = json.dumps({"category": "cat", "title": "Title", "text": "Text"})
+    body = "\n".join([line] * 4)
+    # when
+    response = client.post("/hybrid/insert/stream", content=body.encode())
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["inserted"] == 4
+    assert embedding_batcher.encode_texts.call_count == 3
+
+
+@mark.ut
+def test_hybrid_insert_stream_reports_inserted_rows_on_copy_error(
+    embedding_batcher: Mock, pgvector_repository: Mock, ingest_settings: None
+):
+    # given
+    embedding_batcher.encode_texts.side_effect = lambda texts: np.ones(
+        (len(texts), 3), dtype=np.float32
+    )
+    pgvector_repository.copy_batch.side_effect = [None, RuntimeError("copy failed")]
+    line = json.dumps({"category": "cat", "title": "Title", "text": "Text"})
+    body = "\n".join([line] * 5)
+    # when
+    response = client.post("/hybrid/insert/stream", content=body.encode())
+    # then
+    assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+    assert response.json()["detail"]["inserted"] == 2
+
+
+@mark.ut
+def test_hybrid_insert_stream_reports_inserted_rows_when_queue_stays_full(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # given
+    app.dependency_overrides[get_settings] = lambda: Settings(
+        ingest_chunk_size=2, ingest_queue_wait_seconds=0
+    )
+    embedding_batcher.encode_texts.side_effect = [
+        np.ones((2, 3), dtype=np.float32),
+        QueueFullError("embedding queue is full (1)"),
+    ]
+    line = json.dumps({"category": "cat", "title": "Title", "text": "Text"})
+    body = "\n".join([line] * 4)
+    # when
+    response = client.post("/hybrid/insert/stream", content=body.encode())
+    del app.dependency_overrides[get_settings]
+    # then
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert response.headers["Retry-After"] == "1"
+    assert response.json()["detail"]["inserted"] == 2
+
+
+@mark.ut
+def test_hybrid_search_with_ann_parameters(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # given
+    request_data = {"query": "test query", "ef_search": 200, "probes": 10}
+    # when
+    response = client.post("/hybrid/search", json=request_data)
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    call_kwargs = pgvector_repository.hybrid_search.call_args.kwargs
+    assert call_kwargs["ef_search"] == 200
+    assert call_kwargs["probes"] == 10
+
+
+@mark.ut
+def test_hybrid_search_rejects_invalid_ef_search(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # when
+    response = client.post("/hybrid/search", json={"query": "q", "ef_search": 0})
+    # then
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    pgvector_repository.hybrid_search.assert_not_called()
+
+
+@mark.ut
+def test_hybrid_search_with_fusion_parameters(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # given
+    request_data = {
+        "query": "test query",
+        "limit": 5,
+        "vector_candidates": 200,
+        "text_candidates": 50,
+        "max_distance": None,
+        "fusion": {"strategy": "rrf", "vector_weight": 1.0, "text_weight": 2.0},
+    }
+    # when
+    response = client.post("/hybrid/search", json=request_data)
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    call_kwargs = pgvector_repository.hybrid_search.call_args.kwargs
+    assert call_kwargs["limit"] == 5
+    assert call_kwargs["vector_candidates"] == 200
+    assert call_kwargs["text_candidates"] == 50
+    assert call_kwargs["max_distance"] is None
+    assert call_kwargs["fusion"] == FusionParams(
+        strategy="rrf", vector_weight=1.0, text_weight=2.0
+    )
+
+
+@mark.ut
+def test_hybrid_search_batch(embedding_batcher: Mock, pgvector_repository: Mock):
+    # given
+    record = pgvector_repository.hybrid_search.return_value[0]
+    pgvector_repository.hybrid_search_batch.return_value = [[record], []]
+    request_data = {
+        "queries": [
+            {"query": "first query", "category": "test_category"},
+            {"query": "second query", "limit": 3},
+        ]
+    }
+    # when
+    response = client.post("/hybrid/search/batch", json=request_data)
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    response_data = response.json()
+    assert len(response_data) == 2
+    assert response_data[0][0]["title"] == "Test Title"
+    assert response_data[1] == []
+    embedding_batcher.encode_texts.assert_called_once_with(
+        ["first query", "second query"]
+    )
+    queries = pgvector_repository.hybrid_search_batch.call_args.args[0]
+    assert [q.query for q in queries] == ["first query", "second query"]
+    assert queries[0].category == "test_category"
+    assert queries[1].limit == 3
+    assert np.allclose(queries[1].embedding, [0.4, 0.5, 0.6])
+
+
+@mark.ut
+def test_hybrid_search_batch_rejects_empty_queries(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # when
+    response = client.post("/hybrid/search/batch", json={"queries": []})
+    # then
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    embedding_batcher.encode_texts.assert_not_called()
+
+
+@mark.ut
+def test_hybrid_search_result_is_cached_until_insert(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # given
+    cache = SearchResultCache("test-model", max_bytes=1024 * 1024)
+    app.dependency_overrides[get_search_result_cache] = lambda: cache
+    request_data = {"category": "test_category", "query": "test query"}
+    # when
+    first = client.post("/hybrid/search", json=request_data)
+    second = client.post(
+        "/hybrid/search", json={**request_data, "query": " test query"}
+    )
+    pgvector_repository.generation = 1
+    third = client.post("/hybrid/search", json=request_data)
+    # then
+    assert first.json() == second.json() == third.json()
+    assert pgvector_repository.hybrid_search.call_count == 2
+    assert embedding_batcher.encode_text.call_count == 2
+    assert cache.stats().hits == 1
+
+
+@mark.ut
+def test_hybrid_search_batch_only_searches_uncached_queries(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # given
+    cache = SearchResultCache("test-model", max_bytes=1024 * 1024)
+    app.dependency_overrides[get_search_result_cache] = lambda: cache
+    record = pgvector_repository.hybrid_search.return_value[0]
+    client.post("/hybrid/search", json={"query": "cached query"})
+    pgvector_repository.hybrid_search_batch.return_value = [[]]
+    embedding_batcher.encode_texts.return_value = np.array(
+        [[0.1, 0.2, 0.3]], dtype=np.float32
+    )
+    # when
+    response = client.post(
+        "/hybrid/search/batch",
+        json={"queries": [{"query": "cached query"}, {"query": "new query"}]},
     )
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()[0][0]["id"] == record.id
+    assert response.json()[1] == []
+    embedding_batcher.encode_texts.assert_called_once_with(["new query"])
+
+
+@mark.ut
+def test_hybrid_insert_truncates_to_embedding_dimension(
+    embedding_batcher: Mock, pgvector_repository: Mock
+):
+    # given
+    app.dependency_overrides[get_settings] = lambda: Settings(embedding_dimension=2)
+    request_data = {
+        "items": [
+            {"category": "c", "title": "t1", "text": "x1"},
+            {"category": "c", "title": "t2", "text": "x2"},
+        ]
+    }
+    # when
+    response = client.post("/hybrid/insert", json=request_data)
+    del app.dependency_overrides[get_settings]
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    batch = pgvector_repository.copy_batch.call_args.args[0]
+    assert batch.embeddings.shape == (2, 2)
+    assert np.allclose(np.linalg.norm(batch.embeddings, axis=1), 1.0)
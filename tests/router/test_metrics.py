@@ -0,0 +1,101 @@
+from unittest.mock import Mock
+
+from fastapi import status
+from fastapi.testclient import TestClient
+from pytest import fixture, mark
+from pytest_mock import MockerFixture
+
+from app.main import app
+from app.repository.batcher import EmbeddingBatcher
+from app.repository.cache import (
+    CacheStats,
+    SearchResultCache,
+    get_search_result_cache,
+)
+from app.repository.pgvector import (
+    PoolStats,
+    get_pgvector_repository,
+    get_pool_stats,
+)
+from app.repository.registry import ModelRegistry, get_model_registry
+from app.repository.sentence_transformer import (
+    SentenceTransformerRepository,
+    get_sentence_transformer_repository,
+)
+
+client = TestClient(app)
+
+
+@fixture
+def overrides(mocker: MockerFixture):
+    repository: Mock = mocker.create_autospec(spec=SentenceTransformerRepository)
+    repository.cache = mocker.Mock()
+    repository.cache.stats.return_value = CacheStats(
+        hits=3, misses=1, evictions=0, entries=1, bytes=1664, max_bytes=4096
+    )
+    default: Mock = mocker.create_autospec(spec=EmbeddingBatcher)
+    default.repository = Mock()
+    default.repository.memory_bytes.return_value = 90_000_000
+    registry = ModelRegistry(
+        "sentence-transformers/all-MiniLM-L6-v2",
+        default,
+        factory=Mock(),
+        model_names=[],
+        max_bytes=1024,
+    )
+    app.dependency_overrides[get_sentence_transformer_repository] = lambda: repository
+    app.dependency_overrides[get_search_result_cache] = lambda: SearchResultCache(
+        "test-model", max_bytes=4096
+    )
+    app.dependency_overrides[get_model_registry] = lambda: registry
+    yield
+    for dependency in (
+        get_sentence_transformer_repository,
+        get_search_result_cache,
+        get_model_registry,
+    ):
+        del app.dependency_overrides[dependency]
+
+
+@mark.ut
+def test_metrics(overrides):
+    # given
+    app.dependency_overrides[get_pool_stats] = lambda: PoolStats(
+        size=4, available=1, in_use=3, waiting=2, requests=10, wait_ms=25, errors=0
+    )
+    client.get("/health")
+    # when
+    response = client.get("/metrics")
+    del app.dependency_overrides[get_pool_stats]
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert "# TYPE embedding_api_request_seconds histogram" in lines
+    assert any(
+        line.startswith(
+            'embedding_api_request_seconds_count{method="GET",route="/health",'
+            'status="200"}'
+        )
+        for line in lines
+    )
+    assert 'embedding_api_cache_hits_total{cache="embedding"} 3' in lines
+    assert 'embedding_api_cache_misses_total{cache="search"} 0' in lines
+    assert 'embedding_api_db_pool_connections{state="in_use"} 3' in lines
+    assert (
+        'embedding_api_model_bytes{model="sentence-transformers/all-MiniLM-L6-v2"} '
+        "90000000" in lines
+    )
+
+
+@mark.ut
+def test_metrics_without_database(overrides, mocker: MockerFixture):
+    # given
+    get_pgvector_repository.cache_clear()
+    connect = mocker.patch("app.repository.pgvector.PgVectorRepository.__init__")
+    # when
+    response = client.get("/metrics")
+    # then
+    assert response.status_code == status.HTTP_200_OK
+    connect.assert_not_called()
+    assert "embedding_api_db_pool_connections" not in response.text
@@ -0,0 +1,217 @@
+import csv
+import json
+from concurrent.futures import Future
+from pathlib import Path
+from typing import List
+from unittest.mock import Mock
+
+import numpy as np
+from pytest import fixture, mark, raises
+from pytest_mock import MockerFixture
+
+from app.ingest import (
+    Checkpoint,
+    ChunkEncoder,
+    chunked,
+    encode_chunked,
+    ingest,
+    parse_args,
+    read_records,
+)
+from app.repository.pgvector import ChunkBatch, PgVectorRepository
+from app.repository.sentence_transformer import SentenceTransformerRepository
+
+RECORDS = [(f"cat{i % 2}", f"Title {i}", f"Text {i}") for i in range(5)]
+
+
+def done(texts: List[str]) -> Future:
+    future: Future = Future()
+    future.set_result(np.ones((len(texts), 3), dtype=np.float32))
+    return future
+
+
+@fixture
+def repository(mocker: MockerFixture) -> Mock:
+    return mocker.create_autospec(spec=PgVectorRepository)
+
+
+@fixture
+def encoder(mocker: MockerFixture) -> Mock:
+    encoder: Mock = mocker.create_autospec(spec=ChunkEncoder)
+    encoder.workers = 1
+    encoder.chunking = False
+    encoder.submit.side_effect = done
+    return encoder
+
+
+@mark.ut
+def test_read_records_jsonl(tmp_path: Path):
+    # given
+    path = tmp_path / "corpus.jsonl"
+    path.write_text(
+        "\n".join(
+            json.dumps({"category": c, "title": t, "text": x}) for c, t, x in RECORDS
+        )
+        + "\n\n",
+        encoding="utf-8",
+    )
+    # when
+    records = list(read_records(path))
+    # then
+    assert records == RECORDS
+
+
+@mark.ut
+def test_read_records_csv(tmp_path: Path):
+    # given
+    path = tmp_path / "corpus.csv"
+    with path.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "category", "title", "text"])
+        writer.writerows([(i, *record) for i, record in enumerate(RECORDS)])
+    # when
+    records = list(read_records(path))
+    # then
+    assert records == RECORDS
+
+
+@mark.ut
+def test_read_records_unsupported_format(tmp_path: Path):
+    with raises(ValueError):
+        list(read_records(tmp_path / "corpus.xml"))
+
+
+@mark.ut
+def test_chunked():
+    assert [len(chunk) for chunk in chunked(RECORDS, 2)] == [2, 2, 1]
+
+
+@mark.ut
+def test_ingest(repository: Mock, encoder: Mock, tmp_path: Path):
+    # given
+    checkpoint = Checkpoint(tmp_path / "checkpoint.json", ["corpus.jsonl"])
+    # when
+    report = ingest(RECORDS, repository, encoder, checkpoint, chunk_size=2)
+    # then
+    assert report.rows == 5
+    assert report.chunks == 3
+    assert repository.copy_batch.call_count == 3
+    titles = [
+        title
+        for call in repository.copy_batch.call_args_list
+        for title in call.args[0].titles
+    ]
+    assert titles == [title for _, title, _ in RECORDS]
+    assert encoder.submit.call_args_list[0].args == (
+        ["Title 0 Text 0", "Title 1 Text 1"],
+    )
+    assert checkpoint.load() == 5
+    repository.drop_indexes.assert_not_called()
+
+
+@mark.ut
+def test_ingest_with_document_chunking(repository: Mock, encoder: Mock):
+    # given
+    encoder.chunking = True
+    chunks = ChunkBatch(
+        documents=[0, 1],
+        positions=[0, 0],
+        texts=["Text 0", "Text 1"],
+        embeddings=np.ones((2, 3), dtype=np.float32),
+    )
+    future: Future = Future()
+    future.set_result((np.ones((2, 3), dtype=np.float32), chunks))
+    encoder.submit_chunked.return_value = future
+    # when
+    ingest(RECORDS[:2], repository, encoder, Checkpoint(None, []), chunk_size=2)
+    # then
+    encoder.submit.assert_not_called()
+    assert encoder.submit_chunked.call_args.args == (
+        ["Title 0", "Title 1"],
+        ["Text 0", "Text 1"],
+    )
+    assert repository.copy_batch.call_args.args[0].chunks is chunks
+
+
+@mark.ut
+def test_encode_chunked(mocker: MockerFixture):
+    # given
+    model = mocker.create_autospec(spec=SentenceTransformerRepository)
+    model.chunk_texts.return_value = [["a", "b"], ["c"]]
+    model.encode_texts.return_value = np.array(
+        [[1, 0, 0], [0, 1, 0], [0.6, 0.8, 0]], dtype=np.float32
+    )
+    # when
+    embeddings, chunks = encode_chunked(
+        model, ["T0", "T1"], ["a b", "c"], 2, max_tokens=8, overlap=2
+    )
+    # then
+    model.chunk_texts.assert_called_once_with(["T0", "T1"], ["a b", "c"], 8, 2)
+    assert model.encode_texts.call_args.args == (["T0 a", "T0 b", "T1 c"],)
+    assert chunks.documents == [0, 0, 1]
+    assert chunks.positions == [0, 1, 0]
+    assert chunks.texts == ["a", "b", "c"]
+    assert chunks.embeddings.shape == (3, 2)
+    assert embeddings.shape == (2, 2)
+    np.testing.assert_allclose(np.linalg.norm(embeddings, axis=1), 1.0, rtol=1e-6)
+
+
+@mark.ut
+def test_ingest_resumes_from_checkpoint(
+    repository: Mock, encoder: Mock, tmp_path: Path
+):
+    # given
+    checkpoint = Checkpoint(tmp_path / "checkpoint.json", ["corpus.jsonl"])
+    checkpoint.save(4)
+    # when
+    report = ingest(RECORDS, repository, encoder, checkpoint, chunk_size=2)
+    # then
+    assert report.skipped == 4
+    assert report.rows == 1
+    repository.copy_batch.assert_called_once()
+    assert repository.copy_batch.call_args.args[0].titles == ["Title 4"]
+
+
+@mark.ut
+def test_checkpoint_rejects_other_sources(tmp_path: Path):
+    # given
+    Checkpoint(tmp_path / "checkpoint.json", ["a.jsonl"]).save(10)
+    # when / then
+    with raises(SystemExit):
+        Checkpoint(tmp_path / "checkpoint.json", ["b.jsonl"]).load()
+
+
+@mark.ut
+def test_ingest_rebuilds_indexes(repository: Mock, encoder: Mock):
+    # when
+    ingest(RECORDS, repository, encoder, Checkpoint(None, []), rebuild_indexes=True)
+    # then
+    repository.drop_indexes.assert_called_once()
+    repository.create_indexes.assert_called_once()
+
+
+@mark.ut
+def test_parse_args_rejects_dimension_larger_than_model():
+    with raises(SystemExit):
+        parse_args(
+            [
+                "corpus.jsonl",
+                "--model",
+                "sentence-transformers/all-MiniLM-L6-v2",
+                "--dimension",
+                "1024",
+            ]
+        )
+
+
+@mark.ut
+def test_parse_args_uses_the_table_of_the_model():
+    # when
+    default = parse_args(["corpus.jsonl"])
+    other = parse_args(["corpus.jsonl", "--model", "intfloat/multilingual-e5-large"])
+    explicit = parse_args(["corpus.jsonl", "--table", "backfill"])
+    # then
+    assert default.table == "embeddings"
+    assert other.table == "embeddings_multilingual_e5_large"
+    assert other.dimension is None
+    assert explicit.table == "backfill"
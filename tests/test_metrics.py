@@ -0,0 +1,52 @@
+from pytest import mark
+
+from app.metrics import Histogram, render_samples
+
+
+@mark.ut
+def test_histogram_render():
+    # given
+    histogram = Histogram(
+        "test_seconds", "Test latency", buckets=(0.1, 1.0), labelnames=("stage",)
+    )
+    # when
+    histogram.observe(0.05, "encode")
+    histogram.observe(0.1, "encode")
+    histogram.observe(3.0, "encode")
+    # then
+    assert histogram.count("encode") == 3
+    assert histogram.render() == [
+        "# HELP test_seconds Test latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="encode",le="0.1"} 2',
+        'test_seconds_bucket{stage="encode",le="1.0"} 2',
+        'test_seconds_bucket{stage="encode",le="+Inf"} 3',
+        'test_seconds_sum{stage="encode"} 3.15',
+        'test_seconds_count{stage="encode"} 3',
+    ]
+
+
+@mark.ut
+def test_histogram_time_escapes_labels():
+    # given
+    histogram = Histogram("test_seconds", "Test latency", labelnames=("stage",))
+    # when
+    with histogram.time('db "query"'):
+        pass
+    # then
+    assert histogram.count('db "query"') == 1
+    assert 'test_seconds_count{stage="db \\"query\\""} 1' in histogram.render()
+
+
+@mark.ut
+def test_render_samples():
+    # when
+    lines = render_samples(
+        "test_total", "Test counter", "counter", {("a",): 2}, labelnames=("kind",)
+    )
+    # then
+    assert lines == [
+        "# HELP test_total Test counter",
+        "# TYPE test_total counter",
+        'test_total{kind="a"} 2',
+    ]
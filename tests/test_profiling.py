@@ -0,0 +1,133 @@
+import asyncio
+
+import httpx
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pytest import mark
+
+from app.profiling import ProfileStore, ProfilingMiddleware, active_profile
+
+
+def busy_work() -> int:
+    return sum(i * i for i in range(10_000))
+
+
+def profiled_app(store: ProfileStore, sample_rate: float = 0.0) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/work")
+    def work():
+        # 同期のエンドポイントはスレッドプールで実行される
+        profile = active_profile()
+        if profile is not None:
+            profile.explains.append(lambda: "Limit (actual rows=1)")
+        return {"result": busy_work()}
+
+    app.add_middleware(ProfilingMiddleware, store=store, sample_rate=sample_rate)
+    return app
+
+
+@mark.ut
+def test_request_with_header_is_profiled():
+    # given
+    store = ProfileStore()
+    client = TestClient(profiled_app(store))
+    # when
+    response = client.get("/work", headers={"X-Profile": "1"})
+    # then
+    assert response.status_code == 200
+    [summary] = store.list()
+    assert response.headers["X-Profile-Id"] == str(summary.id)
+    assert summary.concurrent_requests == 0
+    assert summary.trigger == "header"
+    assert summary.path == "/work"
+    assert summary.status == 200
+    profile = store.get(summary.id)
+    assert "busy_work" in profile.stats
+    assert profile.explain == ["Limit (actual rows=1)"]
+
+
+@mark.ut
+def test_request_without_header_is_not_profiled():
+    # given
+    store = ProfileStore()
+    client = TestClient(profiled_app(store))
+    # when
+    response = client.get("/work", headers={"X-Profile": "0"})
+    # then
+    assert response.status_code == 200
+    assert store.list() == []
+    assert active_profile() is None
+    assert "X-Profile-Id" not in response.headers
+
+
+@mark.ut
+def test_sampled_requests_are_profiled():
+    # given
+    store = ProfileStore(max_profiles=2)
+    client = TestClient(profiled_app(store, sample_rate=1.0))
+    # when
+    for _ in range(3):
+        client.get("/work")
+    # then
+    assert [s.id for s in store.list()] == [3, 2]
+    assert all(s.trigger == "sample" for s in store.list())
+    assert store.get(1) is None
+
+
+def concurrent_app(store: ProfileStore) -> FastAPI:
+    app = FastAPI()
+    release = asyncio.Event()
+
+    @app.get("/wait")
+    async def wait():
+        await release.wait()
+        return {}
+
+    @app.get("/release")
+    async def release_waiting():
+        release.set()
+        return {}
+
+    app.add_middleware(ProfilingMiddleware, store=store)
+    return app
+
+
+async def get_concurrently(app: FastAPI, first: dict, second: dict):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        waiting = asyncio.create_task(client.get("/wait", headers=first))
+        await asyncio.sleep(0.01)
+        released = await client.get("/release", headers=second)
+        return await waiting, released
+
+
+@mark.ut
+def test_profile_records_requests_that_overlap():
+    # given
+    store = ProfileStore()
+    app = concurrent_app(store)
+    # when
+    waiting, released = asyncio.run(get_concurrently(app, {"X-Profile": "1"}, {}))
+    # then
+    assert (waiting.status_code, released.status_code) == (200, 200)
+    [summary] = store.list()
+    assert waiting.headers["X-Profile-Id"] == str(summary.id)
+    assert summary.path == "/wait"
+    assert summary.concurrent_requests == 1
+
+
+@mark.ut
+def test_request_is_not_profiled_while_other_request_is_in_flight():
+    # given
+    store = ProfileStore()
+    app = concurrent_app(store)
+    # when
+    waiting, released = asyncio.run(get_concurrently(app, {}, {"X-Profile": "1"}))
+    # then
+    assert (waiting.status_code, released.status_code) == (200, 200)
+    assert store.list() == []
+    assert released.headers["X-Profile-Skipped"] == "concurrent-requests"
+    # 単独で処理される場合はプロファイルされる
+    TestClient(app).get("/release", headers={"X-Profile": "1"})
+    assert [s.path for s in store.list()] == ["/release"]